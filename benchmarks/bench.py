@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+# benchmarks/bench.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Time the planning done by rollup.py, clearempty.py and snap-strip.py on a
+# synthetic pool held by the fake backend: parsing 'zfs get' output,
+# planning, building destroy ranges and batching them. Each phase reports
+# its best time over --repeat runs, its throughput in snapshots per second
+# and its peak Python memory. Results can be saved as a baseline and later
+# runs compared against it, failing if any phase regressed.
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zfsrollup import zfs
+from zfsrollup.fake import FakeBackend
+from zfsrollup.inventory import Inventory, fold, properties
+from zfsrollup.retention import Policy, plan, plan_empty, plan_empty_all, plan_strip, destroy_targets, batch_targets
+
+def generate(datasets=8, years=2, seed=0, root='tank', start=1500000000):
+    """A FakeBackend with 'datasets' children of 'root', each with hourly
+    auto snapshots over 'years', plus daily manual and weekly tm snapshots.
+
+    About a third of the auto snapshots are empty and half of those have
+    nothing written; the newest snapshots carry freenas:state markers.
+    """
+    rng = random.Random(seed)
+    fake = FakeBackend()
+    fake.create(root)
+    hours = int(years * 365.25 * 24)
+    for d in range(datasets):
+        dataset = '%s/data%d' % (root, d)
+        if d % 4 == 3:
+            # some nesting, as with per-user datasets
+            dataset = '%s/data%d/child' % (root, d - 1)
+        for hour in range(hours):
+            epoch = start + hour * 3600 + rng.randrange(60)
+            stamp = time.strftime('%Y%m%d.%H%M', time.gmtime(epoch))
+            if rng.random() < 0.33:
+                used = 0
+                written = 0 if rng.random() < 0.5 else rng.randrange(1, 1 << 20)
+            else:
+                used = rng.randrange(1, 1 << 30)
+                written = used + rng.randrange(1 << 20)
+            state = {}
+            if hour >= hours - 3:
+                state['freenas:state'] = 'NEW' if hour < hours - 1 else 'LATEST'
+            fake.snapshot(dataset, 'auto-%s-2w' % stamp, epoch, used, written, **state)
+            if hour % 24 == 12:
+                fake.snapshot(dataset, 'manual-%s' % stamp, epoch + 1, rng.randrange(1 << 20), rng.randrange(1 << 20))
+            if hour % 168 == 0:
+                fake.snapshot(dataset, 'tm-%s' % stamp, epoch + 2, 0, rng.randrange(1 << 10))
+    return fake
+
+def render(fake, root, props):
+    # the 'zfs get -Hrpo' output the cli backend would read from the pipe
+    return [('\t'.join(row) + '\n').encode() for row in fake.get(root, props, recursive=True)]
+
+def parse(lines, root):
+    inventory = Inventory()
+    for dataset, snapshots in fold((line.decode().rstrip('\n').split('\t', 2) for line in lines), root, True):
+        inventory.add(dataset, snapshots)
+    return inventory
+
+def empty_incremental(inventory, policy):
+    # clearempty.py --incremental without zfs: each pass picks one snapshot per dataset
+    deleted = {}
+    active = True
+    while active:
+        active = False
+        for action in plan_empty(inventory, policy, deleted):
+            deleted[(action.dataset, action.snapshot)] = action.used
+            inventory.discard(action.dataset, action.snapshot)
+            active = True
+    return deleted
+
+def measure(function, repeat, memory=True, setup=None):
+    # best wall time over 'repeat' runs, then one traced run for peak memory;
+    # 'setup' builds a fresh, untimed argument for phases that consume theirs
+    best = None
+    for _ in range(repeat):
+        argument = (setup(),) if setup else ()
+        started = time.perf_counter()
+        result = function(*argument)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    peak = 0
+    if memory:
+        argument = (setup(),) if setup else ()
+        tracemalloc.start()
+        function(*argument)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, best, peak
+
+def run(args):
+    started = time.perf_counter()
+    fake = generate(args.datasets, args.years, args.seed)
+    zfs.use(fake)
+    root = 'tank'
+    lines = render(fake, root, properties + ('written',))
+    count = sum(len(dataset.snapshots) for dataset in fake.datasets.values())
+    print("generated %d snapshots in %d datasets in %.1fs" % (count, len(fake.datasets) - 1,
+        time.perf_counter() - started), file=sys.stderr)
+
+    results = {}
+    def phase(name, function, count, setup=None):
+        result, seconds, peak = measure(function, args.repeat, not args.no_memory, setup)
+        results[name] = {
+            'seconds': round(seconds, 6),
+            'throughput': round(count / seconds) if seconds else None,
+            'peak_bytes': peak,
+        }
+        print("%-26s %10.4fs %12s snapshots/s %10.1f MiB" % (name, seconds,
+            results[name]['throughput'], peak / 1048576.0), file=sys.stderr)
+        return result
+
+    inventory = phase('parse', lambda: parse(lines, root), count)
+    usedbysnapshots = dict((dataset, fake.value(dataset, None, 'usedbysnapshots')) for dataset in inventory.datasets)
+
+    scripts = [
+        ('rollup', lambda: plan(inventory, Policy(prefixes=['auto']))),
+        ('clearempty', lambda: plan_empty_all(inventory, Policy(prefixes=['auto']), fake.reclaim, usedbysnapshots)),
+        ('snap-strip', lambda: plan_strip(inventory, Policy(prefixes=['auto']))),
+    ]
+    for script, planner in scripts:
+        actions = phase(script+'/plan', planner, count)
+        targets = phase(script+'/ranges', lambda: destroy_targets(actions), count)
+        phase(script+'/batch', lambda: batch_targets(targets), count)
+    # each incremental pass rescans a dataset from its newest snapshot, so
+    # only the newest --window snapshots of each dataset take part
+    window = copy(inventory, args.window)
+    phase('clearempty/incremental', lambda inventory: empty_incremental(inventory, Policy(prefixes=['auto'])),
+        sum(len(window.snapshots(dataset)) for dataset in window.datasets), setup=lambda: copy(window))
+
+    return {
+        'parameters': {'datasets': args.datasets, 'years': args.years, 'seed': args.seed, 'snapshots': count},
+        'python': sys.version.split()[0],
+        'results': results,
+    }
+
+def copy(inventory, newest=None):
+    duplicate = Inventory()
+    for dataset in inventory.datasets:
+        length = len(inventory.snapshots(dataset))
+        duplicate.add(dataset, inventory.snapshots(dataset).select(range(max(0, length - (newest or length)), length)))
+    return duplicate
+
+def compare(current, baseline, tolerance):
+    """Phases that got slower, or used more memory, than 'baseline' allows."""
+    regressions = []
+    if current['parameters'] != baseline['parameters']:
+        print("baseline was recorded with %s, not %s" % (baseline['parameters'], current['parameters']), file=sys.stderr)
+    for name, result in sorted(current['results'].items()):
+        before = baseline['results'].get(name)
+        if before is None:
+            continue
+        for key in ('seconds', 'peak_bytes'):
+            if before[key] and result[key] > before[key] * (1 + tolerance):
+                regressions.append("%s %s: %s -> %s (+%.0f%%)" % (name, key, before[key], result[key],
+                    (result[key] / float(before[key]) - 1) * 100))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark snapshot retention planning on a synthetic pool.')
+    parser.add_argument('--datasets', type=int, default=8, help='number of datasets to generate (default: 8)')
+    parser.add_argument('--years', type=float, default=2, help='years of hourly snapshots per dataset (default: 2)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic history')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per phase; the best time is reported (default: 3)')
+    parser.add_argument('--window', type=int, default=1000, help='newest snapshots per dataset used by the clearempty incremental phase (default: 1000)')
+    parser.add_argument('--no-memory', action="store_true", default=False, help='skip the traced run that measures peak memory')
+    parser.add_argument('--save', metavar='FILE', help='write the results to FILE as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results to a saved baseline and fail on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown or memory growth before failing --compare (default: 0.25)')
+
+    args = parser.parse_args()
+
+    current = run(args)
+    print(json.dumps(current, indent=1, sort_keys=True))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=1, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(current, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("regression:", regression, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
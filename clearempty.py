@@ -11,97 +11,177 @@
 # destroyed. This script iteratively destroys the oldest empty snapshot. It
 # does not remove the latest snapshot of each dataset or manual snapshots
 
-import subprocess
 import argparse
 import sys
-from collections import defaultdict
 
-parser = argparse.ArgumentParser(description='Removes empty auto snapshots.')
-parser.add_argument('datasets', nargs='+', help='the root dataset(s) from which to remove snapshots')
-parser.add_argument('--test', '-t', action="store_true", default=False, help='only display the snapshots that would be deleted, without actually deleting them. Note that due to dependencies between snapshots, this may not match what would really happen.')
-parser.add_argument('--recursive', '-r', action="store_true", default=False, help='recursively removes snapshots from nested datasets')
-parser.add_argument('--prefix', '-p', action='append', help='list of snapshot name prefixes that will be considered')
-
-args = parser.parse_args()
-
-if not args.prefix:
-    args.prefix = ['auto']
-
-args.prefix = [prefix+"-" for prefix in set(args.prefix)]
-
-deleted = defaultdict(lambda : defaultdict(lambda : defaultdict(int)))
-
-snapshot_was_deleted = True
-
-while snapshot_was_deleted:
-    snapshot_was_deleted = False
-    snapshots = defaultdict(lambda : defaultdict(lambda : defaultdict(int)))
-
-    # Get properties of all snapshots of the selected datasets
-    for dataset in args.datasets:
-        subp = subprocess.Popen(["zfs", "get", "-Hrpo", "name,property,value", "type,creation,used,freenas:state", dataset], stdout=subprocess.PIPE)
-        zfs_snapshots = subp.communicate()[0]
-        if subp.returncode:
-            print("zfs get failed with RC=%s" % subp.returncode)
+from zfsrollup import fleet, stats, zfs
+from zfsrollup.cache import source
+from zfsrollup.inventory import dataset_properties, properties
+from zfsrollup.retention import Policy, plan_empty, plan_empty_all, destroy_targets, batch_targets
+
+def main():
+    parser = argparse.ArgumentParser(description='Removes empty auto snapshots.')
+    parser.add_argument('datasets', nargs='+', help='the root dataset(s) from which to remove snapshots')
+    parser.add_argument('--test', '-t', action="store_true", default=False, help='only display the snapshots that would be deleted, without actually deleting them. Note that due to dependencies between snapshots, this may not match what would really happen unless --predict is used.')
+    parser.add_argument('--recursive', '-r', action="store_true", default=False, help='recursively removes snapshots from nested datasets')
+    parser.add_argument('--prefix', '-p', action='append', help='list of snapshot name prefixes that will be considered')
+    parser.add_argument('--predict', '-P', action="store_true", default=False, help='plan every removable empty snapshot up front from written and usedbysnapshots, verified with zfs destroy -nvp, and destroy them in one batch per dataset')
+    parser.add_argument('--cache', action="store_true", default=False, help='keep a snapshot inventory cache and only ask zfs about snapshots that changed since the last run')
+    parser.add_argument('--cache-dir', default=None, help='where to keep the inventory cache (default: ~/.cache/zfs-rollup)')
+    parser.add_argument('--incremental', '-i', action="store_true", default=False, help='list snapshots once and, after each destroy, only refresh the neighbouring snapshots whose used value may change')
+    parser.add_argument('--fleet', action="store_true", default=False, help='datasets are HOST:DATASET; list over ssh, plan here and destroy on all hosts at once')
+    parser.add_argument('--ssh-sessions', type=int, default=8, help='with --fleet, the most zfs commands run at once over the ssh connection to a host (default: 8)')
+    parser.add_argument('--backend', choices=zfs.backends, default='cli', help='how to talk to zfs: the zfs command (cli), libzfs_core through pyzfs (lzc), or an in-memory pool (fake)')
+    parser.add_argument('--fake-pool', default=None, help='with --backend fake, a JSON file to load the pool from and save it back to (with --fleet, a directory of HOST.json files)')
+    parser.add_argument('--stats', metavar='FILE', default=None, help='write run statistics (phase times, zfs calls, per-dataset counts) to FILE')
+    parser.add_argument('--stats-format', choices=('json', 'prometheus'), default=None, help='format of the --stats file (default: prometheus for *.prom files, json otherwise)')
+    parser.add_argument('--profile', metavar='FILE', default=None, help='save a cProfile profile of the run to FILE, for pstats')
+
+    args = parser.parse_args()
+
+    stats.configure(args, 'clearempty')
+
+    try:
+        if not args.fleet:
+            zfs.configure(args)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+
+    policy = Policy(prefixes=args.prefix)
+
+    if args.fleet:
+        failed = 0
+        try:
+            for host, output, error in fleet.each_host(args, lambda args, out: clear(args, policy, out)):
+                sys.stdout.write(fleet.prefixed(host, output))
+                if error:
+                    print("%s: %s" % (host, error))
+                    failed += 1
+                sys.stdout.flush()
+        except ValueError as e:
+            print(e)
             sys.exit(1)
-
-        for snapshot in zfs_snapshots.splitlines():
-            name,property,value = snapshot.decode().split('\t',3)
-
-            # if the rollup isn't recursive, skip any snapshots from child datasets
-            if not args.recursive and not name.startswith(dataset+"@"):
-                continue
-
-            try:
-                dataset,snapshot = name.split('@',2)
-            except ValueError:
-                continue
-
-            snapshots[dataset][snapshot][property] = value
-
-    # Ignore non-snapshots and not-auto-snapshots
-    # Remove already destroyed snapshots
-    for dataset in list(snapshots.keys()):
-        latest = None
-        latestNEW = None
-        for snapshot in sorted(snapshots[dataset], key=lambda snapshot: snapshots[dataset][snapshot]['creation'], reverse=True):
-            if not any(map(snapshot.startswith, args.prefix)) \
-                or snapshots[dataset][snapshot]['type'] != "snapshot":
-                del snapshots[dataset][snapshot]
-                continue
-            if not latest:
-                latest = snapshot
-                del snapshots[dataset][snapshot]
-                continue
-            if not latestNEW and snapshots[dataset][snapshot]['freenas:state'] == 'NEW':
-                latestNEW = snapshot
-                del snapshots[dataset][snapshot]
-                continue
-            if snapshots[dataset][snapshot]['freenas:state'] == 'LATEST':
-                del snapshots[dataset][snapshot]
-                continue
-            if snapshots[dataset][snapshot]['used'] != '0' \
-                or snapshot in list(deleted[dataset].keys()):
-                del snapshots[dataset][snapshot]
-                continue
-
-        # Stop if no snapshots are in the list
-        if not snapshots[dataset]:
-            del snapshots[dataset]
-            continue
-
-        # destroy the most recent empty snapshot
-        snapshot = max(snapshots[dataset], key=lambda snapshot: snapshots[dataset][snapshot]['creation'])
+        if failed:
+            sys.exit(1)
+        return
+
+    try:
+        clear(args, policy)
+    except zfs.ZfsError as e:
+        print(e)
+        sys.exit(1)
+
+def clear(args, policy, out=sys.stdout):
+    deleted = {}
+
+    snapshot_was_deleted = not (args.incremental or args.predict)
+    # target -> exit code of the destroys that failed
+    failed = {}
+
+    if args.predict:
+        clear_predicted(args, policy, deleted, failed)
+    elif args.incremental:
+        clear_incremental(args, policy, deleted)
+
+    while snapshot_was_deleted:
+        snapshot_was_deleted = False
+
+        # Get properties of all snapshots of the selected datasets
+        for inventory in stats.source(source(args))(args.datasets, args.recursive):
+            stats.inventory(inventory)
+            # destroy the most recent empty snapshot of each dataset
+            with stats.phase('plan'):
+                actions = plan_empty(inventory, policy, deleted)
+            for action in actions:
+                if not args.test:
+                    # destroy the snapshot
+                    with stats.phase('destroy'):
+                        zfs.destroy(action.dataset+"@"+action.snapshot)
+
+                deleted[(action.dataset, action.snapshot)] = action.used
+                snapshot_was_deleted = True
+
+    for (dataset, snapshot), used in deleted.items():
+        stats.dataset(dataset, pruned=1, reclaimed=used)
+
+    for dataset in sorted(set(dataset for dataset,snapshot in deleted)):
+        print(dataset, file=out)
+        for snapshot in sorted(snapshot for name,snapshot in deleted if name == dataset):
+            print("\t", snapshot, deleted[(dataset, snapshot)], file=out)
+    for target in failed:
+        print("cannot destroy", target, file=out)
+    if failed:
+        raise zfs.ZfsError('destroy', max(failed.values()))
+
+def clear_predicted(args, policy, deleted, failed):
+    usage = dataset_properties(args.datasets, ['usedbysnapshots'], args.recursive)
+    usedbysnapshots = dict((dataset, usage[dataset].get('usedbysnapshots')) for dataset in usage)
+
+    for inventory in stats.source(source(args))(args.datasets, args.recursive, properties=properties + ('written',)):
+        stats.inventory(inventory)
+        with stats.phase('plan'):
+            actions = plan_empty_all(inventory, policy, zfs.reclaim, usedbysnapshots)
         if not args.test:
-            # destroy the snapshot
-            subprocess.call(["zfs", "destroy", dataset+"@"+snapshot])
-
-        deleted[dataset][snapshot] = snapshots[dataset][snapshot]
-        snapshot_was_deleted = True
-
-for dataset in sorted(deleted.keys()):
-    if not deleted[dataset]:
-        continue
-    print(dataset)
-    for snapshot in sorted(deleted[dataset].keys()):
-        print("\t", snapshot, deleted[dataset][snapshot]['used'])
+            with stats.phase('destroy'):
+                for target in batch_targets(destroy_targets(actions)):
+                    # destroy the snapshots; zfs destroys all of a batch or none of it
+                    returncode = zfs.destroy(target)
+                    if returncode:
+                        failed[target] = returncode
+
+        kept = covered(actions, failed)
+        for action in actions:
+            if action.prune and (action.dataset, action.snapshot) not in kept:
+                deleted[(action.dataset, action.snapshot)] = action.used
+
+def covered(actions, targets):
+    # the (dataset, snapshot) of 'actions' named by destroy 'targets', ranges included
+    ends = {}
+    for target in targets:
+        dataset, snapshots = target.split('@', 1)
+        for part in snapshots.split(','):
+            first, _, last = part.partition('%')
+            ends[(dataset, first)] = (dataset, last or first)
+    names = set()
+    until = None
+    for action in actions:
+        name = (action.dataset, action.snapshot)
+        if until is None:
+            until = ends.get(name)
+        if until is not None:
+            names.add(name)
+            if name == until:
+                until = None
+    return names
+
+def clear_incremental(args, policy, deleted):
+    # Destroying a snapshot can only change the 'used' value of the snapshots
+    # immediately before and after it, so keep every dataset's inventory and
+    # re-read just those two. Once a dataset has no empty candidates left it
+    # never gains one, and is dropped from later passes.
+    active = list(stats.source(source(args))(args.datasets, args.recursive))
+    for inventory in active:
+        stats.inventory(inventory)
+
+    while active:
+        remaining = list()
+        for inventory in active:
+            with stats.phase('plan'):
+                actions = plan_empty(inventory, policy, deleted)
+            for action in actions:
+                neighbours = inventory.neighbours(action.dataset, action.snapshot)
+                if not args.test:
+                    # destroy the snapshot
+                    with stats.phase('destroy'):
+                        zfs.destroy(action.dataset+"@"+action.snapshot)
+
+                deleted[(action.dataset, action.snapshot)] = action.used
+                inventory.discard(action.dataset, action.snapshot)
+                if not args.test:
+                    inventory.refresh(action.dataset, neighbours)
+                remaining.append(inventory)
+        active = remaining
+
+if __name__ == '__main__':
+    main()
@@ -12,251 +12,309 @@
 # Keep hourly snapshots for the last day, daily for the last week, and weekly thereafter.
 
 # TODO:
-#   rollup based on local time, not UTC
-#     requires pytz, or manually determining and converting time offsets
 #   improve documentation
 
 # TEST:
 
-import datetime
-import calendar
-import time
-import subprocess
 import argparse
+import io
+import itertools
+import signal
 import sys
-from collections import defaultdict
-
-intervals = {}
-intervals['hourly']  = { 'max':24, 'abbreviation':'h', 'reference':'%Y-%m-%d %H' }
-intervals['daily']   = { 'max': 7, 'abbreviation':'d', 'reference':'%Y-%m-%d' }
-intervals['weekly']  = { 'max': 0, 'abbreviation':'w', 'reference':'%Y-%W' }
-intervals['monthly'] = { 'max':12, 'abbreviation':'m', 'reference':'%Y-%m' }
-intervals['yearly']  = { 'max':10, 'abbreviation':'y', 'reference':'%Y' }
-
-modifiers = {
-    'M' : 1,
-    'H' : 60,
-    'h' : 60,
-    'd' : 60*24,
-    'w' : 60*24*7,
-    'm' : 60*24*28,
-    'y' : 60*24*365,
-}
-
-used_intervals = {
-    'hourly': intervals['hourly'],
-    'daily' : intervals['daily'],
-    'weekly': intervals['weekly']
-}
-
-parser = argparse.ArgumentParser(description='Prune excess snapshots, keeping hourly for the last day, daily for the last week, and weekly thereafter.')
-parser.add_argument('datasets', nargs='+', help='The root dataset(s) from which to prune snapshots')
-parser.add_argument('-t', '--test', action="store_true", default=False, help='Only display the snapshots that would be deleted, without actually deleting them')
-parser.add_argument('-v', '--verbose', action="store_true", default=False, help='Display verbose information about which snapshots are kept, pruned, and why')
-parser.add_argument('-r', '--recursive', action="store_true", default=False, help='Recursively prune snapshots from nested datasets')
-parser.add_argument('--prefix', '-p', action='append', help='list of snapshot name prefixes that will be considered')
-parser.add_argument('-c', '--clear', action="store_true", default=False, help='remove all snapshots')
-parser.add_argument('-i', '--intervals',
-    help="Modify and define intervals with which to keep and prune snapshots. Either name existing intervals ("+
-    ", ".join(sorted(intervals, key=lambda interval: modifiers[intervals[interval]['abbreviation']]))+"), "+
-    "modify the number of those to store (hourly:12), or define new intervals according to interval:count (2h:12). "+
-    "Multiple intervals may be specified if comma seperated (hourly,daily:30,2h:12). Available modifier abbreviations are: "+
-    ", ".join(sorted(modifiers, key=modifiers.get))
-)
-
-args = parser.parse_args()
-
-if not args.prefix:
-    args.prefix = ['auto']
-
-args.prefix = [prefix+"-" for prefix in set(args.prefix)]
-
-if args.test:
-    args.verbose = True
-
-if args.intervals:
-    used_intervals = {}
-
-    for interval in args.intervals.split(','):
-        if interval.count(':') == 1:
-            period,count = interval.split(':')
-
-            try:
-                int(count)
-            except ValueError:
-                print("invalid count: "+count)
-                sys.exit(1)
-
-            if period in intervals:
-                used_intervals[period] = intervals[period]
-                used_intervals[period]['max'] = count
+import time
 
-            else:
-                try:
-                    if period[-1] in modifiers:
-                        used_intervals[interval] = { 'max' : count, 'interval' : int(period[:-1]) * modifiers[period[-1]] }
-                    else:
-                        used_intervals[interval] = { 'max' : count, 'interval' : int(period) }
+from zfsrollup import buckets, calendars, fleet, policies, stats, zfs
+from zfsrollup.cache import source
+from zfsrollup.daemon import Daemon
+from zfsrollup.parallel import each_dataset
+from zfsrollup.inventory import Inventory, dataset_properties
+from zfsrollup.retention import Policy, plan, plan_reclaim, destroy_targets, batch_targets
+from zfsrollup.scheduler import Scheduler, deadline
+
+def main():
+    parser = argparse.ArgumentParser(description='Prune excess snapshots, keeping hourly for the last day, daily for the last week, and weekly thereafter.')
+    parser.add_argument('datasets', nargs='+', help='The root dataset(s) from which to prune snapshots')
+    parser.add_argument('-t', '--test', action="store_true", default=False, help='Only display the snapshots that would be deleted, without actually deleting them')
+    parser.add_argument('-v', '--verbose', action="store_true", default=False, help='Display verbose information about which snapshots are kept, pruned, and why')
+    parser.add_argument('-r', '--recursive', action="store_true", default=False, help='Recursively prune snapshots from nested datasets')
+    parser.add_argument('--prefix', '-p', action='append', help='list of snapshot name prefixes that will be considered')
+    parser.add_argument('-c', '--clear', action="store_true", default=False, help='remove all snapshots')
+    parser.add_argument('-i', '--intervals', help=buckets.describe())
+    parser.add_argument('--timezone', metavar='ZONE', default=None, help="time zone of the hourly, daily, weekly, monthly and yearly buckets: a zoneinfo name (Europe/Amsterdam), 'local' for the system zone, or UTC (the default)")
+    parser.add_argument('--policy', metavar='FILE', default=None, help='take the intervals, prefixes and clear setting of each dataset from a JSON, TOML or YAML policy file instead of -i, --prefix and -c')
+    parser.add_argument('-b', '--batch', action="store_true", default=False, help='destroy all pruned snapshots of a dataset with as few zfs commands as possible')
+    parser.add_argument('--bookmark', action="store_true", default=False, help='bookmark each pruned snapshot (dataset#snapshot) before destroying it, so targets that have it can still be sent increments from the bookmark')
+    parser.add_argument('--cache', action="store_true", default=False, help='keep a snapshot inventory cache and only ask zfs about snapshots that changed since the last run')
+    parser.add_argument('--cache-dir', default=None, help='where to keep the inventory cache (default: ~/.cache/zfs-rollup)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='number of datasets to inventory and prune concurrently')
+    parser.add_argument('--pool-jobs', type=int, default=None, help='with --jobs, the most datasets of any one pool to work on at once')
+    parser.add_argument('--reclaim', type=size, default=None, metavar='SIZE', help='instead of pruning by interval, free SIZE bytes (K, M, G, T suffixes) from each root dataset with as few, and as old, snapshots as possible')
+    parser.add_argument('--keep-free', type=percentage, default=None, metavar='PCT', help='like --reclaim, freeing enough to leave PCT%% of each root dataset available')
+    parser.add_argument('--pool-destroys', type=int, default=None, metavar='N', help='queue destroys and run at most N at a time per pool (default: 1 when any throttling option is given)')
+    parser.add_argument('--max-freeing', type=size, default=None, metavar='SIZE', help="pause destroys while a pool's freeing backlog is above SIZE")
+    parser.add_argument('--max-latency', type=float, default=None, metavar='MS', help='pause destroys while the I/O wait reported by zpool iostat -l is above MS milliseconds')
+    parser.add_argument('--deadline', default=None, metavar='TIME', help='start no destroys after TIME: a duration (90m, 2h) or a local clock time (05:30)')
+    parser.add_argument('--daemon', action="store_true", default=False, help='keep running, pruning incrementally as new snapshots appear')
+    parser.add_argument('--interval', type=float, default=60, help='with --daemon, seconds between polls for new snapshots (default: 60)')
+    parser.add_argument('--fleet', action="store_true", default=False, help='datasets are HOST:DATASET; list over ssh, plan here and push batched destroys back, all hosts at once (--jobs and --pool-jobs apply per host)')
+    parser.add_argument('--ssh-sessions', type=int, default=8, help='with --fleet, the most zfs commands run at once over the ssh connection to a host (default: 8)')
+    parser.add_argument('--backend', choices=zfs.backends, default='cli', help='how to talk to zfs: the zfs command (cli), libzfs_core through pyzfs (lzc), or an in-memory pool (fake)')
+    parser.add_argument('--fake-pool', default=None, help='with --backend fake, a JSON file to load the pool from and save it back to (with --fleet, a directory of HOST.json files)')
+    parser.add_argument('--stats', metavar='FILE', default=None, help='write run statistics (phase times, zfs calls, per-dataset counts) to FILE')
+    parser.add_argument('--stats-format', choices=('json', 'prometheus'), default=None, help='format of the --stats file (default: prometheus for *.prom files, json otherwise)')
+    parser.add_argument('--profile', metavar='FILE', default=None, help='save a cProfile profile of the run to FILE, for pstats')
+
+    args = parser.parse_args()
+
+    stats.configure(args, 'rollup')
+
+    try:
+        if not args.fleet:
+            zfs.configure(args)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
 
-                except ValueError:
-                    print("invalid period: "+period)
-                    sys.exit(1)
+    if args.test:
+        args.verbose = True
 
-        elif interval.count(':') == 0 and interval in intervals:
-            used_intervals[interval] = intervals[interval]
+    try:
+        used_intervals = buckets.parse_intervals(args.intervals)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
 
-        else:
-            print("invalid interval: "+interval)
+    if args.policy:
+        if args.intervals or args.prefix or args.clear:
+            print("--policy cannot be combined with -i, --prefix or -c")
+            sys.exit(1)
+        try:
+            policy = policies.load(args.policy, args.timezone)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+    else:
+        try:
+            policy = Policy(used_intervals, args.prefix, args.clear, zone=calendars.zone(args.timezone))
+        except ValueError as e:
+            print(e)
             sys.exit(1)
 
-for interval in used_intervals:
-    if 'abbreviation' not in used_intervals[interval]:
-        used_intervals[interval]['abbreviation'] = interval
-
-snapshots = defaultdict(lambda : defaultdict(lambda : defaultdict(int)))
-
-for dataset in args.datasets:
-    subp = subprocess.Popen(["zfs", "get", "-Hrpo", "name,property,value", "creation,type,used,freenas:state", dataset], stdout=subprocess.PIPE)
-    zfs_snapshots = subp.communicate()[0]
-    if subp.returncode:
-        print("zfs get failed with RC=%s" % subp.returncode)
+    try:
+        scheduler = throttle(args)
+    except ValueError as e:
+        print(e)
         sys.exit(1)
+    destroy = scheduler.submit if scheduler is not None else zfs.destroy
 
-    for snapshot in zfs_snapshots.splitlines():
-        name,property,value = snapshot.decode().split('\t',3)
-
-        # if the rollup isn't recursive, skip any snapshots from child datasets
-        if not args.recursive and not name.startswith(dataset+"@"):
-            continue
-
+    if args.fleet:
+        if args.daemon or args.reclaim is not None or args.keep_free is not None:
+            print("--fleet cannot be combined with --daemon, --reclaim or --keep-free")
+            sys.exit(1)
         try:
-            dataset,snapshot = name.split('@',2)
-        except ValueError:
-            continue
-
-        # enforce that this is a snapshot starting with one of the requested prefixes
-        if not any(map(snapshot.startswith, args.prefix)):
-            if property == 'creation':
-                print("will ignore:\t", dataset+"@"+snapshot)
-
-        snapshots[dataset][snapshot][property] = value
-
-for dataset in list(snapshots.keys()):
-    latestNEW = None
-    latest = None
-    for snapshot in sorted(snapshots[dataset], key=lambda snapshot: snapshots[dataset][snapshot]['creation'], reverse=True):
-        if not latest:
-            latest = snapshot
-            snapshots[dataset][snapshot]['keep'] = 'RECENT'
-            continue
-        if not any(map(snapshot.startswith, args.prefix)) \
-            or snapshots[dataset][snapshot]['type'] != "snapshot":
-            snapshots[dataset][snapshot]['keep'] = '!PREFIX'
-            continue
-        if not latestNEW and snapshots[dataset][snapshot]['freenas:state'] == 'NEW':
-            latestNEW = snapshot
-            snapshots[dataset][snapshot]['keep'] = 'NEW'
-            continue
-        if snapshots[dataset][snapshot]['freenas:state'] == 'LATEST':
-            snapshots[dataset][snapshot]['keep'] = 'LATEST'
-            continue
-
-    if not len(list(snapshots[dataset].keys())):
-        del snapshots[dataset]
-
-for dataset in sorted(snapshots.keys()):
-    print(dataset)
-
-    sorted_snapshots = sorted(snapshots[dataset], key=lambda snapshot: snapshots[dataset][snapshot]['creation'])
-    most_recent = sorted_snapshots[-1]
+            prune_fleet(policy, args)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        return
 
-    rollup_intervals = defaultdict(lambda : defaultdict(int))
+    if args.daemon:
+        if args.reclaim is not None or args.keep_free is not None:
+            print("--daemon cannot be combined with --reclaim or --keep-free")
+            sys.exit(1)
+        if scheduler is not None:
+            # the daemon destroys directly, as soon as snapshots fall out
+            print("--daemon cannot be combined with --pool-destroys, --max-freeing, --max-latency or --deadline")
+            sys.exit(1)
+        follow(policy, args)
+        return
 
-    for snapshot in sorted_snapshots:
-        prune = True
+    if args.reclaim is not None or args.keep_free is not None:
+        try:
+            reclaim_space(policy, args, destroy)
+            drain(scheduler)
+        except zfs.ZfsError as e:
+            print(e)
+            sys.exit(1)
+        return
+
+    try:
+        for output in each_dataset(args.datasets, lambda inventory, out: rollup(inventory, policy, args, out, destroy=destroy),
+                jobs=args.jobs, per_pool=args.pool_jobs, recursive=args.recursive, source=stats.source(source(args))):
+            sys.stdout.write(output)
+            sys.stdout.flush()
+        drain(scheduler)
+    except zfs.ZfsError as e:
+        print(e)
+        sys.exit(1)
 
-        if args.clear:
-            continue
+def throttle(args, log=print):
+    # a Scheduler if any throttling option was given; ValueError for a bad deadline
+    if not (args.pool_destroys or args.max_freeing is not None or args.max_latency is not None or args.deadline):
+        return None
+    return Scheduler(args.pool_destroys or 1, args.max_freeing,
+        args.max_latency / 1000 if args.max_latency is not None else None,
+        deadline(args.deadline) if args.deadline else None, log=log)
+
+def drain(scheduler, out=sys.stdout):
+    # run the destroys queued while planning
+    if scheduler is None or not len(scheduler):
+        return
+    queued = len(scheduler)
+    with stats.phase('destroy'):
+        destroyed, failed, skipped = scheduler.run()
+    print("destroyed %d of %d queued targets" % (len(destroyed), queued), end='', file=out)
+    if failed:
+        print(", %d failed" % len(failed), end='', file=out)
+    if skipped:
+        print(", %d skipped at the deadline" % len(skipped), end='', file=out)
+    print(file=out)
+
+def prune_fleet(policy, args):
+    # every host at once; each one's output is printed when it is done
+    args.batch = True
+    def work(args, out):
+        scheduler = throttle(args, lambda message: print(message, file=out))
+        destroy = scheduler.submit if scheduler is not None else zfs.destroy
+        for output in each_dataset(args.datasets, lambda inventory, out: rollup(inventory, policy, args, out, destroy=destroy),
+                jobs=args.jobs, per_pool=args.pool_jobs, recursive=args.recursive, source=stats.source(source(args))):
+            out.write(output)
+        drain(scheduler, out)
+
+    failed = 0
+    for host, output, error in fleet.each_host(args, work):
+        sys.stdout.write(fleet.prefixed(host, output))
+        if error:
+            print("%s: %s" % (host, error))
+            failed += 1
+        sys.stdout.flush()
+    if failed:
+        sys.exit(1)
 
-        epoch = snapshots[dataset][snapshot]['creation']
-
-        for interval in list(used_intervals.keys()):
-            if 'reference' in used_intervals[interval]:
-                reference = time.strftime(used_intervals[interval]['reference'], time.gmtime(float(epoch)))
-
-                if reference not in rollup_intervals[interval]:
-                    if int(used_intervals[interval]['max']) != 0 and len(rollup_intervals[interval]) >= int(used_intervals[interval]['max']):
-                        rollup_intervals[interval].pop(sorted(rollup_intervals[interval].keys())[0])
-                    rollup_intervals[interval][reference] = epoch
-
-            elif 'interval' in used_intervals[interval]:
-                if int(used_intervals[interval]['max']) != 0 and len(rollup_intervals[interval]) >= int(used_intervals[interval]['max']):
-                    rollup_intervals[interval].pop(sorted(rollup_intervals[interval].keys())[0])
-
-                if (not rollup_intervals[interval]) or int(sorted(rollup_intervals[interval].keys())[-1]) + (used_intervals[interval]['interval']*60*.9) < int(epoch):
-                    rollup_intervals[interval][epoch] = epoch
-
-    ranges = list()
-    ranges.append(list())
-    for snapshot in sorted_snapshots:
-        prune = True
-
-        epoch = snapshots[dataset][snapshot]['creation']
-
-        if 'keep' in snapshots[dataset][snapshot]:
-            prune = False
-            ranges.append(list())
-
-
-        for interval in list(used_intervals.keys()):
-            if 'reference' in used_intervals[interval]:
-                reference = time.strftime(used_intervals[interval]['reference'], time.gmtime(float(epoch)))
-                if reference in rollup_intervals[interval] and rollup_intervals[interval][reference] == epoch:
-                    prune = False
-                    ranges.append(list())
-
-            elif 'interval' in used_intervals[interval]:
-                if epoch in rollup_intervals[interval]:
-                    prune = False
-                    ranges.append(list())
-
-        if prune or args.verbose:
-            print("\t","pruning\t" if prune else " \t", "@"+snapshot, end=' ')
-            if args.verbose:
-                for interval in list(used_intervals.keys()):
-                    if 'reference' in used_intervals[interval]:
-                        reference = time.strftime(used_intervals[interval]['reference'], time.gmtime(float(epoch)))
-                        if reference in rollup_intervals[interval] and rollup_intervals[interval][reference] == epoch:
-                            print(used_intervals[interval]['abbreviation'], end=' ')
-                        else:
-                            print('-', end=' ')
-                    if 'interval' in used_intervals[interval]:
-                        if epoch in rollup_intervals[interval]:
-                            print(used_intervals[interval]['abbreviation'], end=' ')
-                        else:
-                            print('-', end=' ')
-                if 'keep' in snapshots[dataset][snapshot]:
-                    print(snapshots[dataset][snapshot]['keep'][0], end=' ')
+def size(value):
+    # '500G' -> bytes, powers of 1024 as zfs uses
+    units = 'KMGTPE'
+    number = value.upper().rstrip('B')
+    scale = 1
+    if number and number[-1] in units:
+        scale = 1024 ** (units.index(number[-1]) + 1)
+        number = number[:-1]
+    try:
+        return int(float(number) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: %s" % value)
+
+def percentage(value):
+    try:
+        number = float(value.rstrip('%'))
+    except ValueError:
+        number = -1
+    if not 0 <= number <= 100:
+        raise argparse.ArgumentTypeError("invalid percentage: %s" % value)
+    return number
+
+def reclaim_space(policy, args, destroy=zfs.destroy):
+    # plan every dataset below a root together, oldest snapshots first
+    for root in args.datasets:
+        goal = args.reclaim or 0
+        if args.keep_free is not None:
+            space = dataset_properties([root], ('used', 'available')).get(root, {})
+            if not space.get('used', '').isdigit() or not space.get('available', '').isdigit():
+                print("cannot read the used and available space of %s" % root)
+                sys.exit(1)
+            used, available = int(space['used']), int(space['available'])
+            goal = max(goal, int((used + available) * args.keep_free / 100) - available)
+
+        inventory = Inventory()
+        for single in stats.source(source(args))([root], args.recursive):
+            for dataset in single.datasets:
+                inventory.add(dataset, single.snapshots(dataset))
+
+        estimate = []
+        def planner(inventory, policy):
+            actions, freed = plan_reclaim(inventory, policy, goal, zfs.reclaim)
+            estimate.append(freed)
+            return actions
+        out = io.StringIO()
+        rollup(inventory, policy, args, out, planner, destroy)
+        print("%s: reclaiming %d of %d bytes" % (root, estimate[0] if estimate else 0, goal))
+        sys.stdout.write(out.getvalue())
+        sys.stdout.flush()
+
+def follow(policy, args):
+    daemon = Daemon(args.datasets, policy, args, lambda inventory, out: rollup(inventory, policy, args, out))
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while True:
+            started = time.time()
+            try:
+                daemon.poll()
+            except zfs.ZfsError as e:
+                # keep going; the next poll starts from what is known
+                print(e)
+            sys.stdout.flush()
+            if args.stats:
+                stats.flush(args)
+            time.sleep(max(0, args.interval - (time.time() - started)))
+    except KeyboardInterrupt:
+        pass
+
+def rollup(inventory, policy, args, out=sys.stdout, planner=plan, destroy=zfs.destroy):
+    for dataset in inventory.datasets:
+        applied = policy.resolve(dataset)
+        for snapshot in inventory.snapshots(dataset).names:
+            # enforce that this is a snapshot starting with one of the requested prefixes
+            if not applied.matches(snapshot):
+                print("will ignore:\t", dataset+"@"+snapshot, file=out)
+
+    with stats.phase('plan'):
+        planned = planner(inventory, policy)
+    stats.actions(planned)
+
+    for dataset, actions in itertools.groupby(planned, key=lambda action: action.dataset):
+        actions = list(actions)
+        print(dataset, file=out)
+
+        for action in actions:
+            if action.prune or args.verbose:
+                print("\t","pruning\t" if action.prune else " \t", "@"+action.snapshot, end=' ', file=out)
+                if args.verbose:
+                    intervals = policy.resolve(dataset).intervals_for(action.snapshot)
+                    for interval in intervals:
+                        print(intervals[interval]['abbreviation'] if interval in action.held else '-', end=' ', file=out)
+                    print(action.keep[0] if action.keep else '-', end=' ', file=out)
+                    print(action.used, file=out)
                 else:
-                    print('-', end=' ')
-                print(snapshots[dataset][snapshot]['used'])
-            else:
-                print()
+                    print(file=out)
 
-        if prune:
-            ranges[-1].append(snapshot)
-
-    for range in ranges:
-        if not range:
-            continue
-        to_delete = dataset+'@'+range[0]
-        if len(range) > 1:
-            to_delete += '%' + range[-1]
-        to_delete = to_delete.replace(' ', '')
-        if not to_delete:
+        targets = destroy_targets(actions)
+        if args.bookmark and targets and not bookmark(inventory.snapshots(dataset), actions, args, out):
             continue
-        if args.verbose:
-            print('zfs destroy ' + to_delete)
-        if not args.test:
-            # destroy the snapshot
-            subprocess.call(['zfs', 'destroy', to_delete])
+        if args.batch and targets:
+            batches = batch_targets(targets)
+            print("\tbatched %d destroys into %d, saving %d zfs processes and transaction groups" % (len(targets), len(batches), len(targets) - len(batches)), file=out)
+            targets = batches
+
+        with stats.phase('destroy'):
+            for to_delete in targets:
+                if args.verbose:
+                    print('zfs destroy ' + to_delete, file=out)
+                if not args.test:
+                    # destroy the snapshot
+                    destroy(to_delete)
+
+def bookmark(snapshots, actions, args, out):
+    # bookmark the pruned snapshots that have no bookmark yet; False if one failed
+    guids = dict(zip(snapshots.names, snapshots.guids))
+    pairs = [(action.dataset+'@'+action.snapshot, action.dataset+'#'+action.snapshot) for action in actions
+        if action.prune and guids.get(action.snapshot) not in snapshots.bookmarks]
+    if args.verbose:
+        for snapshot, name in pairs:
+            print('zfs bookmark %s %s' % (snapshot, name), file=out)
+    if pairs and not args.test and zfs.bookmarks(pairs):
+        print("\tcannot bookmark the pruned snapshots of %s, not destroying any" % pairs[0][0].split('@', 1)[0], file=out)
+        return False
+    return True
+
+if __name__ == '__main__':
+    main()
@@ -10,110 +10,128 @@
 # destroyed. This script iteratively destroys the oldest empty snapshot. It
 # does not remove the latest snapshot of each dataset or manual snapshots
 
-import subprocess
 import argparse
-from collections import defaultdict
-
-parser = argparse.ArgumentParser(description='Removes empty auto snapshots.')
-parser.add_argument('datasets', nargs='+', help='the root dataset(s) from which to remove snapshots')
-parser.add_argument('--test', '-t', action="store_true", default=False, help='only display the snapshots that would be deleted, without actually deleting them. Note that due to dependencies between snapshots, this may not match what would really happen.')
-parser.add_argument('--verbose', '-v', action="store_true", default=False, help='be verbose about what snapshots will be deleted and how much space will be freed.')
-parser.add_argument('--recursive', '-r', action="store_true", default=False, help='recursively removes snapshots from nested datasets')
-parser.add_argument('--prefix', '-p', action='append', help='list of snapshot name prefixes that will be considered')
-
-args = parser.parse_args()
-
-if not args.prefix:
-    args.prefix = ['auto']
-
-args.prefix = [prefix+"-" for prefix in set(args.prefix)]
-
-deleted = defaultdict(lambda : defaultdict(lambda : defaultdict(int)))
-
-snapshots = defaultdict(lambda : defaultdict(lambda : defaultdict(int)))
-
-# Get properties of all snapshots of the selected datasets
-for dataset in args.datasets:
-    subp = subprocess.Popen(["zfs", "get", "-t", "snapshot", "-Hrpo", "name,property,value", "type,creation,used,freenas:state", dataset], stdout=subprocess.PIPE)
-    zfs_snapshots = subp.communicate()[0]
-    if subp.returncode:
-        print("zfs get failed with RC=%s" % subp.returncode)
+import json
+import sys
+
+from zfsrollup import stats, zfs
+from zfsrollup.cache import source
+from zfsrollup.parallel import each_dataset
+from zfsrollup.retention import Policy, plan_strip, destroy_targets, batch_targets
+
+def main():
+    parser = argparse.ArgumentParser(description='Removes empty auto snapshots.')
+    parser.add_argument('datasets', nargs='+', help='the root dataset(s) from which to remove snapshots')
+    parser.add_argument('--test', '-t', action="store_true", default=False, help='only display the snapshots that would be deleted, without actually deleting them. Note that due to dependencies between snapshots, this may not match what would really happen.')
+    parser.add_argument('--verbose', '-v', action="store_true", default=False, help='be verbose about what snapshots will be deleted and how much space will be freed.')
+    parser.add_argument('--recursive', '-r', action="store_true", default=False, help='recursively removes snapshots from nested datasets')
+    parser.add_argument('--prefix', '-p', action='append', help='list of snapshot name prefixes that will be considered')
+    parser.add_argument('--cache', action="store_true", default=False, help='keep a snapshot inventory cache and only ask zfs about snapshots that changed since the last run')
+    parser.add_argument('--cache-dir', default=None, help='where to keep the inventory cache (default: ~/.cache/zfs-rollup)')
+    parser.add_argument('--batch', '-b', action="store_true", default=False, help='combine all ranges of a dataset into as few destroy commands as possible')
+    parser.add_argument('--execute', '-x', action="store_true", default=False, help='destroy the snapshots instead of printing zfs destroy commands: ranges are batched per dataset, the space each batch frees is read from zfs destroy -nvp, and a JSON summary is printed (with --test, nothing is destroyed)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='with --execute, number of datasets to inventory and strip concurrently')
+    parser.add_argument('--pool-jobs', type=int, default=None, help='with --jobs, the most datasets of any one pool to work on at once')
+    parser.add_argument('--backend', choices=zfs.backends, default='cli', help='how to talk to zfs: the zfs command (cli), libzfs_core through pyzfs (lzc), or an in-memory pool (fake)')
+    parser.add_argument('--fake-pool', default=None, help='with --backend fake, a JSON file to load the pool from and save it back to')
+    parser.add_argument('--stats', metavar='FILE', default=None, help='write run statistics (phase times, zfs calls, per-dataset counts) to FILE')
+    parser.add_argument('--stats-format', choices=('json', 'prometheus'), default=None, help='format of the --stats file (default: prometheus for *.prom files, json otherwise)')
+    parser.add_argument('--profile', metavar='FILE', default=None, help='save a cProfile profile of the run to FILE, for pstats')
+
+    args = parser.parse_args()
+
+    stats.configure(args, 'snap-strip')
+
+    try:
+        zfs.configure(args)
+    except ValueError as e:
+        print(e)
         sys.exit(1)
 
-    for snapshot in zfs_snapshots.splitlines():
-        name,property,value = snapshot.decode().split('\t',3)
-
-        # if the rollup isn't recursive, skip any snapshots from child datasets
-        if not args.recursive and not name.startswith(dataset+"@"):
-            continue
+    policy = Policy(prefixes=args.prefix)
 
+    if args.execute:
         try:
-            dataset,snapshot = name.split('@',2)
-        except ValueError:
-            continue
-
-        snapshots[dataset][snapshot][property] = value
-
-# Ignore non-snapshots and snapshots that don't include the requested prefix(es)
-# Remove already destroyed snapshots
-for dataset in list(snapshots.keys()):
-    latest = None
-    latestNEW = None
-    for snapshot in sorted(snapshots[dataset], key=lambda snapshot: snapshots[dataset][snapshot]['creation'], reverse=True):
-        if "snapshot" != snapshots[dataset][snapshot]['type']:
-            del snapshots[dataset][snapshot]
-            continue
-        if not latest:
-            latest = snapshot
-            del snapshots[dataset][snapshot]
-            continue
-        if not latestNEW and snapshots[dataset][snapshot]['freenas:state'] == 'NEW':
-            latestNEW = snapshot
-            del snapshots[dataset][snapshot]
-            continue
-        if snapshots[dataset][snapshot]['freenas:state'] == 'LATEST':
-            del snapshots[dataset][snapshot]
-            continue
-
-    # Stop if no snapshots are in the list
-    if not snapshots[dataset]:
-        del snapshots[dataset]
-        continue
-
-def end_range(r_start, r_end):
-    if not r_start:
-        return None
-    if r_start == r_end or not r_end:
-        return r_start
-    return r_start + "%" + r_end
-
-delete_targets = list()
-
-# now build lists of snapshots that match the requested prefixes
-for dataset in sorted(snapshots.keys()):
-    range_start = None
-    range_end = None
-    for snapshot in sorted(snapshots[dataset], key=lambda snapshot: snapshots[dataset][snapshot]['creation'], reverse=False):
-        if not any(map(snapshot.startswith, args.prefix)):
-            range = end_range(range_start, range_end)
-            if range:
-                delete_targets.append(dataset + "@" + range)
-            range_start = None
-            range_end = None
-            continue
-        if not range_start:
-            range_start = snapshot
-        range_end = snapshot
-    range = end_range(range_start, range_end)
-    if range:
-        delete_targets.append(dataset + "@" + range)
-    range_start = None
-    range_end = None
-
-command = "zfs destroy "
-if args.test:
-    command += "-n "
-if args.verbose:
-    command += "-v "
-for target in delete_targets:
-    print(command + target)
+            failed = execute(policy, args)
+        except zfs.ZfsError as e:
+            print(e)
+            sys.exit(1)
+        if failed:
+            sys.exit(1)
+        return
+
+    command = "zfs destroy "
+    if args.test:
+        command += "-n "
+    if args.verbose:
+        command += "-v "
+
+    ranges = 0
+    commands = 0
+
+    try:
+        # Get properties of all snapshots of the selected datasets
+        for inventory in stats.source(source(args))(args.datasets, args.recursive, types='snapshot,bookmark'):
+            with stats.phase('plan'):
+                actions = plan_strip(inventory, policy)
+                targets = destroy_targets(actions)
+            stats.actions(actions)
+            ranges += len(targets)
+            if args.batch:
+                targets = batch_targets(targets)
+            commands += len(targets)
+            for target in targets:
+                print(command + target)
+    except zfs.ZfsError as e:
+        print(e)
+        sys.exit(1)
+
+    if args.batch and ranges:
+        # keep stdout pipeable to a shell
+        print("batched %d ranges into %d destroy commands, saving %d" % (ranges, commands, ranges - commands), file=sys.stderr)
+
+def execute(policy, args):
+    # one JSON line per dataset as it is done, then the totals; returns the
+    # number of failed destroys
+    totals = dict(datasets=0, snapshots=0, ranges=0, commands=0, reclaimed=0, failed=0, test=args.test)
+    for output in each_dataset(args.datasets, lambda inventory, out: strip(inventory, policy, args, out),
+            jobs=args.jobs, per_pool=args.pool_jobs, recursive=args.recursive, types='snapshot,bookmark', source=stats.source(source(args))):
+        for line in output.splitlines():
+            entry = json.loads(line)
+            totals['datasets'] += 1
+            for key in ('snapshots', 'ranges', 'commands', 'reclaimed'):
+                totals[key] += entry[key]
+            totals['failed'] += len(entry['failed'])
+        sys.stdout.write(output)
+        sys.stdout.flush()
+    print(json.dumps(totals))
+    return totals['failed']
+
+def strip(inventory, policy, args, out):
+    with stats.phase('plan'):
+        actions = plan_strip(inventory, policy)
+        targets = destroy_targets(actions)
+    stats.actions(actions)
+    batches = batch_targets(targets) if targets else []
+    for dataset in inventory.datasets:
+        entry = dict(dataset=dataset, snapshots=sum(1 for action in actions if action.prune),
+            ranges=len(targets), commands=len(batches), reclaimed=0, failed=[])
+        if args.verbose:
+            entry['targets'] = batches
+        with stats.phase('destroy'):
+            for batch in batches:
+                # estimated right before its destroy, once the batches
+                # before it are gone
+                try:
+                    reclaimed = zfs.reclaim(batch)
+                except zfs.ZfsError:
+                    entry['failed'].append(batch)
+                    continue
+                if not args.test and zfs.destroy(batch):
+                    entry['failed'].append(batch)
+                    continue
+                entry['reclaimed'] += reclaimed
+        print(json.dumps(entry), file=out)
+
+if __name__ == '__main__':
+    main()
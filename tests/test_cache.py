@@ -0,0 +1,92 @@
+# tests/test_cache.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# The SQLite inventory cache against the in-memory backend: what it serves
+# unchanged, and what makes it read a snapshot again.
+# Run with: python3 -m unittest discover tests
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zfsrollup import zfs
+from zfsrollup.cache import Cache
+from zfsrollup.fake import FakeBackend
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.fake = FakeBackend()
+        for hour in range(6):
+            self.fake.snapshot('tank/a', 'auto-%d' % hour, 1500000000 + hour*3600, used=100 + hour)
+        self.previous = zfs.use(self.fake)
+
+    def tearDown(self):
+        zfs.use(self.previous)
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        # name -> (guid, creation, used), through a fresh Cache as a new run would
+        cache = Cache(self.directory)
+        try:
+            found = {}
+            for inventory in cache.stream(['tank'], recursive=True):
+                for dataset in inventory.datasets:
+                    snapshots = inventory.snapshots(dataset)
+                    for i, name in enumerate(snapshots.names):
+                        found[dataset+'@'+name] = (snapshots.guids[i], snapshots.creation[i], snapshots.used[i])
+            return found
+        finally:
+            cache.close()
+
+    def snapshot(self, name):
+        return self.fake.datasets['tank/a'].snapshots[name]
+
+    def test_unchanged(self):
+        self.read()
+        # nothing moved snapshots_changed, so the cached value stands
+        self.snapshot('auto-2').used = 999
+        self.assertEqual(self.read()['tank/a@auto-2'][2], 102)
+
+    def test_recreated_snapshot(self):
+        self.read()
+        self.fake.destroy('tank/a@auto-5')
+        # same name, new createtxg
+        self.fake.snapshot('tank/a', 'auto-5', 1500100000, used=7)
+        found = self.read()
+        self.assertEqual(found['tank/a@auto-5'][1:], (1500100000, 7))
+        self.assertEqual(len(found), 6)
+
+    def test_new_guid(self):
+        self.read()
+        # replaced by a received snapshot of the same name and createtxg
+        snapshot = self.snapshot('auto-3')
+        snapshot.guid = '12345'
+        snapshot.creation = 1500200000
+        snapshot.used = 8
+        self.fake.txg += 1
+        self.fake.datasets['tank/a'].changed = self.fake.txg
+        found = self.read()
+        self.assertEqual(found['tank/a@auto-3'], (12345, 1500200000, 8))
+        self.assertEqual(len(found), 6)
+
+    def test_recreated_dataset(self):
+        self.read()
+        # destroyed and created again under the same name: a new guid
+        self.fake.datasets['tank/a'].guid = '54321'
+        self.snapshot('auto-1').used = 9
+        self.assertEqual(self.read()['tank/a@auto-1'][2], 9)
+        cache = Cache(self.directory)
+        try:
+            database = cache.database('tank')
+            self.assertEqual(database.execute('SELECT DISTINCT dataset FROM snapshots').fetchall(), [('54321',)])
+        finally:
+            cache.close()
+
+if __name__ == '__main__':
+    unittest.main()
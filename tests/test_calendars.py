@@ -0,0 +1,74 @@
+# tests/test_calendars.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Calendar buckets found by binary search against strftime of the creation
+# time, which rollup used to key them by. Run with: python3 -m unittest discover tests
+
+import datetime
+import os
+import random
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zfsrollup import calendars
+from zfsrollup.buckets import intervals
+
+def zoned(name):
+    try:
+        return calendars.zone(name)
+    except ValueError:
+        return None
+
+amsterdam = zoned('Europe/Amsterdam')
+
+def local_hour(epoch):
+    return datetime.datetime.fromtimestamp(epoch, amsterdam).hour
+
+class CalendarTest(unittest.TestCase):
+    def assertSameBuckets(self, epochs, reference, zone, formatted):
+        # two epochs share a Calendar bucket exactly when they format the same
+        calendar = calendars.calendar(reference, zone)
+        for a, b in zip(epochs, epochs[1:]):
+            self.assertEqual(calendar.key(a) == calendar.key(b), formatted(a) == formatted(b),
+                "%s: %d and %d" % (reference, a, b))
+
+    def test_utc(self):
+        rng = random.Random(1)
+        epochs = sorted(rng.randrange(946684800, 1893456000) for i in range(5000))
+        for interval in intervals.values():
+            reference = interval['reference']
+            self.assertSameBuckets(epochs, reference, calendars.utc,
+                lambda epoch: time.strftime(reference, time.gmtime(epoch)))
+
+    @unittest.skipUnless(amsterdam, "no time zone database")
+    def test_dst(self):
+        # every 10 minutes around the changes of 2017 and the new year between them
+        epochs = list(range(1490400000, 1490400000 + 7*86400, 600)) + \
+            list(range(1508968800, 1508968800 + 7*86400, 600)) + \
+            list(range(1514660400, 1514660400 + 3*86400, 600))
+        local = lambda epoch: datetime.datetime.fromtimestamp(epoch, amsterdam)
+        for interval in intervals.values():
+            reference = interval['reference']
+            if reference == '%Y-%m-%d %H':
+                # the hour that is repeated in autumn is two buckets
+                formatted = lambda epoch: (local(epoch).strftime(reference), local(epoch).fold)
+            else:
+                formatted = lambda epoch: local(epoch).strftime(reference)
+            self.assertSameBuckets(epochs, reference, amsterdam, formatted)
+
+    @unittest.skipUnless(amsterdam, "no time zone database")
+    def test_day_length(self):
+        daily = calendars.calendar('%Y-%m-%d', amsterdam)
+        # 26 March 2017 lost an hour, 29 October 2017 gained one
+        for noon, hours in ((1490529600, 23), (1509274800, 25), (1500000000, 24)):
+            start = daily.key(noon)
+            self.assertEqual(local_hour(start), 0)
+            self.assertEqual(daily.key(start + hours*3600) - start, hours*3600)
+            self.assertEqual(daily.key(start + hours*3600 - 1), start)
+
+if __name__ == '__main__':
+    unittest.main()
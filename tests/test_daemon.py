@@ -0,0 +1,133 @@
+# tests/test_daemon.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# The daemon against a full plan() of the same inventory, over simulated
+# timelines on the in-memory backend. Run with: python3 -m unittest discover tests
+
+import io
+import os
+import random
+import sys
+import types
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zfsrollup import zfs
+from zfsrollup.buckets import parse_intervals
+from zfsrollup.daemon import Daemon
+from zfsrollup.fake import FakeBackend
+from zfsrollup.inventory import fetch
+from zfsrollup.retention import Policy, destroy_targets, plan
+
+def options(**values):
+    defaults = dict(recursive=True, test=False, verbose=False, batch=False, bookmark=False)
+    defaults.update(values)
+    return types.SimpleNamespace(**defaults)
+
+class FailingBackend(FakeBackend):
+    # refuses the first 'failures' destroys
+    failures = 0
+
+    def destroy(self, target, flags=()):
+        if self.failures:
+            self.failures -= 1
+            return 1
+        return FakeBackend.destroy(self, target, flags)
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.previous = zfs.current()
+
+    def tearDown(self):
+        zfs.use(self.previous)
+
+    def daemon(self, fake, policy, args):
+        zfs.use(fake)
+        def initial(inventory, out):
+            for target in destroy_targets(plan(inventory, policy)):
+                zfs.destroy(target)
+        return Daemon(['tank'], policy, args, initial)
+
+    def timeline(self, intervals, seed, steps=400, replication=False, rules=None):
+        # after every new snapshot the daemon destroys what plan() prunes
+        rng = random.Random(seed)
+        policy = Policy(parse_intervals(intervals), ['auto'],
+            rules=dict((prefix, parse_intervals(rule)) for prefix, rule in (rules or {}).items()))
+        fake = FakeBackend()
+        daemon = self.daemon(fake, policy, options(batch=seed % 2 == 0, bookmark=replication))
+        epoch = 1500000000
+        for step in range(steps):
+            epoch += rng.choice([600, 900, 1800, 3600, 5400, 86400])
+            values = {'freenas:state': 'NEW'} if rng.random() < 0.05 else {}
+            fake.snapshot('tank/a', ('auto-%d' if rng.random() < 0.9 else 'manual-%d') % epoch, epoch, 1, **values)
+            if rng.random() < 0.1:
+                # replication caught up
+                for snapshot in fake.datasets['tank/a'].snapshots.values():
+                    snapshot.properties = None
+            if replication and rng.random() < 0.05:
+                fake.hold('tank/a@'+rng.choice(list(fake.datasets['tank/a'].snapshots)))
+            if replication and rng.random() < 0.05:
+                name = rng.choice(list(fake.datasets['tank/a'].snapshots))
+                if '#sent-'+name not in fake.datasets['tank/a'].bookmarks:
+                    fake.bookmark('tank/a@'+name, 'tank/a#sent-'+name)
+            expected = set(action.snapshot for action in plan(fetch(['tank'], True), policy) if action.prune)
+            before = set(fake.datasets['tank/a'].snapshots)
+            daemon.poll(io.StringIO())
+            destroyed = before - set(fake.datasets['tank/a'].snapshots)
+            self.assertEqual(destroyed, expected, "%s, seed %d, step %d" % (intervals, seed, step))
+
+    def test_calendar(self):
+        for seed in range(3):
+            self.timeline('hourly:6,daily:3,weekly:2', seed)
+
+    def test_period(self):
+        for seed in range(3):
+            self.timeline('2h:4', seed)
+
+    def test_mixed(self):
+        for seed in range(3):
+            self.timeline('hourly:6,daily:3,2h:4', seed)
+
+    def test_rules(self):
+        for seed in range(3):
+            self.timeline('hourly:6,2h:4', seed, rules={'manual': '3h:3,daily:2'})
+
+    def test_holds_and_bookmarks(self):
+        for seed in range(3):
+            self.timeline('hourly:6,daily:3,2h:4', seed, replication=True)
+
+    def test_failed_destroy_is_retried(self):
+        policy = Policy(parse_intervals('hourly:2'), ['auto'])
+        fake = FailingBackend()
+        for hour in range(3):
+            fake.snapshot('tank/a', 'auto-%d' % hour, 1500000000 + hour*3600)
+        daemon = self.daemon(fake, policy, options())
+        daemon.poll(io.StringIO())
+        fake.snapshot('tank/a', 'auto-3', 1500000000 + 3*3600)
+        fake.failures = 1
+        out = io.StringIO()
+        daemon.poll(out)
+        self.assertIn('cannot destroy tank/a@auto-1', out.getvalue())
+        self.assertIn('auto-1', fake.datasets['tank/a'].snapshots)
+        daemon.poll(io.StringIO())
+        self.assertNotIn('auto-1', fake.datasets['tank/a'].snapshots)
+
+    def test_failed_initial_destroy_is_retried(self):
+        policy = Policy(parse_intervals('hourly:2'), ['auto'])
+        fake = FailingBackend()
+        for hour in range(6):
+            fake.snapshot('tank/a', 'auto-%d' % hour, 1500000000 + hour*3600)
+        # the full plan's destroy and the retries of the same poll
+        fake.failures = 5
+        daemon = self.daemon(fake, policy, options())
+        out = io.StringIO()
+        daemon.poll(out)
+        self.assertIn('cannot destroy 4 snapshots of tank/a, will retry', out.getvalue())
+        self.assertIn('auto-0', fake.datasets['tank/a'].snapshots)
+        daemon.poll(io.StringIO())
+        self.assertEqual(set(fake.datasets['tank/a'].snapshots), set(['auto-4', 'auto-5']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# tests/test_fleet.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# rollup.py --fleet against FakeHost pools, one JSON file per host.
+# Run with: python3 -m unittest discover tests
+
+import argparse
+import contextlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+top = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, top)
+
+import rollup
+from zfsrollup import fleet
+from zfsrollup.buckets import parse_intervals
+from zfsrollup.fake import FakeBackend
+from zfsrollup.retention import Policy
+
+class BrokenHost(fleet.FakeHost):
+    # zfs cannot be run, as when ssh refuses an argument that is too long
+    def get(self, *arguments):
+        raise OSError(7, 'Argument list too long')
+
+class FleetTest(unittest.TestCase):
+    hosts = ('a', 'b', 'c')
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        for host in self.hosts:
+            fake = FakeBackend()
+            for hour in range(6):
+                fake.snapshot('tank/'+host, 'auto-%d' % hour, 1500000000 + hour*3600)
+            fake.save(self.pool(host))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def pool(self, host):
+        return os.path.join(self.directory, host+'.json')
+
+    def snapshots(self, host):
+        return list(FakeBackend.load(self.pool(host)).datasets['tank/'+host].snapshots)
+
+    def test_prune(self):
+        run = subprocess.run([sys.executable, os.path.join(top, 'rollup.py'), '--fleet', '--backend', 'fake', '--fake-pool', self.directory,
+            '-i', 'hourly:2', '-r'] + ['%s:tank/%s' % (host, host) for host in self.hosts],
+            stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(run.returncode, 0)
+        for host in self.hosts:
+            self.assertEqual(self.snapshots(host), ['auto-4', 'auto-5'])
+            self.assertIn('%s: tank/%s\n' % (host, host), run.stdout)
+            self.assertIn('%s: \t pruning\t @auto-0' % host, run.stdout)
+
+    def test_broken_host(self):
+        args = argparse.Namespace(datasets=['%s:tank/%s' % (host, host) for host in self.hosts], backend='fake', fake_pool=self.directory,
+            recursive=True, test=False, verbose=False, bookmark=False, batch=False, cache=False, cache_dir=None, jobs=1, pool_jobs=None,
+            pool_destroys=None, max_freeing=None, max_latency=None, deadline=None)
+        connect = fleet.connect
+        def broken(host, args, control):
+            backend = connect(host, args, control)
+            if host == 'b':
+                backend.__class__ = BrokenHost
+            return backend
+        out = io.StringIO()
+        with mock.patch.object(fleet, 'connect', broken), contextlib.redirect_stdout(out):
+            with self.assertRaises(SystemExit) as exit:
+                rollup.prune_fleet(Policy(parse_intervals('hourly:2'), ['auto']), args)
+        self.assertEqual(exit.exception.code, 1)
+        self.assertIn('b: [Errno 7] Argument list too long\n', out.getvalue())
+        self.assertEqual(self.snapshots('a'), ['auto-4', 'auto-5'])
+        self.assertEqual(len(self.snapshots('b')), 6)
+        self.assertEqual(self.snapshots('c'), ['auto-4', 'auto-5'])
+
+if __name__ == '__main__':
+    unittest.main()
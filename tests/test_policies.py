@@ -0,0 +1,98 @@
+# tests/test_policies.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Policy files: what a dataset inherits, and how mistakes are reported.
+# Run with: python3 -m unittest discover tests
+
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zfsrollup import calendars
+from zfsrollup.policies import Policies, load
+
+class PoliciesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, values, name='policy.json'):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w') as f:
+            f.write(values if isinstance(values, str) else json.dumps(values))
+        return path
+
+    def counts(self, policy):
+        return dict((interval, definition['max']) for interval, definition in policy.intervals.items())
+
+    def test_inheritance(self):
+        policies = load(self.write({
+            'intervals': 'hourly:24',
+            'prefixes': ['auto'],
+            'datasets': {
+                'tank/vm': {'intervals': {'daily': 3}},
+                'tank/vm/db': {'prefixes': 'manual', 'rules': {'backup': 'monthly:2'}},
+                'tank/scratch': {'clear': True},
+            }}))
+        self.assertEqual(self.counts(policies.resolve('tank')), {'hourly': 24})
+        self.assertEqual(self.counts(policies.resolve('tank/home')), {'hourly': 24})
+        self.assertEqual(self.counts(policies.resolve('tank/vm')), {'daily': 3})
+        self.assertEqual(policies.resolve('tank/vm').prefixes, ('auto-',))
+        # db takes its intervals from tank/vm, not from the top level
+        db = policies.resolve('tank/vm/db')
+        self.assertEqual(self.counts(db), {'daily': 3})
+        self.assertEqual(db.prefixes, ('backup-', 'manual-'))
+        self.assertEqual(list(db.rules), ['backup-'])
+        self.assertIs(policies.resolve('tank/vm/db/logs'), db)
+        self.assertTrue(policies.resolve('tank/scratch').clear)
+        self.assertFalse(policies.resolve('tank/vm').clear)
+        # a sibling whose name merely starts the same is not below tank/vm
+        self.assertEqual(self.counts(policies.resolve('tank/vmware')), {'hourly': 24})
+
+    def test_timezone(self):
+        if calendars.zoneinfo is None:
+            self.skipTest("no zoneinfo")
+        policies = Policies({}, {'tank/eu': {'timezone': 'Europe/Amsterdam'}}, 'UTC')
+        zone = lambda dataset: policies.resolve(dataset).intervals['hourly']['calendar'].zone
+        self.assertEqual(zone('tank'), calendars.utc)
+        self.assertEqual(str(zone('tank/eu/photos')), 'Europe/Amsterdam')
+
+    def assertInvalid(self, values, message, name='policy.json'):
+        path = self.write(values, name)
+        with self.assertRaises(ValueError) as raised:
+            load(path)
+        self.assertEqual(str(raised.exception), "policy file %s: %s" % (path, message))
+
+    def test_errors(self):
+        self.assertInvalid({'interval': 'hourly'}, "top level: unknown setting interval")
+        self.assertInvalid({'datasets': {'tank/vm': {'intervals': {'daily': 'x'}}}},
+            "datasets.tank/vm.intervals: invalid count for daily: 'x'")
+        self.assertInvalid({'datasets': {'tank/vm': {'rules': {'manual': 'fortnightly'}}}},
+            "datasets.tank/vm.rules.manual: invalid interval: fortnightly")
+        self.assertInvalid({'intervals': 'hourly:x'}, "intervals: invalid count: x")
+        self.assertInvalid({'prefixes': ['auto', '']}, "top level: prefixes must be a list of names")
+        self.assertInvalid({'datasets': {'tank': {'clear': 'yes'}}}, "datasets.tank: clear must be true or false")
+        self.assertInvalid({'datasets': {'tank': 'hourly'}}, "datasets.tank: expected a table of settings")
+        self.assertInvalid({'datasets': ['tank']}, "datasets must map dataset names to settings")
+        self.assertInvalid(['hourly'], "expected a table of settings")
+
+    def test_file_errors(self):
+        path = self.write('{"intervals": ', 'broken.json')
+        with self.assertRaisesRegex(ValueError, "^policy file %s: " % re.escape(path)):
+            load(path)
+        with self.assertRaisesRegex(ValueError, "use a .json, .toml, .yaml or .yml file"):
+            load(self.write('', 'policy.ini'))
+        with self.assertRaisesRegex(ValueError, "^policy file /nonexistent.json: "):
+            load('/nonexistent.json')
+
+if __name__ == '__main__':
+    unittest.main()
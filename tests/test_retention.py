@@ -0,0 +1,108 @@
+# tests/test_retention.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Destroy targets and their batching, and planning for a space goal.
+# Run with: python3 -m unittest discover tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zfsrollup import zfs
+from zfsrollup.buckets import parse_intervals
+from zfsrollup.inventory import Inventory, Snapshots
+from zfsrollup.retention import Action, Policy, batch_targets, destroy_targets, plan_reclaim
+
+def actions(dataset, pruned):
+    # one Action per character of 'pruned': 'x' pruned, '.' kept
+    return [Action(dataset, 'auto-%d' % i, flag == 'x', (), None, 0) for i, flag in enumerate(pruned)]
+
+class BatchTest(unittest.TestCase):
+    def test_targets(self):
+        planned = actions('tank/a', 'xx.x...xxx.') + actions('tank/b', 'x')
+        self.assertEqual(destroy_targets(planned),
+            ['tank/a@auto-0%auto-1', 'tank/a@auto-3', 'tank/a@auto-7%auto-9', 'tank/b@auto-0'])
+
+    def test_batches(self):
+        targets = ['tank/a@auto-0%auto-1', 'tank/a@auto-3', 'tank/b@auto-0', 'tank/a@auto-7']
+        self.assertEqual(batch_targets(targets, 1000),
+            ['tank/a@auto-0%auto-1,auto-3', 'tank/b@auto-0', 'tank/a@auto-7'])
+
+    def test_limit(self):
+        targets = ['tank/a@auto-%06d' % i for i in range(100)]
+        batches = batch_targets(targets, 60)
+        self.assertTrue(all(len(batch) <= 60 for batch in batches))
+        # '%06d' names: 'tank/a@' and four of them fit
+        self.assertEqual(len(batches), 25)
+        self.assertEqual(sum((batch.split('@', 1)[1].split(',') for batch in batches), []),
+            [target.split('@', 1)[1] for target in targets])
+
+    def test_arg_limit(self):
+        # without a limit, batches fit a single argument to zfs, and leave
+        # room for what a backend wraps around it
+        targets = ['tank/a@auto-%010d' % i for i in range(30000)]
+        limit = zfs.arg_limit()
+        self.assertTrue(all(len(batch) <= limit for batch in batch_targets(targets)))
+        self.assertGreater(len(batch_targets(targets)), 1)
+
+        class Wrapped(zfs.CliBackend):
+            overhead = 1000
+        with zfs.using(Wrapped()):
+            self.assertEqual(zfs.arg_limit(), limit - 1000)
+            self.assertTrue(all(len(batch) <= limit - 1000 for batch in batch_targets(targets)))
+
+class ReclaimTest(unittest.TestCase):
+    # 'tank/a' has an hourly snapshot auto-0 to auto-19, and destroying
+    # auto-i frees i+1 bytes; hourly:2 prunes auto-0 to auto-17 and holds
+    # auto-18, while auto-19 is the newest
+    def setUp(self):
+        snapshots = Snapshots()
+        for i in range(20):
+            snapshots.append('auto-%d' % i, 1500000000 + i*3600, type='snapshot')
+        self.inventory = Inventory().add('tank/a', snapshots)
+        self.policy = Policy(parse_intervals('hourly:2'), ['auto'])
+        self.estimates = 0
+
+    def reclaim(self, target):
+        # the sum of what every snapshot named by 'target' frees
+        self.estimates += 1
+        dataset, spec = target.split('@', 1)
+        freed = 0
+        for part in spec.split(','):
+            first, _, last = part.partition('%')
+            freed += sum(range(int(first[5:]) + 1, int((last or first)[5:]) + 2))
+        return freed
+
+    def pruned(self, goal):
+        actions, freed = plan_reclaim(self.inventory, self.policy, goal, self.reclaim)
+        return [int(action.snapshot[5:]) for action in actions if action.prune], freed
+
+    def test_shortest_prefix(self):
+        # auto-0 to auto-5 free 21 bytes, auto-0 to auto-4 only 15
+        self.assertEqual(self.pruned(20), (list(range(6)), 21))
+        self.assertEqual(self.pruned(21), (list(range(6)), 21))
+        self.assertEqual(self.pruned(22), (list(range(7)), 28))
+
+    def test_held_snapshots_last(self):
+        # auto-0 to auto-17 free 171 bytes; auto-18 is needed for more
+        self.assertEqual(self.pruned(171), (list(range(18)), 171))
+        self.assertEqual(self.pruned(172), (list(range(19)), 190))
+
+    def test_unreachable(self):
+        # everything but the newest snapshot, and the estimate falls short
+        self.assertEqual(self.pruned(10**6), (list(range(19)), 190))
+
+    def test_no_goal(self):
+        self.assertEqual(self.pruned(0), ([], 0))
+        self.assertEqual(self.estimates, 0)
+
+    def test_binary_search(self):
+        self.pruned(100)
+        # one estimate of the whole list and a handful of halvings, not one per snapshot
+        self.assertLessEqual(self.estimates, 7)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+# tests/test_snap_strip.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# snap-strip.py --execute on the in-memory backend, read back through its
+# JSON Lines output. Run with: python3 -m unittest discover tests
+
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import types
+import unittest
+
+top = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, top)
+
+from zfsrollup import zfs
+from zfsrollup.fake import FakeBackend
+from zfsrollup.retention import Policy
+
+def pool():
+    fake = FakeBackend()
+    for hour in range(8):
+        fake.snapshot('tank/a', 'auto-%d' % hour, 1500000000 + hour*3600, used=10)
+        if hour == 3:
+            fake.snapshot('tank/a', 'manual-3', 1500000000 + hour*3600 + 60, used=10)
+    for hour in range(3):
+        fake.snapshot('tank/b', 'auto-%d' % hour, 1500000000 + hour*3600, used=10)
+    return fake
+
+class FailingBackend(FakeBackend):
+    # refuses to destroy tank/b
+    def destroy(self, target, flags=()):
+        if target.startswith('tank/b@'):
+            return 1
+        return FakeBackend.destroy(self, target, flags)
+
+class SnapStripTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'pool.json')
+        pool().save(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def strip(self, *options):
+        # the JSON lines printed and the exit code
+        run = subprocess.run([sys.executable, os.path.join(top, 'snap-strip.py'), '--backend', 'fake', '--fake-pool', self.path,
+            '-x', '-r', 'tank'] + list(options), stdout=subprocess.PIPE, universal_newlines=True)
+        return [json.loads(line) for line in run.stdout.splitlines()], run.returncode
+
+    def snapshots(self, dataset):
+        return list(FakeBackend.load(self.path).datasets[dataset].snapshots)
+
+    def test_execute(self):
+        lines, returncode = self.strip('-v')
+        self.assertEqual(returncode, 0)
+        entries = dict((entry['dataset'], entry) for entry in lines[:-1])
+        # manual-3 splits tank/a's run in two ranges, batched into one destroy
+        self.assertEqual(entries['tank/a']['snapshots'], 7)
+        self.assertEqual(entries['tank/a']['ranges'], 2)
+        self.assertEqual(entries['tank/a']['targets'], ['tank/a@auto-0%auto-3,auto-4%auto-6'])
+        self.assertEqual(entries['tank/b']['snapshots'], 2)
+        totals = lines[-1]
+        self.assertEqual(totals, dict(datasets=2, snapshots=9, ranges=3, commands=2,
+            reclaimed=sum(entry['reclaimed'] for entry in entries.values()), failed=0, test=False))
+        self.assertGreater(totals['reclaimed'], 0)
+        self.assertEqual(self.snapshots('tank/a'), ['manual-3', 'auto-7'])
+        self.assertEqual(self.snapshots('tank/b'), ['auto-2'])
+
+    def test_test(self):
+        lines, returncode = self.strip('--test')
+        self.assertEqual(returncode, 0)
+        self.assertEqual(lines[-1]['snapshots'], 9)
+        self.assertTrue(lines[-1]['test'])
+        self.assertEqual(len(self.snapshots('tank/a')), 9)
+
+    def test_failed(self):
+        spec = importlib.util.spec_from_file_location('snap_strip', os.path.join(top, 'snap-strip.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        previous = zfs.use(FailingBackend.load(self.path))
+        try:
+            args = types.SimpleNamespace(datasets=['tank'], recursive=True, test=False, verbose=False,
+                jobs=1, pool_jobs=None, cache=False, cache_dir=None)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                failed = module.execute(Policy(), args)
+        finally:
+            zfs.use(previous)
+        lines = [json.loads(line) for line in out.getvalue().splitlines()]
+        entries = dict((entry['dataset'], entry) for entry in lines[:-1])
+        self.assertEqual(failed, 1)
+        self.assertEqual(entries['tank/b']['failed'], ['tank/b@auto-0%auto-1'])
+        self.assertEqual(entries['tank/b']['reclaimed'], 0)
+        self.assertEqual(lines[-1]['failed'], 1)
+        self.assertEqual(lines[-1]['reclaimed'], entries['tank/a']['reclaimed'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+# tests/test_timemachine.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# tmsnap.py's flow against StubServer: a snapshot taken through the API,
+# then pruned by the Rollup hook. Run with: python3 -m unittest discover tests
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zfsrollup import fleet, timemachine
+from zfsrollup.buckets import parse_intervals
+from zfsrollup.retention import Policy
+
+auth = ('root', 'secret')
+
+class FailingHost(fleet.FakeHost):
+    def destroy(self, target, flags=()):
+        return 1
+
+@unittest.skipUnless(timemachine.requests, "the requests package is not installed")
+class RollupTest(unittest.TestCase):
+    def backend(self, kind=fleet.FakeHost):
+        # an hourly tm- snapshot for each of the 30 hours that ended a day
+        # ago, and one of another tool that splits them in two ranges
+        backend = kind()
+        start = (int(time.time()) // 3600 - 54) * 3600
+        for hour in range(30):
+            backend.snapshot('tank/tm', 'tm-%d' % hour, start + hour*3600)
+            if hour == 14:
+                backend.snapshot('tank/tm', 'other-14', start + hour*3600 + 60)
+        return backend
+
+    def backup(self, backend, test=False):
+        # snapshot through the stub, which answers 503 once, then prune
+        server = timemachine.StubServer(auth, backend, failures=1)
+        server.start()
+        hook = timemachine.Rollup(Policy(parse_intervals('hourly:4'), ['tm']), backend, delay=0, test=test)
+        api = timemachine.Api(server.host, auth, backoff=0)
+        try:
+            self.assertEqual(api.snapshot('tank/tm', 'tm-new').status_code, 201)
+            hook.trigger('tank/tm')
+        finally:
+            api.close()
+            hook.close()
+            server.stop()
+        self.assertEqual(server.snapshots, [('tank/tm', 'tm-new')])
+        self.assertEqual(server.failures, 0)
+        return list(backend.datasets['tank/tm'].snapshots)
+
+    def test_prune(self):
+        self.assertEqual(self.backup(self.backend()), ['other-14', 'tm-27', 'tm-28', 'tm-29', 'tm-new'])
+
+    def test_test(self):
+        self.assertEqual(len(self.backup(self.backend(), test=True)), 32)
+
+    def test_failed_destroy(self):
+        with self.assertLogs(level='ERROR') as logs:
+            self.assertEqual(len(self.backup(self.backend(FailingHost))), 32)
+        # the two ranges around other-14 are sent as one batch
+        self.assertIn('ERROR:root:rollup: 1 of 1 destroys of tank/tm failed', logs.output)
+
+if __name__ == '__main__':
+    unittest.main()
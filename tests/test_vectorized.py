@@ -0,0 +1,58 @@
+# tests/test_vectorized.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# The NumPy bucket assignment against Retention, the single pass it replaces.
+# Run with: python3 -m unittest discover tests
+
+import os
+import random
+import sys
+import unittest
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from zfsrollup import vectorized
+from zfsrollup.buckets import compile_intervals, parse_intervals
+from zfsrollup.calendars import zone
+from zfsrollup.retention import Retention
+
+def creation(seed, count=3000):
+    # ascending epochs with gaps from minutes to days, some of them equal
+    rng = random.Random(seed)
+    epochs = array('q')
+    epoch = 1500000000
+    for i in range(count):
+        epoch += rng.choice([0, 60, 600, 900, 3600, 5400, 86400, 3*86400])
+        epochs.append(epoch)
+    return epochs
+
+@unittest.skipUnless(vectorized.available, "NumPy is not installed")
+class VectorizedTest(unittest.TestCase):
+    def assertSameKeep(self, epochs, intervals):
+        retention = Retention(intervals)
+        for i, epoch in enumerate(epochs):
+            retention.add(i, epoch)
+        for interval, positions in vectorized.retain(epochs, intervals).items():
+            expected = sorted(i for i, held in retention.holders.items() if interval in held)
+            self.assertEqual(positions.tolist(), expected, interval)
+
+    def test_calendar(self):
+        for seed in range(3):
+            self.assertSameKeep(creation(seed), parse_intervals('hourly:24,daily:30,weekly:8,monthly:12,yearly:0'))
+
+    def test_period(self):
+        for seed in range(3):
+            self.assertSameKeep(creation(seed), parse_intervals('15M:0,2h:12,1d:7,1w:0'))
+
+    def test_zone(self):
+        intervals = compile_intervals(parse_intervals('hourly:0,daily:0,weekly:0,monthly:0'), zone('Europe/Amsterdam'))
+        self.assertSameKeep(creation(7), intervals)
+
+    def test_empty(self):
+        kept = vectorized.retain(array('q'), parse_intervals('hourly:24,2h:12'))
+        self.assertEqual(dict((interval, positions.tolist()) for interval, positions in kept.items()), {'hourly': [], '2h:12': []})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,95 +1,143 @@
 #!/opt/local/bin/python
 
 import json
-import requests
-from multitail import multitail
-import re, os
+import os
 import argparse
 import logging
-from functools import reduce
-
-TM_PREFIX = re.compile("com\.apple\.backupd\[\d+\]:[ \t]*")
-TM_STARTED = re.compile("Starting (?:automatic|manual) backup")
-TM_COMPLETE = re.compile("Created new backup: (\d{4}-\d{2}-\d{2}-\d{6})")
-TM_EJECTED = "Ejected Time Machine network volume."
-TM_ERROR = ("Backup failed", "Backup canceled", "Stopping backup")
-
-def apicall(host, path, authdata, payload):
-    url = 'http://'+host+'/'+path
-    return requests.post(
-        url,
-        auth=authdata,
-        headers={'Content-Type': 'application/json'},
-        verify=False,
-        data=json.dumps(payload),
-        timeout=30
+import shutil
+import sys
+import tempfile
+
+from zfsrollup import calendars, fleet, timemachine
+from zfsrollup.buckets import parse_intervals
+from zfsrollup.retention import Policy
+
+def main():
+    parser = argparse.ArgumentParser(description='Monitor the system log for Time Machine events and create snapshots after successful backups')
+    parser.add_argument('--config', action='store', help='the configuration file')
+    parser.add_argument('--test', action='store_true', help="don't actually create a new snapshot, just print what would be done")
+    parser.add_argument('--log-stream', action='store_true', help='read backupd messages from the unified log (log stream) instead of log_path; the default when log_path is not configured')
+    parser.add_argument('--stub', action='store_true', help='send snapshots to a local stand-in for the FreeNAS API instead of the configured host, to try the whole flow out')
+    parser.add_argument('--fake-pool', default=None, help='with --stub, a JSON pool file (as saved by rollup.py --backend fake) that the stub snapshots and the rollup hook prunes')
+    args = parser.parse_args()
+
+    # default logger to console
+    logging.basicConfig(
+        format='%(asctime)s %(filename)s [%(process)d]: %(levelname)-8s %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S'
     )
 
-def snapshot(host, auth, payload):
-    return apicall(host, '/api/v1.0/storage/snapshot/', auth, payload)
-
-parser = argparse.ArgumentParser(description='Monitor the system log for Time Machine events and create snapshots after successful backups')
-parser.add_argument('--config', action='store', help='the configuration file')
-parser.add_argument('--test', action='store_true', help="don't actually create a new snapshot, just print what would be done")
-args = parser.parse_args()
-
-# default logger to console
-logging.basicConfig(
-    format='%(asctime)s %(filename)s [%(process)d]: %(levelname)-8s %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
-
-logging.debug("loading configuration")
-
-if not args.config:
-    logging.error("configuration file not specified")
-    parser.print_usage()
-    sys.exit(1)
-if not os.path.isfile(args.config):
-    logging.error("configuration file does not exist: '"+args.config+"'")
-    parser.print_usage()
-    sys.exit(2)
-
-logging.getLogger('').setLevel(logging.INFO)
-logging.getLogger('requests').setLevel(logging.ERROR)
-logging.getLogger('multitail').setLevel(logging.ERROR)
-
-json_data=open(args.config)
-config = json.load(json_data)
-json_data.close()
-
-authorization = (config['username'], config['password'])
-
-latest_completed_backup = None
-
-logging.debug("starting up")
-
-for fn, line in multitail([config['log_path']]):
-    match = TM_PREFIX.search(line)
-    if not match:
-        continue
-    if TM_STARTED.search(line):
-        latest_completed_backup = None
-        logging.info("started new backup")
-        continue
-    if reduce((lambda x,y: x or y), [x in line for x in TM_ERROR]):
-        logging.error("backup error: "+line[match.end():])
-        latest_completed_backup = None
-        continue
-    match = TM_COMPLETE.search(line)
-    if match:
-        latest_completed_backup = match.group(1)
-        continue
-    if TM_EJECTED in line and latest_completed_backup:
-        shot = {}
-        shot['dataset'] = config['dataset']
-        shot['name'] = 'tm-'+latest_completed_backup
-        logging.info("snapshotting: '"+latest_completed_backup+"'")
-        if args.test:
-            logging.warn("skipping snapshot during test")
-            continue
-        result = snapshot(config['host'], authorization, shot)
-        if 201 == result.status_code:
-            logging.info("snapshot successful: '"+latest_completed_backup+"'")
+    logging.debug("loading configuration")
+
+    if not args.config:
+        logging.error("configuration file not specified")
+        parser.print_usage()
+        sys.exit(1)
+    if not os.path.isfile(args.config):
+        logging.error("configuration file does not exist: '"+args.config+"'")
+        parser.print_usage()
+        sys.exit(2)
+
+    logging.getLogger('').setLevel(logging.INFO)
+    logging.getLogger('urllib3').setLevel(logging.ERROR)
+
+    json_data=open(args.config)
+    config = json.load(json_data)
+    json_data.close()
+
+    authorization = (config['username'], config['password'])
+
+    host = config['host']
+    control = None
+    if args.stub:
+        try:
+            backend = fleet.FakeHost.load(args.fake_pool) if args.fake_pool and os.path.exists(args.fake_pool) else fleet.FakeHost()
+        except (IOError, ValueError) as e:
+            logging.error("cannot load fake pool "+args.fake_pool+": "+str(e))
+            sys.exit(1)
+        backend.path = args.fake_pool
+        server = timemachine.StubServer(authorization, backend)
+        server.start()
+        host = server.host
+        logging.info("stub FreeNAS API listening on "+host)
+    elif 'rollup' in config:
+        control = tempfile.mkdtemp(prefix='tmsnap-')
+        backend = fleet.SshBackend(config['rollup'].get('ssh_host', config['host']), os.path.join(control, 'ssh'))
+
+    # prune the dataset after each snapshot, with rollup.py's intervals for tm- snapshots
+    hook = None
+    if 'rollup' in config:
+        settings = config['rollup']
+        try:
+            policy = Policy(parse_intervals(settings.get('intervals')), ['tm'], zone=calendars.zone(settings.get('timezone')))
+            delay = float(settings.get('delay', 30))
+        except ValueError as e:
+            logging.error("rollup: "+str(e))
+            sys.exit(1)
+        hook = timemachine.Rollup(policy, backend, delay, args.test)
+
+    try:
+        api = timemachine.Api(host, authorization)
+        if args.log_stream or not config.get('log_path'):
+            lines = timemachine.stream()
         else:
-            logging.error("snapshot failed, response code: '"+str(result.status_code)+"'")
+            lines = timemachine.follow(config['log_path'])
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(1)
+
+    latest_completed_backup = None
+
+    logging.debug("starting up")
+
+    try:
+        for line in lines:
+            found = timemachine.event(line)
+            if found is None:
+                continue
+            kind, detail = found
+            if kind == 'started':
+                latest_completed_backup = None
+                logging.info("started new backup")
+            elif kind == 'failed':
+                logging.error("backup error: "+detail)
+                latest_completed_backup = None
+            elif kind == 'completed':
+                latest_completed_backup = detail
+            elif kind == 'ejected' and latest_completed_backup:
+                logging.info("snapshotting: '"+latest_completed_backup+"'")
+                if args.test:
+                    logging.warning("skipping snapshot during test")
+                    if hook:
+                        hook.trigger(config['dataset'])
+                    continue
+                try:
+                    result = api.snapshot(config['dataset'], 'tm-'+latest_completed_backup)
+                except timemachine.ApiError as e:
+                    logging.error("snapshot failed: "+str(e))
+                    continue
+                if 201 == result.status_code:
+                    logging.info("snapshot successful: '"+latest_completed_backup+"'")
+                    if hook:
+                        hook.trigger(config['dataset'])
+                    # a later eject without a new backup has nothing to snapshot
+                    latest_completed_backup = None
+                else:
+                    logging.error("snapshot failed, response code: '"+str(result.status_code)+"'")
+    except ValueError as e:
+        logging.error(str(e))
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        api.close()
+        if hook:
+            hook.close()
+        if args.stub:
+            # saves the stub's pool
+            backend.close()
+        if control:
+            shutil.rmtree(control, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
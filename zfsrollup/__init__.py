@@ -0,0 +1,9 @@
+# zfsrollup - shared snapshot retention logic for rollup.py, clearempty.py and snap-strip.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+from .buckets import intervals, modifiers, compile_intervals, parse_intervals
+from .inventory import Inventory, Snapshots, fetch, stream
+from .retention import Action, Policy, Retention, plan, plan_empty, plan_reclaim, plan_strip, destroy_targets
+from .policies import Policies
+from .zfs import ZfsError
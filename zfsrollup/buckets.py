@@ -0,0 +1,118 @@
+# zfsrollup/buckets.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Interval definitions and the '-i' grammar shared by the pruning scripts.
+
+from . import calendars
+
+intervals = {}
+intervals['hourly']  = { 'max':24, 'abbreviation':'h', 'reference':'%Y-%m-%d %H' }
+intervals['daily']   = { 'max': 7, 'abbreviation':'d', 'reference':'%Y-%m-%d' }
+intervals['weekly']  = { 'max': 0, 'abbreviation':'w', 'reference':'%Y-%W' }
+intervals['monthly'] = { 'max':12, 'abbreviation':'m', 'reference':'%Y-%m' }
+intervals['yearly']  = { 'max':10, 'abbreviation':'y', 'reference':'%Y' }
+
+modifiers = {
+    'M' : 1,
+    'H' : 60,
+    'h' : 60,
+    'd' : 60*24,
+    'w' : 60*24*7,
+    'm' : 60*24*28,
+    'y' : 60*24*365,
+}
+
+default_intervals = ('hourly', 'daily', 'weekly')
+
+def describe():
+    # help text for the '-i' option
+    return "Modify and define intervals with which to keep and prune snapshots. Either name existing intervals ("+\
+        ", ".join(sorted(intervals, key=lambda interval: modifiers[intervals[interval]['abbreviation']]))+"), "+\
+        "modify the number of those to store (hourly:12), or define new intervals according to interval:count (2h:12). "+\
+        "Multiple intervals may be specified if comma seperated (hourly,daily:30,2h:12). Available modifier abbreviations are: "+\
+        ", ".join(sorted(modifiers, key=modifiers.get))
+
+def parse_intervals(spec=None):
+    """Parse an '-i' string (hourly,daily:30,2h:12) into the intervals to use.
+
+    The shared 'intervals' table is never modified; every returned
+    definition is a compiled copy (see compile_intervals()). Raises
+    ValueError on invalid input.
+    """
+    if not spec:
+        return compile_intervals(dict((interval, intervals[interval]) for interval in default_intervals))
+
+    used_intervals = {}
+
+    for interval in spec.split(','):
+        if interval.count(':') == 1:
+            period,count = interval.split(':')
+
+            try:
+                count = int(count)
+            except ValueError:
+                raise ValueError("invalid count: "+count)
+
+            if period in intervals:
+                used_intervals[period] = dict(intervals[period])
+                used_intervals[period]['max'] = count
+
+            else:
+                try:
+                    if period[-1] in modifiers:
+                        used_intervals[interval] = { 'max' : count, 'interval' : int(period[:-1]) * modifiers[period[-1]] }
+                    else:
+                        used_intervals[interval] = { 'max' : count, 'interval' : int(period) }
+
+                except (ValueError, IndexError):
+                    raise ValueError("invalid period: "+period)
+
+        elif interval.count(':') == 0 and interval in intervals:
+            used_intervals[interval] = dict(intervals[interval])
+
+        else:
+            raise ValueError("invalid interval: "+interval)
+
+    for interval in used_intervals:
+        if 'abbreviation' not in used_intervals[interval]:
+            used_intervals[interval]['abbreviation'] = interval
+
+    return compile_intervals(used_intervals)
+
+def compile_intervals(definitions, zone=None):
+    """Check interval 'definitions' and return copies ready for bucket assignment.
+
+    Each copy has an integer 'max' and an 'abbreviation'. Calendar intervals
+    keep their strftime 'reference' and get the 'calendar' that finds their
+    buckets in 'zone' (a tzinfo; when not given, the zone they were compiled
+    for before, or UTC). Fixed ones get 'gap', the seconds that must pass
+    before a snapshot opens a new bucket, in addition to 'interval' in
+    minutes. Compiling twice gives the same result. Raises ValueError on an
+    invalid definition.
+    """
+    compiled = {}
+    for interval, definition in definitions.items():
+        definition = dict(definition)
+        try:
+            definition['max'] = int(definition.get('max', 0))
+        except (TypeError, ValueError):
+            raise ValueError("invalid count: %s" % definition.get('max'))
+        if definition['max'] < 0:
+            raise ValueError("invalid count: %s" % definition['max'])
+        definition.setdefault('abbreviation', interval)
+        if 'reference' in definition:
+            if zone is not None or 'calendar' not in definition:
+                definition['calendar'] = calendars.calendar(definition['reference'], zone or calendars.utc)
+        else:
+            try:
+                definition['interval'] = int(definition['interval'])
+            except (KeyError, TypeError, ValueError):
+                raise ValueError("invalid period: %s" % interval)
+            if definition['interval'] <= 0:
+                raise ValueError("invalid period: %s" % interval)
+            # a bucket is left once 90% of the period has passed, so that
+            # snapshots taken a little early still count
+            definition['gap'] = definition['interval']*60*.9
+        compiled[interval] = definition
+    return compiled
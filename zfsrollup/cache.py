@@ -0,0 +1,284 @@
+# zfsrollup/cache.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# A persistent snapshot inventory, one SQLite file per pool, so a run only
+# asks zfs about what changed since the previous one.
+#
+# Datasets are keyed by guid and snapshots by (dataset guid, createtxg,
+# guid), so renames are picked up from the cheap name listing and a
+# recreated dataset never inherits stale rows. Every run lists the name,
+# guid, createtxg and hold count (userrefs) of all snapshots and bookmarks
+# below a root in one 'zfs list', because 'zfs hold' and 'zfs bookmark' do
+# not move 'snapshots_changed'. A dataset whose 'snapshots_changed' matches
+# the cached value is taken from the cache beyond that; otherwise full
+# properties are fetched only for snapshots newer than the last seen txg,
+# and snapshots that disappeared are dropped. Destroying a snapshot
+# changes the 'used' value of its neighbours and the 'written' value of its
+# successor, and the newest snapshot's 'used' grows as the live filesystem
+# diverges, so only those are re-read.
+
+import os
+import sqlite3
+import threading
+import time
+
+from . import zfs
+from .inventory import Inventory, Snapshots, stream
+from .parallel import pool
+
+schema_version = 2
+
+schema = '''
+DROP TABLE IF EXISTS datasets;
+DROP TABLE IF EXISTS snapshots;
+DROP TABLE IF EXISTS bookmarks;
+CREATE TABLE datasets (
+    guid TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    snapshots_changed TEXT
+);
+CREATE TABLE snapshots (
+    dataset TEXT NOT NULL,
+    createtxg INTEGER NOT NULL,
+    guid TEXT NOT NULL,
+    name TEXT NOT NULL,
+    creation INTEGER NOT NULL DEFAULT 0,
+    used INTEGER NOT NULL DEFAULT 0,
+    written INTEGER NOT NULL DEFAULT 0,
+    type TEXT,
+    state TEXT,
+    userrefs INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (dataset, createtxg, guid)
+);
+CREATE TABLE bookmarks (
+    dataset TEXT NOT NULL,
+    guid TEXT NOT NULL,
+    PRIMARY KEY (dataset, guid)
+);
+'''
+
+# the snapshot properties kept in the cache
+properties = ('type', 'creation', 'used', 'written', 'freenas:state')
+
+# snapshot property -> cache column
+columns = {
+    'type' : 'type',
+    'creation' : 'creation',
+    'used' : 'used',
+    'written' : 'written',
+    'freenas:state' : 'state',
+}
+
+# beyond this many snapshots, read the whole dataset rather than each name
+chunk = 512
+
+def convert(property, value):
+    if property in ('creation', 'used', 'written'):
+        return int(value) if value.isdigit() else 0
+    if property == 'freenas:state' and value == '-':
+        return None
+    return value
+
+def settled(changed):
+    # snapshots_changed has one second resolution; a value from the current
+    # second may still be followed by another change with the same stamp
+    if changed.isdigit() and int(changed) >= int(time.time()) - 1:
+        return None
+    return changed
+
+def default_directory():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'zfs-rollup')
+
+class Cache(object):
+    def __init__(self, directory=None):
+        self.directory = directory or default_directory()
+        self.databases = {}
+        self.lock = threading.RLock()
+
+    def database(self, dataset):
+        name = pool(dataset)
+        with self.lock:
+            if name not in self.databases:
+                os.makedirs(self.directory, exist_ok=True)
+                database = sqlite3.connect(os.path.join(self.directory, name.replace('/', '_')+'.sqlite'), check_same_thread=False)
+                if database.execute('PRAGMA user_version').fetchone()[0] != schema_version:
+                    database.executescript(schema)
+                    database.execute('PRAGMA user_version = %d' % schema_version)
+                    database.commit()
+                self.databases[name] = database
+            return self.databases[name]
+
+    def close(self):
+        with self.lock:
+            for database in self.databases.values():
+                database.close()
+            self.databases = {}
+
+    def stream(self, datasets, recursive=False, types=None, properties=None):
+        """Yield a single-dataset Inventory for each dataset below the given roots.
+
+        A drop-in replacement for inventory.stream() that serves unchanged
+        datasets from the cache. 'types' and 'properties' are accepted for
+        compatibility; the cached properties, 'written' among them, are always
+        returned.
+        """
+        for root in datasets:
+            found = {}
+            for name,property,value in zfs.get(root, ('guid', 'snapshots_changed'), types='filesystem,volume', recursive=recursive):
+                found.setdefault(name, {})[property] = value
+            self.forget(root, recursive, set(values['guid'] for values in found.values()))
+            # dataset -> ({(createtxg, guid): (name, userrefs)}, bookmark guids)
+            listed = {}
+            for name, snapshot_guid, txg, refs in zfs.listing(root, ('name', 'guid', 'createtxg', 'userrefs'),
+                    types='snapshot,bookmark', depth=None if recursive else 1):
+                bookmark = '@' not in name
+                dataset, _, short = name.partition('#' if bookmark else '@')
+                snapshots, bookmarks = listed.setdefault(dataset, ({}, set()))
+                if bookmark:
+                    bookmarks.add(snapshot_guid)
+                else:
+                    snapshots[(int(txg), snapshot_guid)] = (short, int(refs) if refs.isdigit() else 0)
+            for dataset in found:
+                snapshots = self.refresh(dataset, found[dataset]['guid'], found[dataset].get('snapshots_changed', '-'),
+                    *listed.get(dataset, ({}, set())))
+                if len(snapshots):
+                    yield Inventory().add(dataset, snapshots)
+
+    def forget(self, root, recursive, guids):
+        # drop datasets below 'root' that no longer exist
+        with self.lock:
+            database = self.database(root)
+            rows = database.execute('SELECT guid, name FROM datasets').fetchall()
+            for guid, name in rows:
+                below = name == root or (recursive and name.startswith(root+'/'))
+                if below and guid not in guids:
+                    database.execute('DELETE FROM snapshots WHERE dataset = ?', (guid,))
+                    database.execute('DELETE FROM bookmarks WHERE dataset = ?', (guid,))
+                    database.execute('DELETE FROM datasets WHERE guid = ?', (guid,))
+            database.commit()
+
+    def refresh(self, dataset, guid, changed, snapshots, bookmarks):
+        """Bring the cached snapshots of one dataset up to date and return them.
+
+        'snapshots' maps (createtxg, guid) of each listed snapshot to its
+        name and hold count, 'bookmarks' holds the bookmark guids.
+        """
+        with self.lock:
+            database = self.database(dataset)
+            row = database.execute('SELECT snapshots_changed FROM datasets WHERE guid = ?', (guid,)).fetchone()
+            cached = {}
+            holds = {}
+            for txg, snapshot_guid, name, userrefs in database.execute(
+                    'SELECT createtxg, guid, name, userrefs FROM snapshots WHERE dataset = ?', (guid,)):
+                cached[(txg, snapshot_guid)] = name
+                holds[(txg, snapshot_guid)] = userrefs
+
+        listed = dict((key, name) for key, (name, refs) in snapshots.items())
+        stale = set()
+        new = ()
+        if row is None or changed == '-' or row[0] != changed:
+            order = sorted(set(cached) | set(listed))
+            gone = [key for key in cached if key not in listed]
+            # anything not cached was created after the last seen txg
+            new = [key for key in listed if key not in cached]
+            renamed = [key for key in listed if key in cached and cached[key] != listed[key]]
+
+            # the surviving neighbours of destroyed snapshots may have gained
+            # unique space, and the next one took over what they had written
+            previous = None
+            pending = False
+            for key in order:
+                if key in listed:
+                    if pending:
+                        stale.add(key)
+                        pending = False
+                    previous = key
+                else:
+                    if previous is not None:
+                        stale.add(previous)
+                    pending = True
+
+            with self.lock:
+                database.executemany('DELETE FROM snapshots WHERE dataset = ? AND createtxg = ? AND guid = ?',
+                    [(guid, txg, snapshot_guid) for txg, snapshot_guid in gone])
+                database.executemany('UPDATE snapshots SET name = ? WHERE dataset = ? AND createtxg = ? AND guid = ?',
+                    [(listed[key], guid, key[0], key[1]) for key in renamed])
+                database.execute('INSERT OR REPLACE INTO datasets (guid, name, snapshots_changed) VALUES (?, ?, ?)', (guid, dataset, settled(changed)))
+                database.commit()
+
+            if new:
+                self.fetch(dataset, guid, dict((key, listed[key]) for key in new), properties, insert=True)
+                # the previous newest snapshot kept gaining space until the next one was taken
+                survivors = [key for key in cached if key in listed]
+                if survivors:
+                    stale.add(max(survivors))
+            stale.difference_update(new)
+            cached = listed
+        else:
+            with self.lock:
+                database.execute('UPDATE datasets SET name = ? WHERE guid = ?', (dataset, guid))
+                database.commit()
+
+        # holds and bookmarks come and go without moving snapshots_changed
+        with self.lock:
+            database.executemany('UPDATE snapshots SET userrefs = ? WHERE dataset = ? AND createtxg = ? AND guid = ?',
+                [(refs, guid, key[0], key[1]) for key, (name, refs) in snapshots.items() if refs != holds.get(key, 0)])
+            database.execute('DELETE FROM bookmarks WHERE dataset = ?', (guid,))
+            database.executemany('INSERT INTO bookmarks (dataset, guid) VALUES (?, ?)', [(guid, mark) for mark in bookmarks])
+            database.commit()
+
+        # the newest snapshot shares its blocks with the live filesystem
+        if cached and not new:
+            stale.add(max(cached))
+        # clearempty --predict trusts 'written', so it is re-read with 'used'
+        self.fetch(dataset, guid, dict((key, cached[key]) for key in stale), ('used', 'written'))
+
+        return self.load(dataset, guid)
+
+    def fetch(self, dataset, guid, snapshots, properties, insert=False):
+        # read 'properties' of the given {(createtxg, guid): name} snapshots
+        if not snapshots:
+            return
+        names = dict((name, key) for key, name in snapshots.items())
+        if len(names) > chunk:
+            # cheaper to read the whole dataset once than name by name
+            rows = zfs.get(dataset, properties, types='snapshot', depth=1)
+        else:
+            rows = zfs.get([dataset+'@'+name for name in sorted(names)], properties, recursive=False)
+
+        values = dict((key, {}) for key in snapshots)
+        for name,property,value in rows:
+            key = names.get(name.split('@', 1)[-1])
+            if key is not None:
+                values[key][columns[property]] = convert(property, value)
+
+        with self.lock:
+            database = self.database(dataset)
+            for key, found in values.items():
+                if insert:
+                    database.execute('INSERT OR REPLACE INTO snapshots (dataset, createtxg, guid, name) VALUES (?, ?, ?, ?)',
+                        (guid, key[0], key[1], snapshots[key]))
+                for column, value in found.items():
+                    database.execute('UPDATE snapshots SET %s = ? WHERE dataset = ? AND createtxg = ? AND guid = ?' % column,
+                        (value, guid, key[0], key[1]))
+            database.commit()
+
+    def load(self, dataset, guid):
+        snapshots = Snapshots()
+        with self.lock:
+            database = self.database(dataset)
+            rows = database.execute(
+                'SELECT name, creation, used, type, state, written, guid, userrefs FROM snapshots WHERE dataset = ? ORDER BY createtxg, guid',
+                (guid,)).fetchall()
+            bookmarks = database.execute('SELECT guid FROM bookmarks WHERE dataset = ?', (guid,)).fetchall()
+        for name, creation, used, type, state, written, snapshot_guid, userrefs in rows:
+            snapshots.append(name, creation, used, type, state, written, int(snapshot_guid), userrefs)
+        snapshots.bookmarks = set(int(mark) for mark, in bookmarks)
+        return snapshots.sorted()
+
+def source(args):
+    """The dataset listing to use for parsed command line 'args': cached with --cache, live otherwise."""
+    if not getattr(args, 'cache', False):
+        return stream
+    return Cache(args.cache_dir).stream
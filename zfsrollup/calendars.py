@@ -0,0 +1,123 @@
+# zfsrollup/calendars.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Calendar buckets (hourly, daily, weekly, monthly, yearly) in a time zone.
+#
+# Rather than formatting every snapshot's creation time, the instants at
+# which buckets start are worked out once per zone with zoneinfo, for whole
+# years around the snapshots seen so far, and a snapshot's bucket is found
+# by binary search. A bucket is keyed by the instant it starts. Days are
+# local days, so around a DST change they last 23 or 25 hours, and a
+# repeated hour is two hourly buckets. Weeks start on Monday, and a new
+# year starts a new week, as '%Y-%W' does.
+
+import bisect
+import datetime
+import os
+import threading
+
+try:
+    import zoneinfo
+except ImportError:
+    zoneinfo = None
+
+utc = datetime.timezone.utc
+
+def zone(name=None):
+    """The tzinfo for --timezone 'name': UTC by default, 'local' for the system zone.
+
+    Raises ValueError for an unknown zone.
+    """
+    if not name or name.upper() == 'UTC':
+        return utc
+    if zoneinfo is None:
+        raise ValueError("time zones other than UTC need Python 3.9 (zoneinfo)")
+    try:
+        if name == 'local':
+            if os.environ.get('TZ'):
+                return zoneinfo.ZoneInfo(os.environ['TZ'].lstrip(':'))
+            with open('/etc/localtime', 'rb') as f:
+                return zoneinfo.ZoneInfo.from_file(f, key='localtime')
+        return zoneinfo.ZoneInfo(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError, IOError):
+        raise ValueError("unknown time zone: %s" % name)
+
+def _hours(zone, day):
+    start = _start(zone, day)
+    if _start(zone, day + datetime.timedelta(days=1)) - start == 86400:
+        return [start + 3600*hour for hour in range(24)]
+    # the clocks change today: a repeated hour starts twice, and a skipped
+    # one maps onto the next
+    return [_start(zone, day, hour, fold) for hour in range(24) for fold in (0, 1)]
+
+def _start(zone, day, hour=0, fold=0):
+    return int(datetime.datetime(day.year, day.month, day.day, hour, tzinfo=zone, fold=fold).timestamp())
+
+# strftime reference -> the bucket starts within one local day
+units = {
+    '%Y-%m-%d %H' : _hours,
+    '%Y-%m-%d'    : lambda zone, day: [_start(zone, day)],
+    '%Y-%W'       : lambda zone, day: [_start(zone, day)] if day.weekday() == 0 or (day.month, day.day) == (1, 1) else [],
+    '%Y-%m'       : lambda zone, day: [_start(zone, day)] if day.day == 1 else [],
+    '%Y'          : lambda zone, day: [_start(zone, day)] if (day.month, day.day) == (1, 1) else [],
+}
+
+class Calendar(object):
+    """Bucket starts of one strftime 'reference' in one zone, extended as needed."""
+
+    def __init__(self, reference, zone):
+        self.reference = reference
+        self.zone = zone
+        # (bucket starts, first covered day, day after the last, and the
+        # instants those days start), replaced as a whole so readers never
+        # see it half extended
+        self.covered = ([], None, None, None, None)
+        self.lock = threading.Lock()
+        self.array = None
+
+    def cover(self, low, high):
+        """The sorted bucket starts, known at least for epochs 'low' to 'high'."""
+        starts, first, end, earliest, latest = self.covered
+        if first is not None and earliest <= low and high < latest:
+            return starts
+        with self.lock:
+            starts, first, end, earliest, latest = self.covered
+            # whole years, starting on January 1st, which begins a bucket of every unit
+            years = [datetime.datetime.fromtimestamp(epoch, self.zone).year for epoch in (low, high)]
+            new_first = datetime.date(years[0] - 1, 1, 1)
+            new_end = datetime.date(years[1] + 2, 1, 1)
+            if first is not None:
+                new_first, new_end = min(first, new_first), max(end, new_end)
+            day, found = new_first, set()
+            while day < new_end:
+                found.update(units[self.reference](self.zone, day))
+                day += datetime.timedelta(days=1)
+            starts = sorted(found)
+            self.covered = (starts, new_first, new_end, _start(self.zone, new_first), _start(self.zone, new_end))
+            self.array = None
+            return starts
+
+    def key(self, epoch):
+        """The start of the bucket holding 'epoch'."""
+        starts = self.cover(epoch, epoch)
+        return starts[bisect.bisect_right(starts, epoch) - 1]
+
+    def keys(self, epochs):
+        """The bucket start for each of the ascending NumPy 'epochs'."""
+        import numpy
+        starts = self.cover(int(epochs[0]), int(epochs[-1]))
+        array = self.array
+        if array is None or len(array) != len(starts):
+            array = self.array = numpy.array(starts, dtype=numpy.int64)
+        return array[numpy.searchsorted(array, epochs, side='right') - 1]
+
+_calendars = {}
+_lock = threading.Lock()
+
+def calendar(reference, zone=utc):
+    """The shared Calendar for 'reference' (one of 'units') in 'zone'."""
+    with _lock:
+        if (reference, zone) not in _calendars:
+            _calendars[(reference, zone)] = Calendar(reference, zone)
+        return _calendars[(reference, zone)]
@@ -0,0 +1,318 @@
+# zfsrollup/daemon.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Keep rollup running and re-plan incrementally as snapshots arrive.
+#
+# Each dataset is planned in full once. After that its Retention buckets
+# stay in memory and only snapshots created since the last poll are fed to
+# them. A dataset's 'snapshots_changed' property tells whether anything
+# happened at all, so an unchanged dataset costs one property read. If it
+# did change, its snapshots are listed newest first by createtxg and the
+# listing is abandoned as soon as it reaches one already seen. zfs sorts
+# in userspace, so it still reads every snapshot of the dataset before the
+# first line arrives; what is saved is parsing and planning them.
+#
+# Buckets only ever move forward, so a snapshot that drops out of every
+# bucket is never held again and can be destroyed unless it is protected.
+# Protected ones (the newest snapshot, and NEW or LATEST replication
+# states) wait until the protection lifts. Holds and bookmarks can appear
+# at any time, so they are read again right before anything is destroyed.
+#
+# A chain of period buckets (2h:12) is anchored to the snapshot that opened
+# it, while a full plan starts the chain from the snapshots that are left.
+# So once anything is destroyed, the period chains of its rule are built
+# again from the surviving snapshots before new ones are added. That takes
+# no zfs calls but walks every tracked snapshot of the rule, so with period
+# intervals a poll that follows a destroy costs time in proportion to the
+# snapshots kept, not to the new ones. Calendar buckets are not rebuilt.
+
+import sys
+
+from . import stats, zfs
+from .inventory import Inventory, Snapshots
+from .retention import Retention, batch_targets, protected
+
+fields = ('name', 'createtxg', 'creation', 'used', 'freenas:state', 'guid', 'userrefs')
+
+class Tracked(object):
+    # Retention state of one dataset. Snapshots get increasing ids in
+    # creation order; the names, creation times and guids of those still on
+    # disk are kept, so that the buckets can be filled again from them and
+    # bookmarks matched against them.
+    __slots__ = ('policy', 'retentions', 'periodic', 'stale', 'names', 'epochs', 'guids', 'states', 'pending', 'count', 'newest', 'epoch', 'txg', 'seen', 'changed')
+
+    def __init__(self, policy, changed):
+        self.policy = policy
+        self.retentions = self.empty()
+        # only chains of period buckets depend on the destroyed snapshots:
+        # rule -> its period intervals, for the rules that have any
+        self.periodic = {}
+        for rule, retention in self.retentions.items():
+            periods = dict((interval, definition) for interval, definition in retention.intervals.items() if 'reference' not in definition)
+            if periods:
+                self.periodic[rule] = periods
+        # the rules whose chains lost a snapshot
+        self.stale = set()
+        self.names = {}
+        self.epochs = {}
+        self.guids = {}
+        self.states = {}
+        self.pending = set()
+        self.count = 0
+        self.newest = None
+        self.epoch = None
+        self.txg = 0
+        self.seen = set()
+        self.changed = changed
+
+    def empty(self):
+        # rule prefix (None for the shared intervals) -> Retention
+        retentions = {None: Retention({} if self.policy.clear else self.policy.intervals)}
+        for rule in self.policy.rules:
+            retentions[rule] = Retention({} if self.policy.clear else self.policy.rules[rule])
+        return retentions
+
+    def held(self, i):
+        return any(i in retention.holders for retention in self.retentions.values())
+
+    def destroyed(self, i):
+        rule = self.policy.rule(self.names[i])
+        if rule in self.periodic:
+            self.stale.add(rule)
+        self.pending.discard(i)
+        self.states.pop(i, None)
+        del self.names[i]
+        del self.epochs[i]
+        del self.guids[i]
+
+    def refill(self):
+        # the period chains a full plan of the surviving snapshots would
+        # build. Calendar buckets are left alone: the snapshots holding them
+        # all survive, and a full plan would keep the same newest buckets.
+        for rule in self.stale:
+            periods = self.periodic[rule]
+            retention = self.retentions[rule]
+            chains = Retention(periods)
+            # ids were handed out, and so inserted, in creation order
+            for i, name in self.names.items():
+                if self.policy.rule(name) == rule:
+                    chains.add(i, self.epochs[i])
+            changed = set(chains.holders)
+            for i in list(retention.holders):
+                if not retention.holders[i].isdisjoint(periods):
+                    changed.add(i)
+                    retention.holders[i].difference_update(periods)
+                    if not retention.holders[i]:
+                        del retention.holders[i]
+            for interval in periods:
+                retention.buckets[interval] = chains.buckets[interval]
+            for i, intervals in chains.holders.items():
+                retention.holders[i].update(intervals)
+            for i in changed:
+                if self.held(i):
+                    self.pending.discard(i)
+                elif self.policy.matches(self.names[i]):
+                    self.pending.add(i)
+        self.stale = set()
+
+class Daemon(object):
+    def __init__(self, roots, policy, args, initial):
+        """Follow the datasets below 'roots'.
+
+        'initial(inventory, out)' plans and prunes a dataset in full the
+        first time it is seen, as a normal rollup run does. 'args' supplies
+        the recursive, test, verbose, batch and bookmark options.
+        """
+        self.roots = roots
+        self.policy = policy
+        self.args = args
+        self.initial = initial
+        self.tracked = {}
+
+    def poll(self, out=sys.stdout):
+        """Pick up new snapshots of every dataset and destroy what they push out."""
+        found = {}
+        for root in self.roots:
+            for name,property,value in zfs.get(root, ('snapshots_changed',), types='filesystem,volume', recursive=self.args.recursive):
+                found[name] = value
+
+        for dataset in list(self.tracked):
+            if dataset not in found:
+                del self.tracked[dataset]
+
+        for dataset, changed in found.items():
+            state = self.tracked.get(dataset)
+            if state is None:
+                self.start(dataset, changed, out)
+            elif changed == '-' or changed != state.changed:
+                state.changed = changed
+                if not self.update(dataset, state):
+                    # out of order snapshots: plan the dataset from scratch
+                    self.start(dataset, changed, out)
+                    continue
+            state = self.tracked.get(dataset)
+            if state is not None and state.pending:
+                self.settle(dataset, state, out)
+
+    def start(self, dataset, changed, out):
+        # full plan of one dataset, then keep its buckets
+        with stats.phase('list'):
+            rows = list(zfs.listing(dataset, fields, types='snapshot,bookmark', sort='createtxg'))
+        snapshots = Snapshots()
+        for row in rows:
+            if '@' not in row[0]:
+                snapshots.bookmarks.add(int(row[5]))
+        rows = [row for row in rows if '@' in row[0]]
+        for name,txg,creation,used,status,guid,userrefs in rows:
+            snapshots.append(name.split('@', 1)[1], type='snapshot')
+            snapshots.set('creation', creation)
+            snapshots.set('used', used)
+            snapshots.set('freenas:state', status)
+            snapshots.set('guid', guid)
+            snapshots.set('userrefs', userrefs)
+        snapshots = snapshots.sorted()
+        if len(snapshots):
+            self.initial(Inventory().add(dataset, snapshots), out)
+
+        state = Tracked(self.policy.resolve(dataset), changed)
+        for i in range(len(snapshots)):
+            self.feed(state, snapshots.names[i], snapshots.creation[i], snapshots.states[i], snapshots.guids[i])
+        # unheld snapshots that were not protected were just pruned by the full
+        # plan, unless their destroy or bookmark failed; those stay pending
+        keep = protected(snapshots, state.policy)
+        pruned = [i for i in state.pending if i not in keep]
+        if pruned and not self.args.test:
+            with stats.phase('list'):
+                left = set(name.split('@', 1)[1] for name, in zfs.listing(dataset, ('name',)))
+            failed = [i for i in pruned if state.names[i] in left]
+            if failed:
+                print("\tcannot destroy %d snapshots of %s, will retry" % (len(failed), dataset), file=out)
+            pruned = [i for i in pruned if state.names[i] not in left]
+        for i in pruned:
+            state.destroyed(i)
+        if rows:
+            state.txg = int(rows[-1][1])
+            state.seen = set(row[0] for row in rows if int(row[1]) == state.txg)
+        self.tracked[dataset] = state
+
+    def update(self, dataset, state):
+        # feed the snapshots created since the last poll; False if any of
+        # them is older than a snapshot already fed
+        new = []
+        # zfs reads all snapshots to sort them; only the new ones are parsed
+        rows = zfs.listing(dataset, fields, sort='-createtxg')
+        try:
+            for row in rows:
+                txg = int(row[1])
+                if txg < state.txg:
+                    break
+                if txg == state.txg and row[0] in state.seen:
+                    continue
+                new.append(row)
+        finally:
+            rows.close()
+        if not new:
+            return True
+
+        new.reverse()
+        new.sort(key=lambda row: int(row[2]))
+        if state.epoch is not None and int(new[0][2]) < state.epoch:
+            return False
+        if state.stale:
+            state.refill()
+        for name,txg,creation,used,status,guid,userrefs in new:
+            self.feed(state, name.split('@', 1)[1], int(creation), status if status != '-' else None, int(guid) if guid.isdigit() else 0)
+        state.txg = int(new[-1][1])
+        state.seen = set(row[0] for row in new if int(row[1]) == state.txg)
+        return True
+
+    def feed(self, state, name, epoch, status, guid):
+        # add one snapshot to the buckets; the snapshots it leaves unheld
+        # wait in 'pending' if they match the policy prefixes
+        i = state.count
+        state.count += 1
+        state.names[i] = name
+        state.epochs[i] = epoch
+        state.guids[i] = guid
+        if status:
+            state.states[i] = status
+        state.newest = i
+        state.epoch = epoch
+        retention = state.retentions[state.policy.rule(name)]
+        evicted = retention.add(i, epoch)
+        if i not in retention.holders:
+            evicted.append(i)
+        for e in evicted:
+            if state.policy.matches(state.names[e]):
+                state.pending.add(e)
+
+    def settle(self, dataset, state, out):
+        # destroy pending snapshots whose protection has lifted
+        if state.pending & set(state.states):
+            names = dict((dataset+'@'+state.names[i], i) for i in state.states)
+            try:
+                for name,property,value in zfs.get(sorted(names), ('freenas:state',), recursive=False):
+                    if value == '-':
+                        del state.states[names[name]]
+                    else:
+                        state.states[names[name]] = value
+            except zfs.ZfsError:
+                # something was destroyed behind our back; start over next poll
+                del self.tracked[dataset]
+                return
+        # as in retention.protected(): the newest NEW snapshot other than the newest one
+        new = [i for i in state.states if state.states[i] == 'NEW' and i != state.newest and state.policy.matches(state.names[i])]
+        latest_new = max(new) if new else None
+
+        doomed = sorted(i for i in state.pending
+            if i != state.newest and i != latest_new and state.states.get(i) != 'LATEST')
+        if not doomed:
+            return
+        try:
+            doomed, bookmarks = self.unpinned(dataset, state, doomed)
+        except zfs.ZfsError:
+            del self.tracked[dataset]
+            return
+        if not doomed:
+            return
+        if self.args.bookmark and not self.args.test:
+            pairs = [(dataset+'@'+state.names[i], dataset+'#'+state.names[i]) for i in doomed if state.guids[i] not in bookmarks]
+            if pairs and zfs.bookmarks(pairs):
+                # keep them pending and try again next poll
+                print("cannot bookmark the doomed snapshots of %s, not destroying" % dataset, file=out)
+                return
+
+        print(dataset, file=out)
+        for i in doomed:
+            print("\t","pruning\t", "@"+state.names[i], file=out)
+        targets = [dataset+'@'+state.names[i] for i in doomed]
+        if self.args.batch:
+            targets = batch_targets(targets)
+        failed = set()
+        for to_delete in targets:
+            if self.args.verbose:
+                print('zfs destroy ' + to_delete, file=out)
+            if not self.args.test and zfs.destroy(to_delete):
+                # zfs destroys all of a target or none of it; keep them pending
+                print("\tcannot destroy %s, will retry" % to_delete, file=out)
+                failed.update(to_delete.split('@', 1)[1].split(','))
+        destroyed = [i for i in doomed if state.names[i] not in failed]
+        stats.dataset(dataset, pruned=len(destroyed))
+        for i in destroyed:
+            state.destroyed(i)
+
+    def unpinned(self, dataset, state, doomed):
+        # 'doomed' without the snapshots that retention.replicated() keeps,
+        # and the guids of the dataset's bookmarks. Only the doomed
+        # snapshots' holds are read, and the newest bookmarked snapshot is
+        # looked for among the tracked ones, which are all those still on disk.
+        names = dict((dataset+'@'+state.names[i], i) for i in doomed)
+        held = set()
+        for name,property,value in zfs.get(sorted(names), ('userrefs',), recursive=False):
+            if value.isdigit() and int(value):
+                held.add(names[name])
+        bookmarks = set(int(guid) for guid, in zfs.listing(dataset, ('guid',), types='bookmark') if guid.isdigit())
+        based = [i for i in state.guids if state.guids[i] in bookmarks]
+        base = max(based) if based else None
+        return [i for i in doomed if i not in held and i != base], bookmarks
@@ -0,0 +1,308 @@
+# zfsrollup/fake.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# An in-memory pool that answers the same queries as the zfs command line
+# tool, for benchmarks and for trying out retention policies without
+# touching real data.
+#
+# Snapshots are kept in creation order per dataset, and only the properties
+# the scripts read are modelled. Space accounting is simplified: a
+# snapshot's 'used' is what destroying it frees, and destroying one does not
+# move space to its neighbours. Bookmarks and user holds are modelled as far
+# as listing them, and refusing to destroy held snapshots, goes. Bookmarks
+# are named 'dataset#bookmark' by the queries and '#bookmark' internally.
+
+import json
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from .zfs import ZfsError
+
+class FakeSnapshot(object):
+    __slots__ = ('guid', 'createtxg', 'creation', 'used', 'written', 'properties')
+
+    def __init__(self, guid, createtxg, creation, used=0, written=0, properties=None):
+        self.guid = guid
+        self.createtxg = createtxg
+        self.creation = creation
+        self.used = used
+        self.written = written
+        # user properties such as 'freenas:state'
+        self.properties = properties
+
+class FakeDataset(object):
+    __slots__ = ('guid', 'type', 'snapshots', 'bookmarks', 'changed')
+
+    def __init__(self, guid, type='filesystem'):
+        self.guid = guid
+        self.type = type
+        # snapshot name -> FakeSnapshot, oldest first
+        self.snapshots = OrderedDict()
+        # bookmark name -> the FakeSnapshot it was made from
+        self.bookmarks = OrderedDict()
+        self.changed = None
+
+# snapshot properties stored as attributes
+numeric = ('guid', 'createtxg', 'creation', 'used', 'written')
+
+def guid(name):
+    # stable across runs, so a saved pool keeps its identity
+    return str(zlib.crc32(name.encode()) << 32 | zlib.adler32(name.encode()))
+
+class FakeBackend(object):
+    """An in-memory pool, usable wherever zfs.CliBackend is."""
+
+    def __init__(self):
+        # dataset name -> FakeDataset
+        self.datasets = {}
+        self.txg = 0
+        # pool -> background freeing backlog in bytes, and I/O wait in seconds
+        self.backlog = {}
+        self.waits = {}
+        self.lock = threading.RLock()
+
+    def create(self, dataset, type='filesystem'):
+        """Create 'dataset' and any missing parents."""
+        with self.lock:
+            parts = dataset.split('/')
+            for depth in range(1, len(parts) + 1):
+                name = '/'.join(parts[:depth])
+                if name not in self.datasets:
+                    self.datasets[name] = FakeDataset(guid(name), type if name == dataset else 'filesystem')
+            return self.datasets[dataset]
+
+    def snapshot(self, dataset, name, creation=None, used=0, written=0, **properties):
+        """Take snapshot 'dataset@name'; snapshots must be taken oldest first."""
+        with self.lock:
+            self.txg += 1
+            target = self.create(dataset) if dataset not in self.datasets else self.datasets[dataset]
+            target.snapshots[name] = FakeSnapshot(guid(dataset+'@'+name), self.txg,
+                int(time.time()) if creation is None else int(creation), int(used), int(written), properties or None)
+            target.changed = self.txg
+
+    def bookmark(self, snapshot, bookmark):
+        """Bookmark 'dataset@snapshot' as 'dataset#bookmark', returning the exit code like zfs."""
+        with self.lock:
+            dataset, _, name = snapshot.partition('@')
+            target = self.datasets.get(dataset)
+            if target is None or name not in target.snapshots or bookmark.partition('#')[0] != dataset:
+                print("cannot bookmark '%s': snapshot does not exist" % snapshot, file=sys.stderr)
+                return 1
+            tag = '#' + bookmark.partition('#')[2]
+            if tag in target.bookmarks:
+                print("cannot create bookmark '%s': bookmark exists" % bookmark, file=sys.stderr)
+                return 1
+            snap = target.snapshots[name]
+            target.bookmarks[tag] = FakeSnapshot(snap.guid, snap.createtxg, snap.creation)
+        return 0
+
+    def bookmarks(self, pairs):
+        """Bookmark each (snapshot, bookmark) of 'pairs' until one fails, like the zfs backend."""
+        for snapshot, bookmark in pairs:
+            returncode = self.bookmark(snapshot, bookmark)
+            if returncode:
+                return returncode
+        return 0
+
+    def hold(self, snapshot):
+        """Add a user hold to 'dataset@snapshot'."""
+        with self.lock:
+            dataset, _, name = snapshot.partition('@')
+            snap = self.datasets[dataset].snapshots[name]
+            snap.properties = dict(snap.properties or {}, userrefs=int((snap.properties or {}).get('userrefs', 0)) + 1)
+
+    def value(self, dataset, snapshot, property):
+        # the 'zfs get -p' value of one property, '-' when it does not apply
+        target = self.datasets[dataset]
+        if snapshot is not None and snapshot.startswith('#'):
+            mark = target.bookmarks[snapshot]
+            if property == 'type':
+                return 'bookmark'
+            if property in ('guid', 'createtxg', 'creation'):
+                return str(getattr(mark, property))
+            return '-'
+        if snapshot is None:
+            if property == 'type':
+                return target.type
+            if property == 'guid':
+                return target.guid
+            if property == 'snapshots_changed':
+                return '-' if target.changed is None else str(target.changed)
+            if property == 'usedbysnapshots':
+                return str(sum(snap.used for snap in target.snapshots.values()))
+            return '-'
+        snap = target.snapshots[snapshot]
+        if property == 'type':
+            return 'snapshot'
+        if property in numeric:
+            return str(getattr(snap, property))
+        if snap.properties and property in snap.properties:
+            return str(snap.properties[property])
+        if property == 'userrefs':
+            return '0'
+        return '-'
+
+    def select(self, dataset, types=None, recursive=True, depth=None):
+        # (dataset, snapshot or None) in 'zfs get' order: each dataset followed by its snapshots
+        names = [dataset] if isinstance(dataset, str) else list(dataset)
+        types = (types or 'all').split(',')
+        found = []
+        with self.lock:
+            for root in names:
+                if '#' in root:
+                    root_dataset, snapshot = root.split('#', 1)
+                    snapshot = '#' + snapshot
+                    exists = root_dataset in self.datasets and snapshot in self.datasets[root_dataset].bookmarks
+                else:
+                    root_dataset, _, snapshot = root.partition('@')
+                    exists = root_dataset in self.datasets and (not snapshot or snapshot in self.datasets[root_dataset].snapshots)
+                if not exists:
+                    print("cannot open '%s': dataset does not exist" % root, file=sys.stderr)
+                    return found, False
+                if snapshot:
+                    found.append((root_dataset, snapshot))
+                    continue
+                limit = depth if depth is not None else float('inf') if recursive else 0
+                below = sorted(name for name in self.datasets if name == root or name.startswith(root+'/'))
+                for name in below:
+                    level = name.count('/') - root.count('/')
+                    if level > limit:
+                        continue
+                    if 'all' in types or self.datasets[name].type in types:
+                        found.append((name, None))
+                    if level < limit and ('all' in types or 'snapshot' in types):
+                        found.extend((name, snapshot) for snapshot in self.datasets[name].snapshots)
+                    if level < limit and ('all' in types or 'bookmark' in types):
+                        found.extend((name, bookmark) for bookmark in self.datasets[name].bookmarks)
+        return found, True
+
+    def rows(self, found, fields, name_field=False):
+        # values are read as the rows are consumed, like the zfs pipe;
+        # anything destroyed in the meantime is skipped
+        for dataset, snapshot in found:
+            name = dataset if snapshot is None else dataset+snapshot if snapshot.startswith('#') else dataset+'@'+snapshot
+            with self.lock:
+                try:
+                    values = [name if field == 'name' else self.value(dataset, snapshot, field) for field in fields]
+                except KeyError:
+                    continue
+            if name_field:
+                yield values
+            else:
+                for field, value in zip(fields, values):
+                    yield [name, field, value]
+
+    def get(self, dataset, properties, types=None, recursive=True, depth=None):
+        found, ok = self.select(dataset, types, recursive, depth)
+        for row in self.rows(found, properties):
+            yield row
+        if not ok:
+            raise ZfsError('get', 1)
+
+    def listing(self, dataset, fields, types='snapshot', depth=1, sort=None):
+        found, ok = self.select(dataset, types, True, depth)
+        if sort:
+            with self.lock:
+                values = [self.value(dataset, snapshot, sort.lstrip('-')) for dataset, snapshot in found]
+                order = sorted(range(len(found)), key=lambda i: int(values[i]) if values[i].isdigit() else 0, reverse=sort.startswith('-'))
+                found = [found[i] for i in order]
+        for row in self.rows(found, fields, name_field=True):
+            yield row
+        if not ok:
+            raise ZfsError('list', 1)
+
+    def expand(self, target):
+        # the snapshot names a destroy target covers, in creation order
+        dataset, _, spec = target.partition('@')
+        if dataset not in self.datasets:
+            return None, []
+        names = list(self.datasets[dataset].snapshots)
+        positions = dict((name, i) for i, name in enumerate(names))
+        covered = set()
+        for part in spec.split(','):
+            if '%' in part:
+                first, last = part.split('%', 1)
+                if (first and first not in positions) or (last and last not in positions):
+                    return dataset, []
+                covered.update(range(positions[first] if first else 0, positions[last] + 1 if last else len(names)))
+            elif part in positions:
+                covered.add(positions[part])
+        return dataset, [names[i] for i in sorted(covered)]
+
+    def destroy(self, target, flags=()):
+        with self.lock:
+            dataset, names = self.expand(target)
+            if not names:
+                print("could not find any snapshots to destroy; check snapshot names.", file=sys.stderr)
+                return 1
+            snapshots = self.datasets[dataset].snapshots
+            held = [name for name in names if int((snapshots[name].properties or {}).get('userrefs', 0))]
+            if held:
+                # the whole batch fails, as with lzc_destroy_snaps()
+                print("cannot destroy snapshot %s@%s: dataset is busy" % (dataset, held[0]), file=sys.stderr)
+                return 1
+            if 'n' in ''.join(flags):
+                return 0
+            for name in names:
+                del snapshots[name]
+            self.txg += 1
+            self.datasets[dataset].changed = self.txg
+        return 0
+
+    def reclaim(self, target):
+        with self.lock:
+            dataset, names = self.expand(target)
+            if not names:
+                raise ZfsError('destroy -nvp', 1)
+            snapshots = self.datasets[dataset].snapshots
+            return sum(snapshots[name].used for name in names)
+
+    def freeing(self, pool):
+        return self.backlog.get(pool, 0)
+
+    def latency(self, pool):
+        return self.waits.get(pool, 0.0)
+
+    @classmethod
+    def load(cls, path):
+        """Read a pool saved by save(): {"dataset": {}, "dataset@snapshot": {property: value},
+        "dataset#bookmark": {"guid": ..., "createtxg": ..., "creation": ...}}."""
+        fake = cls()
+        with open(path) as f:
+            entries = json.load(f)
+        snapshots = []
+        bookmarks = []
+        for name, values in entries.items():
+            if '@' in name:
+                snapshots.append((int(values.get('createtxg', 0)), int(values.get('creation', 0)), name, values))
+            elif '#' in name:
+                bookmarks.append((name, values))
+            else:
+                fake.create(name, values.get('type', 'filesystem'))
+        for createtxg, creation, name, values in sorted(snapshots):
+            dataset, _, snapshot = name.partition('@')
+            extra = dict((key, value) for key, value in values.items() if key not in numeric + ('type',))
+            fake.snapshot(dataset, snapshot, creation, values.get('used', 0), values.get('written', 0), **extra)
+        for name, values in bookmarks:
+            dataset, _, bookmark = name.partition('#')
+            fake.create(dataset).bookmarks['#'+bookmark] = FakeSnapshot(str(values.get('guid', 0)),
+                int(values.get('createtxg', 0)), int(values.get('creation', 0)))
+        return fake
+
+    def save(self, path):
+        with self.lock:
+            entries = OrderedDict()
+            for name in sorted(self.datasets):
+                entries[name] = {'type': self.datasets[name].type}
+                for snapshot, snap in self.datasets[name].snapshots.items():
+                    values = OrderedDict((key, getattr(snap, key)) for key in numeric[1:])
+                    values.update(snap.properties or {})
+                    entries[name+'@'+snapshot] = values
+                for bookmark, mark in self.datasets[name].bookmarks.items():
+                    entries[name+bookmark] = OrderedDict((key, getattr(mark, key)) for key in ('guid', 'createtxg', 'creation'))
+        with open(path, 'w') as f:
+            json.dump(entries, f, indent=1)
@@ -0,0 +1,190 @@
+# zfsrollup/fleet.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Prune many hosts from one place.
+#
+# Targets are named HOST:DATASET. Every host gets a single ssh master
+# connection (ControlMaster) and each zfs command runs as a session
+# multiplexed over it, so only the first command pays for the handshake.
+# At most 'sessions' commands run on a host at once, below sshd's default
+# MaxSessions of 10. Hosts are worked on concurrently, each from its own
+# thread with its backend selected by zfs.using(), so a fleet takes about
+# as long as its slowest host. Planning happens locally; only listings and
+# destroys go over the wire.
+
+import argparse
+import io
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import zfs
+from .cache import default_directory
+from .fake import FakeBackend
+
+class SshBackend(zfs.CliBackend):
+    """Run zfs and zpool on 'host' over one multiplexed ssh connection."""
+
+    # ssh passes the whole command as one string, which must fit the limit
+    # of a single argument: the destroy target plus 'zfs destroy -nvp ' and
+    # the quotes shlex adds around a name with a space
+    overhead = len("zfs destroy -nvp ''")
+
+    def __init__(self, host, control, sessions=8):
+        self.host = host
+        # socket of the master connection
+        self.control = control
+        # a streamed listing and a destroy may be open at once in one thread
+        self.sessions = threading.BoundedSemaphore(max(2, sessions))
+
+    def ssh(self, *arguments):
+        return ['ssh', '-o', 'BatchMode=yes', '-o', 'ControlPath='+self.control] + list(arguments)
+
+    def connect(self):
+        """Open the master connection; raises ValueError if the host cannot be reached."""
+        # the master outlives this command in the background; it must not
+        # hold our stdout open, and gives up by itself if close() is missed
+        try:
+            returncode = subprocess.call(self.ssh('-o', 'ControlMaster=yes', '-o', 'ControlPersist=600', '-fN', self.host),
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+        except OSError as e:
+            raise ValueError("cannot run ssh: %s" % e)
+        if returncode:
+            raise ValueError("cannot connect to %s (ssh exited with %d)" % (self.host, returncode))
+
+    def close(self):
+        subprocess.call(self.ssh('-O', 'exit', self.host), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def argv(self, program, command):
+        # ssh hands the remote shell a single string
+        return self.ssh('-o', 'ControlMaster=no', self.host, ' '.join(shlex.quote(word) for word in [program] + command))
+
+    def _rows(self, command, fields, program="zfs"):
+        with self.sessions:
+            yield from zfs.CliBackend._rows(self, command, fields, program)
+
+    def destroy(self, target, flags=()):
+        with self.sessions:
+            return zfs.CliBackend.destroy(self, target, flags)
+
+    def bookmark(self, snapshot, bookmark):
+        with self.sessions:
+            return zfs.CliBackend.bookmark(self, snapshot, bookmark)
+
+    def bookmarks(self, pairs):
+        # one session runs as many 'zfs bookmark' commands as fit its command line
+        commands = [' '.join(shlex.quote(word) for word in ['zfs', 'bookmark', snapshot, bookmark]) for snapshot, bookmark in pairs]
+        limit = zfs.arg_limit() + self.overhead
+        while commands:
+            size = len(commands[0])
+            count = 1
+            while count < len(commands) and size + len(' && ') + len(commands[count]) <= limit:
+                size += len(' && ') + len(commands[count])
+                count += 1
+            with self.sessions:
+                returncode = subprocess.call(self.ssh('-o', 'ControlMaster=no', self.host, ' && '.join(commands[:count])))
+            if returncode:
+                return returncode
+            commands = commands[count:]
+        return 0
+
+    def reclaim(self, target):
+        with self.sessions:
+            return zfs.CliBackend.reclaim(self, target)
+
+class FakeHost(FakeBackend):
+    """A host whose pool is kept in a JSON file, standing in for SshBackend."""
+
+    path = None
+
+    def connect(self):
+        pass
+
+    def close(self):
+        if self.path:
+            self.save(self.path)
+
+def targets(names):
+    """Group HOST:DATASET names by host, in the order given.
+
+    Raises ValueError for a name without a host.
+    """
+    hosts = OrderedDict()
+    for name in names:
+        host, colon, dataset = name.partition(':')
+        if not colon or not host or not dataset:
+            raise ValueError("fleet datasets are given as HOST:DATASET, not %s" % name)
+        hosts.setdefault(host, []).append(dataset)
+    return hosts
+
+def connect(host, args, control):
+    """A connected backend for 'host', as selected by --backend and --fake-pool in 'args'.
+
+    With the fake backend, --fake-pool names a directory holding one
+    HOST.json pool per host. Raises ValueError if the host cannot be used.
+    """
+    name = getattr(args, 'backend', None) or 'cli'
+    if name == 'cli':
+        backend = SshBackend(host, control, getattr(args, 'ssh_sessions', None) or 8)
+    elif name == 'fake':
+        path = os.path.join(args.fake_pool, host+'.json') if getattr(args, 'fake_pool', None) else None
+        try:
+            backend = FakeHost.load(path) if path else FakeHost()
+        except (IOError, ValueError) as e:
+            raise ValueError("cannot load fake pool %s: %s" % (path, e))
+        backend.path = path
+    else:
+        raise ValueError("the %s backend cannot reach other hosts" % name)
+    backend.connect()
+    return backend
+
+def each_host(args, work):
+    """Call work(args, out) for every host named in args.datasets, all at once.
+
+    Each call gets a copy of 'args' with 'datasets' cut down to the host's
+    own, and a cache directory of its own; its zfs calls go to the host.
+    Yields (host, text written to 'out', error message or None) in the
+    order the hosts were named. A host that cannot be reached, or whose
+    zfs fails or cannot be run, does not stop the others.
+    """
+    hosts = targets(args.datasets)
+    control = tempfile.mkdtemp(prefix='zfs-rollup-')
+
+    def run(index, host):
+        out = io.StringIO()
+        local = argparse.Namespace(**vars(args))
+        local.datasets = hosts[host]
+        if getattr(args, 'cache', False):
+            local.cache_dir = os.path.join(args.cache_dir or default_directory(), host)
+        try:
+            backend = connect(host, args, os.path.join(control, str(index)))
+        except ValueError as e:
+            return out.getvalue(), str(e)
+        try:
+            with zfs.using(backend):
+                work(local, out)
+        except (zfs.ZfsError, OSError) as e:
+            # OSError: ssh or zfs could not be run, e.g. an argument too long
+            return out.getvalue(), str(e)
+        finally:
+            backend.close()
+        return out.getvalue(), None
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(hosts)) as executor:
+            futures = [(host, executor.submit(run, index, host)) for index, host in enumerate(hosts)]
+            for host, future in futures:
+                output, error = future.result()
+                yield host, output, error
+    finally:
+        shutil.rmtree(control, ignore_errors=True)
+
+def prefixed(host, text):
+    """'text' with every line prefixed by 'host: ', as pdsh prints it."""
+    return ''.join('%s: %s' % (host, line) for line in text.splitlines(True))
@@ -0,0 +1,202 @@
+# zfsrollup/inventory.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# The snapshot inventory: every snapshot of every dataset and the properties
+# reported for it by 'zfs get'. The same pass reads the guids of bookmarks,
+# so replication bases are known without another listing.
+
+import sys
+from array import array
+from collections import OrderedDict
+
+from . import stats, zfs
+
+properties = ('type', 'creation', 'used', 'freenas:state', 'userrefs', 'guid')
+
+class Snapshots(object):
+    # Columnar storage for the snapshots of one dataset. Position i in every
+    # column describes the same snapshot; once sorted, positions follow
+    # creation order. Epochs, sizes, guids and hold counts are packed 64 bit
+    # integers, names, types and states are interned strings. 'bookmarks'
+    # holds the guids of the dataset's bookmarks.
+    __slots__ = ('names', 'creation', 'used', 'written', 'types', 'states', 'guids', 'userrefs', 'bookmarks')
+
+    def __init__(self):
+        self.names = list()
+        self.creation = array('q')
+        self.used = array('q')
+        self.written = array('q')
+        self.types = list()
+        self.states = list()
+        self.guids = array('Q')
+        self.userrefs = array('q')
+        self.bookmarks = set()
+
+    def __len__(self):
+        return len(self.names)
+
+    def append(self, name, creation=0, used=0, type=None, state=None, written=0, guid=0, userrefs=0):
+        self.names.append(sys.intern(name))
+        self.creation.append(creation)
+        self.used.append(used)
+        self.written.append(written)
+        self.types.append(type)
+        self.states.append(state)
+        self.guids.append(guid)
+        self.userrefs.append(userrefs)
+
+    def set(self, property, value, position=-1):
+        # set a property of the most recently appended snapshot by default
+        if property == 'creation':
+            self.creation[position] = int(value)
+        elif property == 'used':
+            self.used[position] = int(value) if value.isdigit() else 0
+        elif property == 'written':
+            self.written[position] = int(value) if value.isdigit() else 0
+        elif property == 'type':
+            self.types[position] = sys.intern(value)
+        elif property == 'freenas:state':
+            self.states[position] = sys.intern(value) if value != '-' else None
+        elif property == 'guid':
+            self.guids[position] = int(value) if value.isdigit() else 0
+        elif property == 'userrefs':
+            self.userrefs[position] = int(value) if value.isdigit() else 0
+
+    def extend(self, other):
+        self.names.extend(other.names)
+        self.creation.extend(other.creation)
+        self.used.extend(other.used)
+        self.written.extend(other.written)
+        self.types.extend(other.types)
+        self.states.extend(other.states)
+        self.guids.extend(other.guids)
+        self.userrefs.extend(other.userrefs)
+        self.bookmarks.update(other.bookmarks)
+
+    def select(self, positions):
+        # a new Snapshots holding only the given positions, in that order;
+        # arrays fill faster from a list than from a generator
+        selected = Snapshots()
+        selected.names = [self.names[i] for i in positions]
+        selected.creation = array('q', [self.creation[i] for i in positions])
+        selected.used = array('q', [self.used[i] for i in positions])
+        selected.written = array('q', [self.written[i] for i in positions])
+        selected.types = [self.types[i] for i in positions]
+        selected.states = [self.states[i] for i in positions]
+        selected.guids = array('Q', [self.guids[i] for i in positions])
+        selected.userrefs = array('q', [self.userrefs[i] for i in positions])
+        selected.bookmarks = self.bookmarks
+        return selected
+
+    def sorted(self):
+        creation = self.creation
+        positions = sorted(range(len(creation)), key=creation.__getitem__)
+        if all(positions[i] == i for i in range(len(positions))):
+            return self
+        return self.select(positions)
+
+class Inventory(object):
+    def __init__(self):
+        # dataset -> Snapshots, ordered by creation time
+        self.datasets = OrderedDict()
+
+    def add(self, dataset, snapshots):
+        if dataset in self.datasets:
+            merged = Snapshots()
+            merged.extend(self.datasets[dataset])
+            merged.extend(snapshots)
+            snapshots = merged
+        with stats.phase('sort'):
+            self.datasets[dataset] = snapshots.sorted()
+        return self
+
+    def discard(self, dataset, name):
+        snapshots = self.datasets.get(dataset)
+        if snapshots is not None and name in snapshots.names:
+            self.datasets[dataset] = snapshots.select([i for i in range(len(snapshots)) if snapshots.names[i] != name])
+
+    def neighbours(self, dataset, name):
+        """Names of the snapshots created just before and just after 'name'."""
+        names = self.snapshots(dataset).names
+        i = names.index(name)
+        return names[max(i - 1, 0):i] + names[i + 1:i + 2]
+
+    def refresh(self, dataset, names, properties=('used',)):
+        """Re-read 'properties' of the named snapshots of 'dataset' from zfs."""
+        if not names:
+            return
+        snapshots = self.snapshots(dataset)
+        positions = dict((name, i) for i, name in enumerate(snapshots.names))
+        for name,property,value in zfs.get([dataset+'@'+name for name in names], properties, recursive=False):
+            snapshot = name.split('@', 1)[1]
+            if snapshot in positions:
+                snapshots.set(property, value, positions[snapshot])
+
+    def snapshots(self, dataset):
+        """Columnar snapshots of 'dataset', ordered by creation time."""
+        return self.datasets.get(dataset, Snapshots())
+
+def fold(rows, root, recursive=False):
+    """Fold (name, property, value) rows into (dataset, Snapshots) pairs.
+
+    zfs reports all properties of a snapshot, and all snapshots and
+    bookmarks of a dataset, together; each dataset is yielded as soon as the
+    rows move on to the next one, so only one dataset is held at a time.
+    Of a bookmark only the guid is kept.
+    """
+    dataset = None
+    snapshots = Snapshots()
+    current_name = None
+    current = False
+    bookmark = False
+    for name,property,value in rows:
+        # if the rollup isn't recursive, skip any snapshots from child datasets
+        if not recursive and not name.startswith((root+"@", root+"#")):
+            continue
+        if name != current_name:
+            current_name = name
+            current = False
+            bookmark = '@' not in name
+            try:
+                name_dataset,snapshot = name.split('#' if bookmark else '@')
+            except ValueError:
+                continue
+            if name_dataset != dataset:
+                if len(snapshots):
+                    yield dataset, snapshots
+                dataset = name_dataset
+                snapshots = Snapshots()
+            if not bookmark:
+                snapshots.append(snapshot)
+            current = True
+        if not current:
+            continue
+        if not bookmark:
+            snapshots.set(property, value)
+        elif property == 'guid' and value.isdigit():
+            snapshots.bookmarks.add(int(value))
+    if len(snapshots):
+        yield dataset, snapshots
+
+def stream(datasets, recursive=False, types=None, properties=properties):
+    """Yield a single-dataset Inventory for each dataset below the given roots."""
+    for root in datasets:
+        for dataset,snapshots in fold(zfs.get(root, properties, types), root, recursive):
+            yield Inventory().add(dataset, snapshots)
+
+def fetch(datasets, recursive=False, types=None, properties=properties):
+    """Build an Inventory for the given root datasets."""
+    inventory = Inventory()
+    for root in datasets:
+        for dataset,snapshots in fold(zfs.get(root, properties, types), root, recursive):
+            inventory.add(dataset, snapshots)
+    return inventory
+
+def dataset_properties(datasets, properties, recursive=False):
+    """Map each filesystem or volume below 'datasets' to its requested properties."""
+    found = {}
+    for root in datasets:
+        for name,property,value in zfs.get(root, properties, types='filesystem,volume', recursive=recursive):
+            found.setdefault(name, {})[property] = value
+    return found
@@ -0,0 +1,99 @@
+# zfsrollup/lzc.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# A backend that destroys snapshots and estimates reclaimed space through
+# libzfs_core, using the pyzfs bindings, instead of running zfs for each
+# target. pyzfs has no way to read snapshot properties, so listing still
+# goes through the zfs command line tool.
+
+import sys
+
+from .zfs import CliBackend, ZfsError
+
+try:
+    import libzfs_core
+    from libzfs_core.exceptions import ZFSError
+except ImportError:
+    libzfs_core = None
+
+available = libzfs_core is not None
+
+class LzcBackend(CliBackend):
+    def __init__(self):
+        if not available:
+            raise ValueError("the lzc backend needs the pyzfs bindings (libzfs_core)")
+
+    def expand(self, target):
+        # full snapshot names covered by 'dataset@a%b,c', oldest first;
+        # a range whose end does not exist fails, as it does for zfs
+        dataset, _, spec = target.partition('@')
+        if '%' in spec:
+            names = [name.split('@', 1)[1] for name, in self.listing(dataset, ('name',))]
+            positions = dict((name, i) for i, name in enumerate(names))
+        covered = []
+        for part in spec.split(','):
+            if '%' in part:
+                first, last = part.split('%', 1)
+                for end in (first, last):
+                    if end and end not in positions:
+                        print("cannot destroy '%s': snapshot %s@%s does not exist" % (target, dataset, end), file=sys.stderr)
+                        raise ZfsError('destroy', 1)
+                covered += names[positions[first] if first else 0:positions[last] + 1 if last else len(names)]
+            else:
+                covered.append(part)
+        return [dataset+'@'+name for name in covered]
+
+    def destroy(self, target, flags=()):
+        if flags:
+            # deferred, recursive and dry-run destroys are left to zfs
+            return CliBackend.destroy(self, target, flags)
+        try:
+            names = self.expand(target)
+        except ZfsError as e:
+            return e.returncode
+        if not names:
+            print("could not find any snapshots to destroy; check snapshot names.", file=sys.stderr)
+            return 1
+        # one call for the whole target, which zfs destroys all or nothing of
+        try:
+            libzfs_core.lzc_destroy_snaps([name.encode() for name in names], False)
+        except ZFSError as e:
+            print("cannot destroy snapshots of %s: %s" % (target.split('@', 1)[0], e), file=sys.stderr)
+            return 1
+        return 0
+
+    def bookmark(self, snapshot, bookmark):
+        try:
+            libzfs_core.lzc_bookmark({bookmark.encode(): snapshot.encode()})
+        except ZFSError as e:
+            print("cannot create bookmark %s: %s" % (bookmark, e), file=sys.stderr)
+            return 1
+        return 0
+
+    def bookmarks(self, pairs):
+        # one call, which creates all of them or none
+        if not pairs:
+            return 0
+        try:
+            libzfs_core.lzc_bookmark(dict((bookmark.encode(), snapshot.encode()) for snapshot, bookmark in pairs))
+        except ZFSError as e:
+            print("cannot create bookmarks of %s: %s" % (pairs[0][0].split('@', 1)[0], e), file=sys.stderr)
+            return 1
+        return 0
+
+    def reclaim(self, target):
+        dataset, _, spec = target.partition('@')
+        if ',' in spec:
+            # the space of several ranges is not the sum of each; ask zfs
+            return CliBackend.reclaim(self, target)
+        first, _, last = spec.partition('%')
+        if not first or (last == '' and '%' in spec):
+            names = self.expand(target)
+            if not names:
+                raise ZfsError('destroy -nvp', 1)
+            first, last = names[0].split('@', 1)[1], names[-1].split('@', 1)[1]
+        try:
+            return libzfs_core.lzc_snaprange_space((dataset+'@'+first).encode(), (dataset+'@'+(last or first)).encode())
+        except ZFSError as e:
+            raise ZfsError('snaprange_space', e.errno)
@@ -0,0 +1,83 @@
+# zfsrollup/parallel.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Run per-dataset work on a bounded thread pool. Datasets are independent,
+# so inventory and destroy for one can overlap with another; per-pool
+# limits keep a single pool from being saturated, and every dataset's
+# output is buffered so logs never interleave.
+
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import zfs
+from .inventory import stream
+
+def pool(dataset):
+    return dataset.split('/', 1)[0].split('@', 1)[0]
+
+class PoolLimits(object):
+    # one semaphore per pool, created on first use
+    def __init__(self, per_pool=None):
+        self.per_pool = per_pool
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, dataset):
+        if not self.per_pool:
+            return _unlimited
+        name = pool(dataset)
+        with self.lock:
+            if name not in self.semaphores:
+                self.semaphores[name] = threading.BoundedSemaphore(self.per_pool)
+            return self.semaphores[name]
+
+class _Unlimited(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_unlimited = _Unlimited()
+
+def each_dataset(roots, work, jobs=1, per_pool=None, recursive=False, types=None, source=stream):
+    """Call work(inventory, out) for every dataset below 'roots'.
+
+    Roots are listed and datasets worked on using up to 'jobs' threads
+    each, with at most 'per_pool' datasets of any one pool in progress.
+    Yields the text each call wrote to 'out', in the same order a
+    sequential run would produce it. 'source' lists the datasets of a root,
+    as inventory.stream() does. Exceptions from listing or from
+    'work' are raised from the generator.
+    """
+    if jobs <= 1:
+        # no threads: keep streaming one dataset at a time
+        for root in roots:
+            for inventory in source([root], recursive, types):
+                out = io.StringIO()
+                work(inventory, out)
+                yield out.getvalue()
+        return
+
+    limits = PoolLimits(per_pool)
+    # the workers talk to the same backend as the caller
+    backend = zfs.current()
+
+    def run(inventory):
+        out = io.StringIO()
+        with zfs.using(backend), limits(next(iter(inventory.datasets))):
+            work(inventory, out)
+        return out.getvalue()
+
+    with ThreadPoolExecutor(max_workers=jobs) as workers, \
+            ThreadPoolExecutor(max_workers=jobs) as listers:
+
+        def list_root(root):
+            with zfs.using(backend), limits(root):
+                return [workers.submit(run, inventory) for inventory in source([root], recursive, types)]
+
+        for root in [listers.submit(list_root, root) for root in roots]:
+            for future in root.result():
+                yield future.result()
@@ -0,0 +1,182 @@
+# zfsrollup/policies.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Retention for a whole pool from one policy file, instead of one cron line
+# per policy.
+#
+# Settings at the top level apply everywhere; 'datasets' overrides them for
+# a dataset and everything below it. Each setting is taken from the nearest
+# configured ancestor that has it, so a child only names what differs.
+# Every configured dataset is compiled into a Policy when the file is
+# loaded, which reports mistakes before anything is destroyed and leaves
+# nothing to parse while planning. In TOML:
+#
+#   intervals = "hourly,daily,weekly"       # the -i grammar, or a table of counts
+#   prefixes = ["auto"]
+#   timezone = "Europe/Amsterdam"           # calendar buckets in local time
+#
+#   [datasets."tank/vm"]
+#   intervals = { hourly = 48, daily = 14 }
+#
+#   [datasets."tank/home".rules]
+#   manual = "monthly:0"                    # manual- snapshots get their own buckets
+#
+#   [datasets."tank/scratch"]
+#   clear = true
+#
+# JSON and YAML files have the same structure.
+
+import json
+import os
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from . import calendars
+from .buckets import parse_intervals
+from .retention import Policy
+
+settings = ('intervals', 'prefixes', 'clear', 'rules', 'timezone')
+
+class Policies(object):
+    """A Policy per dataset; the planners accept it wherever they accept a Policy."""
+
+    def __init__(self, defaults, datasets=None, timezone=None):
+        """'defaults' holds the top level settings, 'datasets' maps dataset
+        names to their own. 'timezone' is used where the file names none.
+        Raises ValueError on invalid settings.
+        """
+        check(defaults, 'top level')
+        defaults = dict(defaults)
+        if timezone and 'timezone' not in defaults:
+            defaults['timezone'] = timezone
+        self.default = compile_policy(defaults, 'top level')
+        # configured dataset -> inherited settings, and its Policy
+        self.settings = {}
+        self.policies = {}
+        for dataset in sorted(datasets or {}, key=lambda name: name.count('/')):
+            where = 'datasets.%s' % dataset
+            check(datasets[dataset], where)
+            parent = self.configured(dataset.rpartition('/')[0])
+            merged = dict(self.settings[parent] if parent else defaults)
+            merged.update(datasets[dataset])
+            self.settings[dataset] = merged
+            self.policies[dataset] = compile_policy(merged, where)
+        self.resolved = {}
+
+    def configured(self, dataset):
+        # 'dataset' or its nearest configured ancestor, None if there is none
+        while dataset:
+            if dataset in self.policies:
+                return dataset
+            dataset = dataset.rpartition('/')[0]
+        return None
+
+    def resolve(self, dataset):
+        """The Policy for 'dataset'."""
+        policy = self.resolved.get(dataset)
+        if policy is None:
+            configured = self.configured(dataset)
+            policy = self.resolved[dataset] = self.policies[configured] if configured else self.default
+        return policy
+
+def check(values, where):
+    if not isinstance(values, dict):
+        raise ValueError("%s: expected a table of settings" % where)
+    for key in values:
+        if key not in settings:
+            raise ValueError("%s: unknown setting %s" % (where, key))
+
+def intervals(value, where):
+    # the -i grammar, or a table of interval -> count
+    if isinstance(value, dict):
+        for interval, count in value.items():
+            if isinstance(count, bool) or not isinstance(count, int):
+                raise ValueError("%s: invalid count for %s: %r" % (where, interval, count))
+        value = ','.join('%s:%d' % item for item in value.items())
+    if not isinstance(value, str):
+        raise ValueError("%s: intervals must be a string or a table of counts" % where)
+    try:
+        return parse_intervals(value)
+    except ValueError as e:
+        raise ValueError("%s: %s" % (where, e))
+
+def compile_policy(values, where):
+    # settings are named 'intervals' at the top level, 'datasets.tank/vm.intervals' below it
+    path = '' if where == 'top level' else where + '.'
+    prefixes = values.get('prefixes')
+    if isinstance(prefixes, str):
+        prefixes = [prefixes]
+    if prefixes is not None and not (isinstance(prefixes, list) and all(isinstance(prefix, str) and prefix for prefix in prefixes)):
+        raise ValueError("%s: prefixes must be a list of names" % where)
+    clear = values.get('clear', False)
+    if not isinstance(clear, bool):
+        raise ValueError("%s: clear must be true or false" % where)
+    rules = values.get('rules') or {}
+    if not isinstance(rules, dict):
+        raise ValueError("%s: rules must map prefixes to intervals" % where)
+    timezone = values.get('timezone')
+    if timezone is not None and not isinstance(timezone, str):
+        raise ValueError("%s: timezone must be a zone name" % where)
+    try:
+        zone = calendars.zone(timezone)
+    except ValueError as e:
+        raise ValueError("%s: %s" % (where, e))
+    return Policy(intervals(values['intervals'], path+'intervals') if 'intervals' in values else None,
+        prefixes, clear, dict((prefix, intervals(rule, '%srules.%s' % (path, prefix))) for prefix, rule in rules.items()), zone)
+
+def parse(text, format):
+    if format == 'json':
+        return json.loads(text)
+    if format == 'toml':
+        if tomllib is None:
+            raise ValueError("reading TOML needs Python 3.11 or the tomli package")
+        return tomllib.loads(text)
+    if format == 'yaml':
+        if yaml is None:
+            raise ValueError("reading YAML needs the PyYAML package")
+        try:
+            return yaml.safe_load(text)
+        except yaml.YAMLError as e:
+            raise ValueError(str(e))
+    raise ValueError("unknown policy file format: %s" % format)
+
+formats = {'.json': 'json', '.toml': 'toml', '.yaml': 'yaml', '.yml': 'yaml'}
+
+def load(path, timezone=None):
+    """Read and compile a policy file; the format follows the extension.
+
+    'timezone' names the zone of datasets the file gives none. Raises
+    ValueError, naming the file and the offending setting, if the file
+    cannot be read or is invalid.
+    """
+    format = formats.get(os.path.splitext(path)[1].lower())
+    if format is None:
+        raise ValueError("policy file %s: use a .json, .toml, .yaml or .yml file" % path)
+    try:
+        with open(path) as f:
+            values = parse(f.read(), format)
+    except (IOError, ValueError) as e:
+        # json and TOML syntax errors are ValueErrors too
+        raise ValueError("policy file %s: %s" % (path, e))
+    if not isinstance(values, dict):
+        raise ValueError("policy file %s: expected a table of settings" % path)
+    values = dict(values)
+    datasets = values.pop('datasets', None) or {}
+    if not isinstance(datasets, dict):
+        raise ValueError("policy file %s: datasets must map dataset names to settings" % path)
+    try:
+        return Policies(values, datasets, timezone)
+    except ValueError as e:
+        raise ValueError("policy file %s: %s" % (path, e))
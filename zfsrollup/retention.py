@@ -0,0 +1,389 @@
+# zfsrollup/retention.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Side-effect free retention planning. Each plan function takes an Inventory
+# and a Policy and returns Actions; nothing here talks to zfs.
+
+from collections import defaultdict, namedtuple, OrderedDict
+
+from . import stats, vectorized, zfs
+from .buckets import compile_intervals, parse_intervals
+
+# keep is None for snapshots that are not protected, otherwise the reason:
+# RECENT, NEW, LATEST, HOLD, BASE or !PREFIX
+Action = namedtuple('Action', 'dataset snapshot prune held keep used')
+
+class Policy(object):
+    def __init__(self, intervals=None, prefixes=None, clear=False, rules=None, zone=None):
+        """'rules' maps a prefix ('manual') to intervals of its own: snapshots
+        with that prefix fill only those buckets, and everything else the
+        shared 'intervals'. Rule prefixes are considered along with
+        'prefixes'. Calendar buckets follow the clock of 'zone' (a tzinfo,
+        see calendars.zone()), UTC by default. Raises ValueError on invalid
+        intervals.
+        """
+        self.intervals = compile_intervals(intervals if intervals is not None else parse_intervals(), zone)
+        # name prefix -> compiled intervals, longest prefix first
+        self.rules = OrderedDict((prefix+'-', compile_intervals(rules[prefix], zone))
+            for prefix in sorted(rules or (), key=len, reverse=True))
+        self.prefixes = tuple(prefix_list(list(prefixes or ['auto']) + list(rules or ())))
+        self.clear = clear
+
+    def matches(self, snapshot):
+        return snapshot.startswith(self.prefixes)
+
+    def resolve(self, dataset):
+        """The Policy for 'dataset'; policies.Policies gives each dataset its own."""
+        return self
+
+    def rule(self, snapshot):
+        # the rule prefix whose buckets 'snapshot' fills, None for the shared ones
+        for prefix in self.rules:
+            if snapshot.startswith(prefix):
+                return prefix
+        return None
+
+    def intervals_for(self, snapshot):
+        """The intervals whose buckets 'snapshot' fills."""
+        rule = self.rule(snapshot)
+        return self.rules[rule] if rule else self.intervals
+
+    def held(self, snapshots):
+        """Map positions kept by the interval buckets to the intervals keeping them."""
+        if self.clear:
+            return {}
+        if not self.rules:
+            return hold(snapshots, self.intervals)
+        groups = defaultdict(list)
+        for i, name in enumerate(snapshots.names):
+            groups[self.rule(name)].append(i)
+        held = {}
+        for rule, positions in groups.items():
+            for j, intervals in hold(snapshots.select(positions), self.rules[rule] if rule else self.intervals).items():
+                held[positions[j]] = intervals
+        return held
+
+def prefix_list(prefixes):
+    # command line prefixes ('auto') become name prefixes ('auto-')
+    if not prefixes:
+        prefixes = ['auto']
+    return [prefix+"-" for prefix in sorted(set(prefixes))]
+
+class Retention(object):
+    # Buckets for each interval are filled in a single pass over snapshots in
+    # ascending creation order. Each interval keeps an ordered map of bucket
+    # key -> the first (oldest) snapshot in that bucket; keys only ever grow,
+    # so the oldest bucket is always at the front and eviction is O(1).
+
+    def __init__(self, intervals):
+        self.intervals = compile_intervals(intervals)
+        self.buckets = dict((interval, OrderedDict()) for interval in intervals)
+        self.holders = defaultdict(set)
+
+    def add(self, snapshot, epoch):
+        # returns the snapshots that no longer hold any bucket
+        evicted = list()
+        for interval, definition in self.intervals.items():
+            buckets = self.buckets[interval]
+            if 'reference' in definition:
+                key = definition['calendar'].key(epoch)
+                if key in buckets:
+                    continue
+            else:
+                if buckets and next(reversed(buckets)) + definition['gap'] >= epoch:
+                    continue
+                key = epoch
+            if definition['max'] != 0 and len(buckets) >= definition['max']:
+                oldest = buckets.popitem(last=False)[1]
+                self.holders[oldest].discard(interval)
+                if not self.holders[oldest]:
+                    del self.holders[oldest]
+                    evicted.append(oldest)
+            buckets[key] = snapshot
+            self.holders[snapshot].add(interval)
+        return evicted
+
+    def held(self, snapshot):
+        # the intervals for which this snapshot is currently kept
+        return self.holders.get(snapshot, ())
+
+def hold(snapshots, intervals):
+    """Map positions kept by the interval buckets to the intervals keeping them."""
+    if len(snapshots) >= vectorized.threshold and vectorized.available:
+        held = defaultdict(list)
+        for interval, positions in vectorized.retain(snapshots.creation, intervals).items():
+            for i in positions.tolist():
+                held[i].append(interval)
+        return held
+
+    retention = Retention(intervals)
+    for i in range(len(snapshots)):
+        retention.add(i, snapshots.creation[i])
+    return retention.holders
+
+def replicated(snapshots):
+    """Map positions of snapshots that replication needs to the reason.
+
+    HOLD: the snapshot has user holds ('zfs hold'), so zfs refuses to
+    destroy it, and a batch that includes it fails as a whole. BASE: the
+    newest snapshot with a bookmark. Replication tools bookmark what they
+    have sent, so this is where the next 'zfs send -i' starts, and losing
+    it forces a full send.
+    """
+    keep = {}
+    if any(snapshots.userrefs):
+        for i, userrefs in enumerate(snapshots.userrefs):
+            if userrefs:
+                keep[i] = 'HOLD'
+    if snapshots.bookmarks:
+        guids = snapshots.guids
+        for i in range(len(guids) - 1, -1, -1):
+            if guids[i] in snapshots.bookmarks:
+                keep.setdefault(i, 'BASE')
+                break
+    return keep
+
+def protected(snapshots, policy):
+    """Map positions of snapshots that must be kept to the reason they are kept."""
+    keep = {}
+    pinned = replicated(snapshots)
+    latestNEW = None
+    names = snapshots.names
+    for i in range(len(names) - 1, -1, -1):
+        if i == len(names) - 1:
+            keep[i] = 'RECENT'
+            continue
+        if not policy.matches(names[i]) \
+            or snapshots.types[i] != "snapshot":
+            keep[i] = '!PREFIX'
+            continue
+        state = snapshots.states[i]
+        if latestNEW is None and state == 'NEW':
+            latestNEW = i
+            keep[i] = 'NEW'
+            continue
+        if state == 'LATEST':
+            keep[i] = 'LATEST'
+            continue
+        if i in pinned:
+            keep[i] = pinned[i]
+    return keep
+
+def plan(inventory, policy):
+    """Decide which snapshots to keep and prune, in dataset and creation order."""
+    actions = list()
+    for dataset in sorted(inventory.datasets):
+        snapshots = inventory.snapshots(dataset)
+        names = snapshots.names
+        applied = policy.resolve(dataset)
+        keep = protected(snapshots, applied)
+
+        with stats.phase('buckets'):
+            held_by = applied.held(snapshots)
+
+        for i in range(len(names)):
+            held = held_by.get(i, ())
+            actions.append(Action(dataset, names[i], not held and i not in keep, tuple(held), keep.get(i), snapshots.used[i]))
+    return actions
+
+def empty_candidates(dataset, snapshots, policy, deleted=()):
+    # positions of empty snapshots that may be destroyed, newest first
+    names = snapshots.names
+    pinned = replicated(snapshots)
+    latest = None
+    latestNEW = None
+    for i in range(len(names) - 1, -1, -1):
+        if not policy.matches(names[i]) \
+            or snapshots.types[i] != "snapshot":
+            continue
+        if latest is None:
+            latest = i
+            continue
+        state = snapshots.states[i]
+        if latestNEW is None and state == 'NEW':
+            latestNEW = i
+            continue
+        if state == 'LATEST' or i in pinned:
+            continue
+        if snapshots.used[i] != 0 \
+            or (dataset, names[i]) in deleted:
+            continue
+        yield i
+
+def plan_empty(inventory, policy, deleted=()):
+    """Pick the most recent empty snapshot of each dataset.
+
+    Only one snapshot per dataset is returned, as destroying it may change
+    the 'used' value of its neighbours. 'deleted' holds (dataset, snapshot)
+    pairs that have already been handled.
+    """
+    actions = list()
+    for dataset in sorted(inventory.datasets):
+        snapshots = inventory.snapshots(dataset)
+        for i in empty_candidates(dataset, snapshots, policy.resolve(dataset), deleted):
+            actions.append(Action(dataset, snapshots.names[i], True, (), None, snapshots.used[i]))
+            break
+    return actions
+
+def plan_empty_all(inventory, policy, reclaim, usedbysnapshots=None):
+    """Predict every empty snapshot that can be destroyed together.
+
+    Returns Actions for all snapshots of each dataset, pruning a set that
+    frees no space when destroyed in one batch. 'reclaim' estimates the
+    bytes freed by a destroy target (zfs.reclaim runs 'zfs destroy -nvp');
+    'usedbysnapshots' maps datasets to that property, if known.
+
+    A set of snapshots can only free a block if the block was born in one
+    of them, so candidates with nothing 'written' are always safe and are
+    taken without asking zfs. If the dataset's snapshots use no space at
+    all, every candidate is safe. The rest are tried newest first, like the
+    iterative mode, keeping each one whose addition still frees nothing.
+    """
+    usedbysnapshots = usedbysnapshots or {}
+    actions = list()
+    for dataset in sorted(inventory.datasets):
+        snapshots = inventory.snapshots(dataset)
+        names = snapshots.names
+        candidates = list(empty_candidates(dataset, snapshots, policy.resolve(dataset)))
+
+        if str(usedbysnapshots.get(dataset)) == '0':
+            chosen = set(candidates)
+        else:
+            chosen = set(i for i in candidates if snapshots.written[i] == 0)
+            undecided = [i for i in candidates if i not in chosen]
+
+            def frees(positions):
+                marked = [Action(dataset, names[i], i in positions, (), None, 0) for i in range(len(names))]
+                return sum(reclaim(target) for target in batch_targets(destroy_targets(marked)))
+
+            if undecided and frees(chosen.union(undecided)) == 0:
+                chosen.update(undecided)
+            else:
+                for i in undecided:
+                    if frees(chosen | set([i])) == 0:
+                        chosen.add(i)
+
+        for i in range(len(names)):
+            actions.append(Action(dataset, names[i], i in chosen, (), None, snapshots.used[i]))
+    return actions
+
+def plan_reclaim(inventory, policy, goal, reclaim):
+    """Prune the oldest snapshots needed to free 'goal' bytes, and no more.
+
+    Returns the Actions and the bytes the chosen snapshots are estimated to
+    free. Snapshots the time buckets would prune anyway are taken first,
+    oldest first across all datasets; if they are not enough, snapshots
+    held by a bucket follow, again oldest first. Protected snapshots are
+    never taken. 'reclaim' estimates the bytes freed by a destroy target
+    (zfs.reclaim runs 'zfs destroy -nvp').
+
+    Freeing more snapshots never frees less space, so the shortest prefix
+    of the candidates that reaches the goal is found by binary search, at
+    one estimate per dataset for each step.
+    """
+    actions = plan(inventory, policy)
+    creation = dict((dataset, inventory.snapshots(dataset).creation) for dataset in inventory.datasets)
+    candidates = list()
+    position = 0
+    for i, action in enumerate(actions):
+        if i and actions[i - 1].dataset != action.dataset:
+            position = 0
+        if action.keep is None:
+            candidates.append((0 if action.prune else 1, creation[action.dataset][position], i))
+        position += 1
+    candidates.sort()
+
+    estimates = {}
+    def frees(count):
+        if count not in estimates:
+            chosen = set(i for tier, epoch, i in candidates[:count])
+            marked = [action._replace(prune=i in chosen) for i, action in enumerate(actions)]
+            estimates[count] = sum(reclaim(target) for target in batch_targets(destroy_targets(marked)))
+        return estimates[count]
+
+    low, high = 0, len(candidates)
+    if goal <= 0:
+        high = 0
+    elif frees(high) >= goal:
+        while low < high:
+            middle = (low + high) // 2
+            if frees(middle) >= goal:
+                high = middle
+            else:
+                low = middle + 1
+
+    chosen = set(i for tier, epoch, i in candidates[:high])
+    return [action._replace(prune=i in chosen) for i, action in enumerate(actions)], frees(high) if high else 0
+
+def plan_strip(inventory, policy):
+    """Prune every snapshot matching the policy prefixes, except protected ones."""
+    actions = list()
+    for dataset in sorted(inventory.datasets):
+        snapshots = inventory.snapshots(dataset)
+        names = snapshots.names
+        positions = [i for i in range(len(names)) if snapshots.types[i] == "snapshot"]
+        applied = policy.resolve(dataset)
+        pinned = replicated(snapshots)
+        keep = {}
+        latestNEW = None
+        for i in reversed(positions):
+            if i == positions[-1]:
+                keep[i] = 'RECENT'
+                continue
+            state = snapshots.states[i]
+            if latestNEW is None and state == 'NEW':
+                latestNEW = i
+                keep[i] = 'NEW'
+                continue
+            if state == 'LATEST':
+                keep[i] = 'LATEST'
+                continue
+            if i in pinned:
+                keep[i] = pinned[i]
+                continue
+            if not applied.matches(names[i]):
+                keep[i] = '!PREFIX'
+        for i in positions:
+            actions.append(Action(dataset, names[i], i not in keep, (), keep.get(i), snapshots.used[i]))
+    return actions
+
+def destroy_targets(actions):
+    """Collapse runs of pruned snapshots into 'dataset@first%last' targets."""
+    targets = list()
+    run = list()
+    for action in actions + [None]:
+        if run and (action is None or not action.prune or action.dataset != run[0].dataset):
+            target = run[0].dataset+'@'+run[0].snapshot
+            if len(run) > 1:
+                target += '%' + run[-1].snapshot
+            targets.append(target.replace(' ', ''))
+            run = list()
+        if action is not None and action.prune:
+            run.append(action)
+    return targets
+
+def batch_targets(targets, limit=None):
+    """Combine destroy targets of the same dataset into 'dataset@a%b,c,d%e' batches.
+
+    zfs destroys every snapshot named in one argument in a single
+    transaction group, so each batch costs one process and one sync. A
+    batch is split before its length would exceed 'limit' characters
+    (zfs.arg_limit() when not given).
+    """
+    if limit is None:
+        limit = zfs.arg_limit()
+    batches = list()
+    current = None
+    for target in targets:
+        dataset,snapshots = target.split('@', 1)
+        if current is not None and current.startswith(dataset+'@') \
+            and len(current) + 1 + len(snapshots) <= limit:
+            current += ',' + snapshots
+            continue
+        if current is not None:
+            batches.append(current)
+        current = target
+    if current is not None:
+        batches.append(current)
+    return batches
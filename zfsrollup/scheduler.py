@@ -0,0 +1,153 @@
+# zfsrollup/scheduler.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Destroy queued targets without swamping the pool.
+#
+# A large destroy returns quickly, but the pool frees the blocks in the
+# background afterwards, and that is when production I/O suffers. Targets
+# are queued per pool and destroyed by a few asyncio workers per pool.
+# Before each destroy a worker checks the pool's 'freeing' backlog and the
+# I/O wait reported by 'zpool iostat -l'; while either is above its limit,
+# the worker backs off. Once the deadline passes, no further destroy is
+# started and the rest of the queue is reported as skipped.
+#
+# The destroys and pool queries themselves are the blocking zfs backend
+# calls, run on a thread pool so one pool's wait never holds up another.
+
+import asyncio
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from . import zfs
+from .parallel import pool
+
+# longest pause between two checks of a busy pool, in seconds
+backoff_limit = 60
+
+class Scheduler(object):
+    def __init__(self, per_pool=1, max_freeing=None, max_latency=None, deadline=None, interval=5, log=None):
+        """'max_freeing' is in bytes, 'max_latency' in seconds, 'deadline' an
+        epoch after which no destroy is started. Busy pools are checked
+        again after 'interval' seconds, doubling up to backoff_limit.
+        'log(message)' reports pauses.
+        """
+        self.per_pool = max(1, per_pool)
+        self.max_freeing = max_freeing
+        self.max_latency = max_latency
+        self.deadline = deadline
+        self.interval = interval
+        self.log = log or (lambda message: None)
+        # pool -> deque of targets
+        self.queues = OrderedDict()
+        self.lock = threading.Lock()
+        self.destroyed = []
+        self.failed = []
+        self.skipped = []
+
+    def submit(self, target):
+        """Queue 'target' for destruction; safe to call from several threads."""
+        with self.lock:
+            self.queues.setdefault(pool(target), deque()).append(target)
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(queue) for queue in self.queues.values())
+
+    def run(self):
+        """Destroy everything queued; returns (destroyed, failed, skipped) target lists."""
+        if len(self):
+            asyncio.run(self.drain())
+        return self.destroyed, self.failed, self.skipped
+
+    def expired(self):
+        return self.deadline is not None and time.time() >= self.deadline
+
+    async def drain(self):
+        loop = asyncio.get_running_loop()
+        checks = dict((name, PoolCheck()) for name in self.queues)
+        backend = zfs.current()
+        def hosted(function, *arguments):
+            with zfs.using(backend):
+                return function(*arguments)
+
+        with ThreadPoolExecutor(max_workers=self.per_pool * len(self.queues) + len(self.queues)) as executor:
+            async def call(function, *arguments):
+                return await loop.run_in_executor(executor, hosted, function, *arguments)
+
+            async def worker(name, queue):
+                while queue:
+                    await self.throttle(name, checks[name], call)
+                    if self.expired() or not queue:
+                        break
+                    target = queue.popleft()
+                    if await call(zfs.destroy, target):
+                        self.failed.append(target)
+                    else:
+                        self.destroyed.append(target)
+
+            await asyncio.gather(*[worker(name, queue) for name, queue in self.queues.items() for _ in range(self.per_pool)])
+        for queue in self.queues.values():
+            self.skipped.extend(queue)
+            queue.clear()
+
+    async def throttle(self, name, check, call):
+        # wait while the pool is busy, backing off, but never past the deadline
+        delay = self.interval
+        while not self.expired():
+            reason = await check.busy(self, name, call)
+            if reason is None:
+                return
+            wait = delay if self.deadline is None else min(delay, max(0, self.deadline - time.time()))
+            self.log("%s: %s, pausing %.1fs" % (name, reason, wait))
+            await asyncio.sleep(wait)
+            delay = min(delay * 2, backoff_limit)
+
+class PoolCheck(object):
+    # the latest 'freeing' and latency readings of one pool; workers of the
+    # same pool share them rather than each running zpool
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.checked = None
+        self.reason = None
+
+    async def busy(self, scheduler, name, call):
+        async with self.lock:
+            if self.checked is not None and time.time() - self.checked < scheduler.interval:
+                return self.reason
+            self.reason = None
+            if scheduler.max_freeing is not None:
+                freeing = await call(zfs.freeing, name)
+                if freeing > scheduler.max_freeing:
+                    self.reason = "freeing %d bytes" % freeing
+            if self.reason is None and scheduler.max_latency is not None:
+                latency = await call(zfs.latency, name)
+                if latency > scheduler.max_latency:
+                    self.reason = "I/O wait %.1fms" % (latency * 1000)
+            self.checked = time.time()
+            return self.reason
+
+def deadline(value, now=None):
+    """Parse a --deadline: a duration ('90m', '2h', '45s', plain seconds) or a
+    local clock time ('05:30', the next time it comes round). Returns an epoch.
+
+    Raises ValueError for anything else.
+    """
+    now = time.time() if now is None else now
+    match = re.match(r'^(\d+):(\d\d)$', value)
+    if match:
+        hours, minutes = int(match.group(1)), int(match.group(2))
+        if hours > 23 or minutes > 59:
+            raise ValueError("invalid deadline: %s" % value)
+        local = time.localtime(now)
+        target = time.mktime((local.tm_year, local.tm_mon, local.tm_mday, hours, minutes, 0, 0, 0, -1))
+        if target <= now:
+            target = time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, hours, minutes, 0, 0, 0, -1))
+        return target
+    match = re.match(r'^(\d+(?:\.\d+)?)([smh]?)$', value)
+    if match:
+        return now + float(match.group(1)) * {'': 1, 's': 1, 'm': 60, 'h': 3600}[match.group(2)]
+    raise ValueError("invalid deadline: %s" % value)
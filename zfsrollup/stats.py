@@ -0,0 +1,206 @@
+# zfsrollup/stats.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Run statistics for --stats: wall time per phase, the number and duration
+# of zfs calls, and per-dataset snapshot counts, written as JSON or in the
+# Prometheus text exposition format for the node exporter's textfile
+# collector.
+#
+# Nothing is recorded unless enable() was called; the helpers below are
+# no-ops otherwise, so instrumented code costs nothing in a normal run.
+# Phases run from several threads with --jobs add up, so their sum may
+# exceed the run's wall time.
+
+import atexit
+import cProfile
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+
+class Stats(object):
+    def __init__(self, script):
+        self.script = script
+        self.started = time.time()
+        self.clock = time.perf_counter()
+        self.phases = defaultdict(float)
+        # zfs command -> [calls, seconds]
+        self.calls = defaultdict(lambda: [0, 0.0])
+        # dataset -> {'scanned', 'pruned', 'reclaimed'}
+        self.datasets = OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.phases[name] += elapsed
+
+    def call(self, command, seconds):
+        with self.lock:
+            self.calls[command][0] += 1
+            self.calls[command][1] += seconds
+
+    def timed(self, iterable, phase=None, command=None):
+        # time spent waiting for each item counts towards 'phase' and/or one 'command' call
+        iterator = iter(iterable)
+        spent = 0.0
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed = time.perf_counter() - started
+                    spent += elapsed
+                    if phase is not None:
+                        with self.lock:
+                            self.phases[phase] += elapsed
+                yield item
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+            if command is not None:
+                self.call(command, spent)
+
+    def dataset(self, dataset, scanned=0, pruned=0, reclaimed=0):
+        # 'scanned' is the most snapshots seen at once; the others add up
+        with self.lock:
+            counts = self.datasets.setdefault(dataset, {'scanned': 0, 'pruned': 0, 'reclaimed': 0})
+            counts['scanned'] = max(counts['scanned'], scanned)
+            counts['pruned'] += pruned
+            counts['reclaimed'] += reclaimed
+
+    def report(self):
+        with self.lock:
+            datasets = OrderedDict()
+            for dataset, counts in self.datasets.items():
+                datasets[dataset] = {
+                    'scanned': counts['scanned'],
+                    'kept': max(0, counts['scanned'] - counts['pruned']),
+                    'pruned': counts['pruned'],
+                    'reclaimed_bytes': counts['reclaimed'],
+                }
+            return OrderedDict([
+                ('script', self.script),
+                ('started', self.started),
+                ('seconds', round(time.perf_counter() - self.clock, 6)),
+                ('phases', OrderedDict((name, round(seconds, 6)) for name, seconds in sorted(self.phases.items()))),
+                ('zfs', OrderedDict((command, {'calls': calls, 'seconds': round(seconds, 6)})
+                    for command, (calls, seconds) in sorted(self.calls.items()))),
+                ('datasets', datasets),
+            ])
+
+    def prometheus(self):
+        report = self.report()
+        script = label(report['script'])
+        lines = []
+        def metric(name, help, type, samples):
+            lines.append('# HELP zfsrollup_%s %s' % (name, help))
+            lines.append('# TYPE zfsrollup_%s %s' % (name, type))
+            for labels, value in samples:
+                lines.append('zfsrollup_%s{script="%s"%s} %s' % (name, script,
+                    ''.join(',%s="%s"' % (key, label(value)) for key, value in labels), value))
+        metric('last_run_timestamp_seconds', 'When the run started.', 'gauge', [((), report['started'])])
+        metric('run_seconds', 'Wall time of the run.', 'gauge', [((), report['seconds'])])
+        metric('phase_seconds', 'Time spent in each phase, summed over threads.', 'gauge',
+            [((('phase', name),), seconds) for name, seconds in report['phases'].items()])
+        metric('zfs_calls', 'zfs commands run.', 'gauge',
+            [((('command', command),), values['calls']) for command, values in report['zfs'].items()])
+        metric('zfs_call_seconds', 'Time spent in zfs commands.', 'gauge',
+            [((('command', command),), values['seconds']) for command, values in report['zfs'].items()])
+        for key, help in (('scanned', 'Snapshots considered.'), ('kept', 'Snapshots kept.'),
+                ('pruned', 'Snapshots pruned.'), ('reclaimed_bytes', "Sum of the pruned snapshots' used property.")):
+            metric('snapshots_'+key if key != 'reclaimed_bytes' else key, help, 'gauge',
+                [((('dataset', dataset),), counts[key]) for dataset, counts in report['datasets'].items()])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, format='json'):
+        """Write the report to 'path', replacing it atomically so a collector never reads half of it."""
+        text = self.prometheus() if format == 'prometheus' else json.dumps(self.report(), indent=1) + '\n'
+        temporary = '%s.%d.tmp' % (path, os.getpid())
+        with open(temporary, 'w') as f:
+            f.write(text)
+        os.rename(temporary, path)
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+current = None
+
+def enable(script):
+    """Start recording statistics for 'script' and return the Stats object."""
+    global current
+    current = Stats(script)
+    return current
+
+@contextmanager
+def _nothing():
+    yield
+
+def phase(name):
+    """Context manager timing a phase of the run, if statistics are enabled."""
+    return current.phase(name) if current is not None else _nothing()
+
+def dataset(dataset, scanned=0, pruned=0, reclaimed=0):
+    if current is not None:
+        current.dataset(dataset, scanned, pruned, reclaimed)
+
+def inventory(inventory):
+    """Count the snapshots of each dataset of 'inventory' as scanned."""
+    if current is not None:
+        for name in inventory.datasets:
+            current.dataset(name, len(inventory.snapshots(name)))
+
+def actions(actions):
+    """Count the planned Actions of each dataset."""
+    if current is None:
+        return
+    counts = OrderedDict()
+    for action in actions:
+        scanned, pruned, reclaimed = counts.get(action.dataset, (0, 0, 0))
+        counts[action.dataset] = (scanned + 1, pruned + bool(action.prune), reclaimed + (action.used if action.prune else 0))
+    for name, (scanned, pruned, reclaimed) in counts.items():
+        current.dataset(name, scanned, pruned, reclaimed)
+
+def source(source):
+    """Wrap an inventory source so time spent listing counts as the 'list' phase."""
+    if current is None:
+        return source
+    recorder = current
+    def timed(datasets, recursive=False, types=None, **options):
+        return recorder.timed(source(datasets, recursive, types, **options), phase='list')
+    return timed
+
+def configure(args, script):
+    """Enable statistics and profiling as requested by parsed command line 'args'.
+
+    With --stats the report is written when the program exits (and by
+    flush()); with --profile a cProfile dump is saved for pstats.
+    """
+    if getattr(args, 'stats', None):
+        enable(script)
+        atexit.register(flush, args)
+    if getattr(args, 'profile', None):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        def save():
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        atexit.register(save)
+
+def flush(args):
+    """Write the report so far to the --stats file."""
+    if current is None:
+        return
+    format = args.stats_format or ('prometheus' if args.stats.endswith('.prom') else 'json')
+    current.write(args.stats, format)
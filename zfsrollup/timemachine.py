@@ -0,0 +1,517 @@
+# zfsrollup/timemachine.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Time Machine events for tmsnap.py, and the FreeNAS API it reports them to.
+#
+# backupd's messages are read either from a log file, followed like
+# 'tail -F' across rotation and truncation, or from the unified log through
+# 'log stream' (macOS 10.12 and later no longer write them to system.log).
+# A followed file is only read when the kernel reports that it changed:
+# inotify watches its directory on Linux, kqueue its vnode and directory on
+# macOS and the BSDs, and elsewhere the file is polled every second. Each
+# line is classified by a single regular expression.
+#
+# Snapshots are created through one requests session, so the connection to
+# FreeNAS is kept alive between backups, and failed connections and gateway
+# errors are retried with exponential backoff. StubServer stands in for
+# FreeNAS to try the whole flow out locally.
+#
+# Rollup prunes a dataset with rollup.py's interval logic right after a
+# snapshot lands in it, instead of cron scanning every dataset on a
+# schedule. Its zfs calls go over ssh to the FreeNAS host (fleet's
+# SshBackend), or to the stub's pool.
+
+import base64
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import re
+import select
+import struct
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+except ImportError:
+    requests = None
+
+from . import zfs
+from .inventory import fetch
+from .retention import plan, destroy_targets, batch_targets
+
+# one alternation for every event; the named group that matched is the kind
+EVENT = re.compile(
+    r"(?P<prefix>(?:com\.apple\.)?backupd\[\d+\]:[ \t]*).*?"
+    r"(?:(?P<started>Starting (?:automatic|manual) backup)"
+    r"|(?P<failed>Backup failed|Backup canceled|Stopping backup)"
+    r"|Created new backup: (?P<completed>\d{4}-\d{2}-\d{2}-\d{6})"
+    r"|(?P<ejected>Ejected Time Machine network volume\.))")
+
+def event(line):
+    """Classify a log line as (kind, detail), or None if it is no backupd event.
+
+    'kind' is 'started', 'failed', 'completed' or 'ejected'. 'detail' is the
+    backup name for 'completed', the message without its prefix otherwise.
+    """
+    # most lines come from other processes; skip them without the regex
+    if 'backupd[' not in line:
+        return None
+    match = EVENT.search(line)
+    if match is None:
+        return None
+    kind = match.lastgroup
+    if kind == 'completed':
+        return kind, match.group('completed')
+    return kind, line[match.end('prefix'):].rstrip('\n')
+
+# unified log messages from backupd, in the same format as system.log
+PREDICATE = 'process == "backupd"'
+
+def stream(predicate=PREDICATE, restart=5):
+    """Yield unified log lines matching 'predicate' as they are logged.
+
+    'log stream' is started again, after 'restart' seconds, if it exits.
+    Raises ValueError if the log command cannot be run.
+    """
+    command = ['log', 'stream', '--style', 'syslog', '--predicate', predicate]
+    while True:
+        try:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, universal_newlines=True, bufsize=1)
+        except OSError as e:
+            raise ValueError("cannot run log stream: %s" % e)
+        try:
+            for line in process.stdout:
+                yield line
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+        logging.warning("log stream exited with %d, restarting in %ds" % (process.returncode, restart))
+        time.sleep(restart)
+
+class Tail(object):
+    """The complete lines appended to 'path', across rotation and truncation."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        # (device, inode) of the open file
+        self.identity = None
+        self.partial = b''
+        # lines already in the file are not reported, only a file that
+        # appears later is read from its start
+        self.open(end=True)
+
+    def open(self, end=False):
+        try:
+            opened = open(self.path, 'rb')
+        except IOError:
+            return
+        if self.file is not None:
+            self.file.close()
+        self.file = opened
+        status = os.fstat(opened.fileno())
+        self.identity = (status.st_dev, status.st_ino)
+        if end:
+            opened.seek(0, os.SEEK_END)
+
+    def read(self, found):
+        data = self.file.read()
+        if data:
+            lines = (self.partial + data).split(b'\n')
+            self.partial = lines.pop()
+            found.extend(lines)
+
+    def lines(self):
+        """The lines completed since the last call, without their newlines."""
+        found = []
+        if self.file is None:
+            self.open()
+        while self.file is not None:
+            self.read(found)
+            try:
+                status = os.stat(self.path)
+            except OSError:
+                # rotated away and not yet replaced; the old file may still grow
+                break
+            if (status.st_dev, status.st_ino) != self.identity:
+                # rotated: finish the old file, then read the new one from its start
+                self.read(found)
+                if self.partial:
+                    found.append(self.partial)
+                    self.partial = b''
+                self.open()
+                continue
+            if status.st_size < self.file.tell():
+                # truncated in place
+                self.file.seek(0)
+                self.partial = b''
+                continue
+            break
+        return [line.decode('utf-8', 'replace') for line in found]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+# inotify(7)
+IN_MODIFY = 0x2
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+
+class Inotify(object):
+    """Wake up when the file at 'path' changes, is replaced or removed (Linux).
+
+    The directory is watched rather than the file, so a rotated file's
+    replacement is seen as soon as it is created.
+    """
+
+    # seconds between checks should an event be missed, e.g. on NFS
+    timeout = 60
+
+    def __init__(self, path):
+        # raises AttributeError where libc has no inotify
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        directory = os.path.dirname(os.path.abspath(path))
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, "cannot watch %s" % directory)
+        self.name = os.fsencode(os.path.basename(path))
+
+    def wait(self, timeout):
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([self.fd], [], [], remaining)[0]:
+                return
+            try:
+                if self.relevant(os.read(self.fd, 65536)):
+                    return
+            except BlockingIOError:
+                pass
+
+    def relevant(self, data):
+        # struct inotify_event: wd, mask, cookie, len, then a padded name;
+        # other files of the directory are ignored
+        offset = 0
+        while offset + 16 <= len(data):
+            wd, mask, cookie, length = struct.unpack_from('iIII', data, offset)
+            name = data[offset+16:offset+16+length].rstrip(b'\0')
+            offset += 16 + length
+            if name == self.name or mask & IN_Q_OVERFLOW:
+                return True
+        return False
+
+    def close(self):
+        os.close(self.fd)
+
+class Kqueue(object):
+    """Wake up when the file at 'path' changes, is replaced or removed (macOS, BSD)."""
+
+    timeout = 60
+
+    def __init__(self, path):
+        # raises AttributeError where there is no kqueue
+        self.queue = select.kqueue()
+        self.path = path
+        self.file = None
+        self.identity = None
+        # a write to the directory is a file created, renamed or removed
+        self.directory = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        self.register(self.directory, select.KQ_NOTE_WRITE)
+        self.rewatch()
+
+    def register(self, fd, flags):
+        self.queue.control([select.kevent(fd, select.KQ_FILTER_VNODE, select.KQ_EV_ADD | select.KQ_EV_CLEAR, flags)], 0, 0)
+
+    def rewatch(self):
+        # watch the file the path names now; closing the old descriptor
+        # drops its registration
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return
+        status = os.fstat(fd)
+        if (status.st_dev, status.st_ino) == self.identity:
+            os.close(fd)
+            return
+        if self.file is not None:
+            os.close(self.file)
+        self.file, self.identity = fd, (status.st_dev, status.st_ino)
+        self.register(fd, select.KQ_NOTE_WRITE | select.KQ_NOTE_EXTEND | select.KQ_NOTE_DELETE | select.KQ_NOTE_RENAME)
+
+    def wait(self, timeout):
+        self.queue.control(None, 8, timeout)
+        self.rewatch()
+
+    def close(self):
+        if self.file is not None:
+            os.close(self.file)
+        os.close(self.directory)
+        self.queue.close()
+
+class Poll(object):
+    """Check the file every second."""
+
+    timeout = 1
+
+    def __init__(self, path):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+
+    def close(self):
+        pass
+
+def watcher(path):
+    """The best available way to wait for changes to 'path'."""
+    for kind in (Inotify, Kqueue):
+        try:
+            return kind(path)
+        except (AttributeError, OSError):
+            continue
+    return Poll(path)
+
+def follow(path, watch=None):
+    """Yield each line appended to 'path' from now on, like 'tail -F'.
+
+    'watch' is an Inotify, Kqueue or Poll for 'path' (by default the best
+    one available).
+    """
+    tail = Tail(path)
+    watch = watch or watcher(path)
+    try:
+        while True:
+            for line in tail.lines():
+                yield line
+            watch.wait(watch.timeout)
+    finally:
+        watch.close()
+        tail.close()
+
+SNAPSHOTS = '/api/v1.0/storage/snapshot/'
+
+class ApiError(Exception):
+    """FreeNAS could not be reached."""
+
+def retry(retries, backoff):
+    # POST is not retried by default. A refused connection or a gateway
+    # error never reached FreeNAS, but a timed out read may have, so reads
+    # are not retried.
+    options = dict(total=retries, connect=retries, read=0, status=retries, backoff_factor=backoff,
+        status_forcelist=(502, 503, 504), raise_on_status=False)
+    try:
+        return Retry(allowed_methods=frozenset(['POST']), **options)
+    except TypeError:
+        # urllib3 before 1.26
+        return Retry(method_whitelist=frozenset(['POST']), **options)
+
+class Api(object):
+    """The FreeNAS REST API (v1.0) on 'host', over one kept-alive session.
+
+    Failed connections and 502, 503 and 504 answers are retried up to
+    'retries' times, waiting 'backoff' seconds and doubling. Raises
+    ValueError if the requests package is missing.
+    """
+
+    def __init__(self, host, auth, retries=5, backoff=1, timeout=30):
+        if requests is None:
+            raise ValueError("the FreeNAS API needs the requests package")
+        self.url = host if '://' in host else 'http://' + host
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.verify = False
+        self.session.headers['Content-Type'] = 'application/json'
+        adapter = HTTPAdapter(max_retries=retry(retries, backoff), pool_connections=1, pool_maxsize=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def post(self, path, payload):
+        """POST 'payload' as JSON; raises ApiError if FreeNAS cannot be reached."""
+        try:
+            return self.session.post(self.url + path, data=json.dumps(payload), timeout=self.timeout)
+        except requests.RequestException as e:
+            raise ApiError(str(e))
+
+    def snapshot(self, dataset, name):
+        """Create 'dataset@name'; FreeNAS answers 201 on success."""
+        return self.post(SNAPSHOTS, {'dataset': dataset, 'name': name})
+
+    def close(self):
+        self.session.close()
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, as FreeNAS does
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path != SNAPSHOTS:
+            return self.answer(404, {'error': 'not found'})
+        if server.authorization and self.headers.get('Authorization') != server.authorization:
+            return self.answer(401, {'error': 'invalid credentials'})
+        with server.lock:
+            failing = server.failures > 0
+            if failing:
+                server.failures -= 1
+        if failing:
+            return self.answer(503, {'error': 'service unavailable'})
+        try:
+            payload = json.loads(body.decode())
+            dataset, name = payload['dataset'], payload['name']
+        except (ValueError, KeyError, TypeError):
+            return self.answer(400, {'error': 'expected a dataset and a name'})
+        with server.lock:
+            exists = (dataset, name) in server.snapshots
+            if not exists:
+                server.snapshots.append((dataset, name))
+                if server.backend is not None:
+                    server.backend.snapshot(dataset, name)
+        if exists:
+            return self.answer(409, {'error': 'snapshot %s@%s already exists' % (dataset, name)})
+        logging.info("stub: created snapshot %s@%s" % (dataset, name))
+        self.answer(201, {'fullname': dataset+'@'+name, 'name': name, 'parent_type': 'filesystem'})
+
+    def answer(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *arguments):
+        logging.debug("stub: " + format % arguments)
+
+class StubServer(ThreadingHTTPServer):
+    """A stand-in for the FreeNAS snapshot API on localhost.
+
+    Created snapshots are recorded in 'snapshots' as (dataset, name), and
+    taken on the FakeBackend 'backend' if one is given. With 'auth',
+    requests must carry that (username, password). The first 'failures'
+    requests are answered 503, to exercise retries. 'connections' counts
+    the connections accepted.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, auth=None, backend=None, failures=0, address=('127.0.0.1', 0)):
+        ThreadingHTTPServer.__init__(self, address, StubHandler)
+        self.authorization = 'Basic ' + base64.b64encode(('%s:%s' % auth).encode()).decode() if auth else None
+        self.backend = backend
+        self.failures = failures
+        self.snapshots = []
+        self.connections = 0
+        self.lock = threading.Lock()
+
+    @property
+    def host(self):
+        return '%s:%d' % self.server_address[:2]
+
+    def get_request(self):
+        accepted = ThreadingHTTPServer.get_request(self)
+        with self.lock:
+            self.connections += 1
+        return accepted
+
+    def start(self):
+        """Serve from a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class Rollup(object):
+    """Prune datasets with a retention Policy shortly after snapshots land in them.
+
+    trigger() schedules a run 'delay' seconds later, and a dataset
+    triggered again before then is pruned once. Runs happen one at a time
+    on a background thread. 'backend' is connected for each run and its
+    zfs calls go to it. With 'test', nothing is destroyed.
+    """
+
+    def __init__(self, policy, backend, delay=30, test=False):
+        self.policy = policy
+        self.backend = backend
+        self.delay = delay
+        self.test = test
+        # dataset -> when to prune it, earliest first
+        self.pending = OrderedDict()
+        self.closing = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def trigger(self, dataset):
+        with self.condition:
+            if dataset in self.pending:
+                logging.info("rollup: %s is already due" % dataset)
+                return
+            self.pending[dataset] = time.time() + self.delay
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if not self.pending:
+                    if self.closing:
+                        return
+                    self.condition.wait()
+                    continue
+                dataset, due = next(iter(self.pending.items()))
+                if due > time.time() and not self.closing:
+                    self.condition.wait(due - time.time())
+                    continue
+                del self.pending[dataset]
+            try:
+                self.prune(dataset)
+            except (zfs.ZfsError, ValueError) as e:
+                logging.error("rollup of %s failed: %s" % (dataset, e))
+
+    def prune(self, dataset):
+        self.backend.connect()
+        try:
+            with zfs.using(self.backend):
+                actions = plan(fetch([dataset]), self.policy)
+                targets = destroy_targets(actions)
+                batches = batch_targets(targets) if targets else []
+                failed = 0
+                for target in batches:
+                    logging.info("rollup: destroying " + target)
+                    if not self.test and zfs.destroy(target):
+                        failed += 1
+        finally:
+            self.backend.close()
+        pruned = sum(1 for action in actions if action.prune)
+        if failed:
+            logging.error("rollup: %d of %d destroys of %s failed" % (failed, len(batches), dataset))
+        logging.info("rollup: %s %d of %d snapshots of %s" % ("would prune" if self.test else "pruned", pruned, len(actions), dataset))
+
+    def close(self):
+        """Prune whatever is pending now, and stop."""
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        self.thread.join()
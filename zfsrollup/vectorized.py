@@ -0,0 +1,62 @@
+# zfsrollup/vectorized.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Optional NumPy implementation of the bucket assignment in
+# retention.Retention. Every interval is evaluated with a handful of array
+# operations over all creation epochs of a dataset instead of one Python
+# step per snapshot. Without NumPy, 'available' is False and callers use
+# Retention instead.
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+available = numpy is not None
+
+# below this many snapshots the array setup costs more than it saves
+threshold = 512
+
+def first_of_buckets(ids):
+    # positions of the oldest snapshot of each bucket
+    starts = numpy.empty(len(ids), dtype=bool)
+    starts[:1] = True
+    numpy.not_equal(ids[1:], ids[:-1], out=starts[1:])
+    return numpy.flatnonzero(starts)
+
+def chain(epochs, gap):
+    # positions kept by an 'interval' style bucket: each snapshot more than
+    # 'gap' seconds after the previously kept one
+    if not len(epochs):
+        return numpy.zeros(0, dtype=numpy.int64)
+    kept = list()
+    if (epochs[-1] - epochs[0]) / gap < len(epochs) / 16:
+        # few buckets: jump from one kept snapshot to the next
+        position = 0
+        while position < len(epochs):
+            kept.append(position)
+            position = int(numpy.searchsorted(epochs, epochs[position] + gap, side='right'))
+    else:
+        # most snapshots open a bucket: a plain scan is cheaper than searching
+        last = None
+        for position, epoch in enumerate(epochs.tolist()):
+            if last is None or last + gap < epoch:
+                kept.append(position)
+                last = epoch
+    return numpy.array(kept, dtype=numpy.int64)
+
+def retain(creation, intervals):
+    """Map each interval to the positions it keeps, given ascending 'creation' epochs."""
+    epochs = numpy.frombuffer(creation, dtype=numpy.int64) if len(creation) else numpy.zeros(0, dtype=numpy.int64)
+    kept = {}
+    for interval, definition in intervals.items():
+        if 'reference' in definition:
+            positions = first_of_buckets(definition['calendar'].keys(epochs)) if len(epochs) else epochs
+        else:
+            positions = chain(epochs, definition['gap'])
+        # the cap keeps the newest 'max' buckets
+        if definition['max'] != 0:
+            positions = positions[-definition['max']:]
+        kept[interval] = positions
+    return kept
@@ -0,0 +1,227 @@
+# zfsrollup/zfs.py
+#   This work is licensed under a Creative Commons Attribution-ShareAlike 3.0 Unported License.
+#   (CC BY-SA-3.0) http://creativecommons.org/licenses/by-sa/3.0/
+
+# Every zfs query and destroy goes through a backend. The default one wraps
+# the zfs command line tool; lzc.py talks to libzfs_core directly and
+# fake.py keeps an in-memory pool; fleet.py reaches other hosts over ssh.
+# The module level functions dispatch to whichever backend use() last
+# selected, unless the calling thread picked its own with using().
+
+import atexit
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+from . import stats
+
+class ZfsError(Exception):
+    def __init__(self, command, returncode):
+        Exception.__init__(self, "zfs %s failed with RC=%s" % (command, returncode))
+        self.command = command
+        self.returncode = returncode
+
+def arg_limit():
+    """The longest single argument that can safely be passed to zfs through the current backend."""
+    # Linux caps each argument at MAX_ARG_STRLEN (32 pages) regardless of
+    # ARG_MAX; leave room for the environment and the rest of the command,
+    # and for what the backend wraps around the argument
+    try:
+        arg_max = os.sysconf('SC_ARG_MAX')
+    except (ValueError, OSError):
+        arg_max = 262144
+    environment = sum(len(key) + len(value) + 2 for key, value in os.environ.items())
+    return max(4096, min(131072, arg_max - environment - 4096) - 1) - getattr(current(), 'overhead', 0)
+
+class CliBackend(object):
+    """Run the zfs command line tool and parse its output."""
+
+    def argv(self, program, command):
+        # the process that runs 'program' (zfs or zpool) with 'command'
+        return [program] + command
+
+    def _rows(self, command, fields, program="zfs"):
+        # stream tab separated output of a zfs (or zpool) command, one list per line
+        subp = subprocess.Popen(self.argv(program, command), stdout=subprocess.PIPE)
+        try:
+            for line in subp.stdout:
+                yield line.decode().rstrip('\n').split('\t', fields - 1)
+        finally:
+            subp.stdout.close()
+            returncode = subp.wait()
+        if returncode:
+            raise ZfsError(command[0] if program == "zfs" else program+" "+command[0], returncode)
+
+    def get(self, dataset, properties, types=None, recursive=True, depth=None):
+        command = ["get"]
+        if types:
+            command += ["-t", types]
+        if depth is not None:
+            command += ["-d", str(depth)]
+        command += ["-Hrpo" if recursive and depth is None else "-Hpo", "name,property,value", ",".join(properties)]
+        command += [dataset] if isinstance(dataset, str) else list(dataset)
+        return self._rows(command, 3)
+
+    def listing(self, dataset, fields, types='snapshot', depth=1, sort=None):
+        command = ["list", "-Hp", "-t", types, "-o", ",".join(fields)]
+        if sort:
+            command += ["-S", sort[1:]] if sort.startswith('-') else ["-s", sort]
+        if depth is not None:
+            command += ["-d", str(depth)]
+        else:
+            command += ["-r"]
+        return self._rows(command + [dataset], len(fields))
+
+    def destroy(self, target, flags=()):
+        return subprocess.call(self.argv("zfs", ["destroy"] + list(flags) + [target]))
+
+    def bookmark(self, snapshot, bookmark):
+        return subprocess.call(self.argv("zfs", ["bookmark", snapshot, bookmark]))
+
+    def bookmarks(self, pairs):
+        # 'zfs bookmark' takes a single snapshot
+        for snapshot, bookmark in pairs:
+            returncode = self.bookmark(snapshot, bookmark)
+            if returncode:
+                return returncode
+        return 0
+
+    def reclaim(self, target):
+        subp = subprocess.Popen(self.argv("zfs", ["destroy", "-nvp", target]), stdout=subprocess.PIPE)
+        output = subp.communicate()[0]
+        if subp.returncode:
+            raise ZfsError('destroy -nvp', subp.returncode)
+        for line in output.decode().splitlines():
+            fields = line.split('\t')
+            if fields[0] == 'reclaim':
+                return int(fields[1])
+        return 0
+
+    def freeing(self, pool):
+        for value, in self._rows(["get", "-Hp", "-o", "value", "freeing", pool], 1, "zpool"):
+            return int(value) if value.isdigit() else 0
+        return 0
+
+    def latency(self, pool):
+        # total wait of a one second sample (the first 'zpool iostat' report
+        # averages everything since import), the worse of reads and writes
+        rows = list(self._rows(["iostat", "-Hpl", pool, "1", "2"], 18, "zpool"))
+        waits = [int(value) for value in rows[-1][7:9] if value.isdigit()] if rows else []
+        return max(waits) / 1e9 if waits else 0.0
+
+backend = CliBackend()
+
+# the names accepted by configure()
+backends = ('cli', 'lzc', 'fake')
+
+# per thread overrides of 'backend', set by using()
+_local = threading.local()
+
+def use(new):
+    """Send all further zfs calls to the 'new' backend, returning the previous one."""
+    global backend
+    previous, backend = backend, new
+    return previous
+
+def current():
+    """The backend zfs calls from this thread go to."""
+    return getattr(_local, 'backend', None) or backend
+
+@contextmanager
+def using(new):
+    """Send zfs calls made by this thread to the 'new' backend for the duration of the block.
+
+    Threads started inside the block do not inherit it; each_dataset() and
+    the Scheduler pass the caller's backend on to their workers.
+    """
+    previous = getattr(_local, 'backend', None)
+    _local.backend = new
+    try:
+        yield new
+    finally:
+        _local.backend = previous
+
+def configure(args):
+    """Select the backend named by parsed command line 'args' (--backend and --fake-pool).
+
+    Raises ValueError if the backend is unknown or cannot be used here.
+    """
+    name = getattr(args, 'backend', None) or 'cli'
+    path = getattr(args, 'fake_pool', None)
+    if name == 'cli':
+        return use(CliBackend())
+    if name == 'lzc':
+        from .lzc import LzcBackend
+        return use(LzcBackend())
+    if name == 'fake':
+        from .fake import FakeBackend
+        try:
+            fake = FakeBackend.load(path) if path else FakeBackend()
+        except (IOError, ValueError) as e:
+            raise ValueError("cannot load fake pool %s: %s" % (path, e))
+        if path:
+            # keep destroys for the next run
+            atexit.register(fake.save, path)
+        return use(fake)
+    raise ValueError("invalid backend: %s" % name)
+
+def _timed(command, function, *arguments):
+    if not stats.current:
+        return function(*arguments)
+    started = time.perf_counter()
+    try:
+        return function(*arguments)
+    finally:
+        stats.current.call(command, time.perf_counter() - started)
+
+def get(dataset, properties, types=None, recursive=True, depth=None):
+    """Yield (name, property, value) rows for 'dataset' and everything below it.
+
+    'dataset' may also be a list of names; with recursive=False only those
+    names are queried. 'depth' limits the recursion, as with 'zfs get -d'.
+
+    Rows are read from the pipe as zfs produces them, so the full output is
+    never held in memory. ZfsError is raised once the output is exhausted if
+    zfs exited with an error.
+    """
+    rows = current().get(dataset, properties, types, recursive, depth)
+    return stats.current.timed(rows, command='get') if stats.current else rows
+
+def listing(dataset, fields, types='snapshot', depth=1, sort=None):
+    """Yield one list of 'fields' values per item below 'dataset', as 'zfs list -Hp'.
+
+    'sort' names a property to order by, descending if prefixed with '-'.
+    Closing the generator early stops reading the zfs output.
+    """
+    rows = current().listing(dataset, fields, types, depth, sort)
+    return stats.current.timed(rows, command='list') if stats.current else rows
+
+def destroy(target, flags=()):
+    """Destroy 'target' (dataset@snapshot or dataset@first%last), returning the exit code."""
+    return _timed('destroy', current().destroy, target, flags)
+
+def bookmark(snapshot, name):
+    """Bookmark 'dataset@snapshot' as 'dataset#name', returning the exit code."""
+    return _timed('bookmark', current().bookmark, snapshot, name)
+
+def bookmarks(pairs):
+    """Bookmark each (dataset@snapshot, dataset#name) of 'pairs', stopping at the first failure.
+
+    Returns the exit code. Backends that can make several bookmarks in
+    one call do so; the ones made before a failure are kept.
+    """
+    return _timed('bookmark', current().bookmarks, list(pairs))
+
+def reclaim(target):
+    """Bytes that destroying 'target' would free, as estimated by 'zfs destroy -nvp'."""
+    return _timed('destroy -nvp', current().reclaim, target)
+
+def freeing(pool):
+    """Bytes of destroyed data 'pool' has yet to free in the background."""
+    return _timed('zpool get freeing', current().freeing, pool)
+
+def latency(pool):
+    """Seconds an I/O request of 'pool' currently waits, from 'zpool iostat -l'."""
+    return _timed('zpool iostat', current().latency, pool)